@@ -0,0 +1,304 @@
+# Long-running build service, which keeps imports, connections and caches warm between builds
+import argparse
+from collections import OrderedDict
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import importlib
+import itertools
+import json
+import os
+import queue
+import sys
+import threading
+import traceback
+import urllib.request
+
+from metrics import metrics
+from utils import reset_build_state
+
+DEFAULT_DAEMON_PORT = int(os.environ.get("BGE_DAEMON_PORT", "8765"))
+
+# builders the daemon runs, by the name a job gives
+BUILDERS = {
+    "genome": "make_crate_genome",
+    "barcode": "make_crate_barcode",
+    "barcode-validation": "make_crate_barcode_validation",
+}
+
+# finished jobs kept for status and log requests
+MAX_FINISHED_JOBS = 100
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class Job:
+    """A build request: one builder's ``main`` run with the given arguments."""
+
+    def __init__(self, job_id: int, builder: str, args: list[str], cwd: str):
+        self.id = job_id
+        self.builder = builder
+        self.args = args
+        self.cwd = cwd
+        self.status = "queued"
+        self.submitted = _now()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.report = None
+        self._lines = []
+        self._changed = threading.Condition()
+
+    # a Job is the stdout and stderr of its build, so that all the builder prints is its progress
+    def write(self, text: str) -> int:
+        with self._changed:
+            self._lines.append(text)
+            self._changed.notify_all()
+        return len(text)
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self, status: str, error: str | None = None) -> None:
+        with self._changed:
+            self.status = status
+            self.error = error
+            self.finished = _now()
+            self._changed.notify_all()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def follow(self):
+        """The job's output as it is written, until the job is done."""
+        offset = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: len(self._lines) > offset or self.done)
+                lines = self._lines[offset:]
+                done = self.done
+            offset += len(lines)
+            yield from lines
+            if done and not lines:
+                return
+
+    def describe(self) -> dict:
+        return {
+            "id": self.id,
+            "builder": self.builder,
+            "args": self.args,
+            "cwd": self.cwd,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "report": self.report,
+        }
+
+
+class BuildDaemon:
+    """Runs build jobs one at a time, in this process, in the order they were submitted.
+
+    The builders share module-level state (metrics, checkpoint, validator
+    settings), so jobs do not overlap. Between jobs the process keeps what makes
+    a build start slowly: the imported modules, the HTTP connection pool, the
+    fetched upstream records, the validation profiles already loaded and the
+    open taxonomy index (one per file, see ``open_taxonomy_index``).
+    """
+
+    def __init__(self, clear_records: bool = False):
+        self.clear_records = clear_records
+        self.jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.builders = {
+            name: importlib.import_module(m) for name, m in BUILDERS.items()
+        }
+        threading.Thread(target=self._work, name="build worker", daemon=True).start()
+
+    def submit(self, builder: str, args: list[str], cwd: str) -> Job:
+        """Queue a build.
+
+        :param builder: one of ``BUILDERS``
+        :param args: command line arguments for the builder
+        :param cwd: folder relative output paths are resolved against
+        :raises ValueError: the builder is not known
+        :return: the queued job
+        """
+        if builder not in self.builders:
+            raise ValueError(
+                f"Unknown builder {builder!r}, choose one of {', '.join(BUILDERS)}."
+            )
+        with self._lock:
+            job = Job(next(self._ids), builder, list(args), cwd)
+            self.jobs[job.id] = job
+            finished = [j.id for j in self.jobs.values() if j.done]
+            for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+                del self.jobs[job_id]
+        self._queue.put(job)
+        return job
+
+    def list_jobs(self) -> list[Job]:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started = _now()
+            reset_build_state(clear_records=self.clear_records)
+            try:
+                os.chdir(job.cwd)
+                with redirect_stdout(job), redirect_stderr(job):
+                    self.builders[job.builder].main(job.args)
+            except SystemExit as e:  # argparse errors and --dry-run exits
+                job.report = metrics.report()
+                if e.code:
+                    job.finish("failed", f"exited with status {e.code}")
+                else:
+                    job.finish("succeeded")
+            except Exception:
+                job.report = metrics.report()
+                job.finish("failed", traceback.format_exc())
+            else:
+                job.report = metrics.report()
+                job.finish("succeeded")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    daemon: BuildDaemon
+
+    def _send_json(self, status: int, body) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self, job_id: str) -> Job | None:
+        job = self.daemon.jobs.get(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            self._send_json(404, {"error": f"no job {job_id}"})
+        return job
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self._send_json(200, [job.describe() for job in self.daemon.list_jobs()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            if job := self._job(parts[1]):
+                self._send_json(200, job.describe())
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "log":
+            if job := self._job(parts[1]):
+                # no length: the log is streamed until the job is done, then the connection closes
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.end_headers()
+                for text in job.follow():
+                    self.wfile.write(text.encode())
+                    self.wfile.flush()
+        else:
+            self._send_json(404, {"error": f"no resource {self.path}"})
+
+    def do_POST(self):
+        if self.path.strip("/") != "jobs":
+            self._send_json(404, {"error": f"no resource {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            job = self.daemon.submit(
+                request["builder"], request.get("args", []), request["cwd"]
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        self._send_json(202, job.describe())
+
+    def log_message(self, format, *args):
+        # job output goes to the client, so keep the daemon's own stderr quiet
+        pass
+
+
+def serve(port: int = DEFAULT_DAEMON_PORT, clear_records: bool = False) -> None:
+    """Run the daemon on localhost until interrupted.
+
+    :param port: port to listen on, on 127.0.0.1 only
+    :param clear_records: forget fetched records after each job
+    """
+    handler = type("Handler", (_Handler,), {"daemon": BuildDaemon(clear_records)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Build daemon listening on http://127.0.0.1:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def submit(builder: str, args: list[str], port: int = DEFAULT_DAEMON_PORT) -> dict:
+    """Send a build to a running daemon, print its progress as it comes in, and wait for it.
+
+    :param builder: one of ``BUILDERS``
+    :param args: command line arguments for the builder
+    :param port: port the daemon listens on
+    :return: the finished job, as listed by the daemon
+    """
+    base = f"http://127.0.0.1:{port}/jobs"
+    request = urllib.request.Request(
+        base,
+        data=json.dumps(
+            {"builder": builder, "args": args, "cwd": os.getcwd()}
+        ).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as r:
+        job = json.load(r)
+    with urllib.request.urlopen(f"{base}/{job['id']}/log") as r:
+        for line in r:
+            sys.stdout.write(line.decode())
+            sys.stdout.flush()
+    with urllib.request.urlopen(f"{base}/{job['id']}") as r:
+        return json.load(r)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Keep builders warm in a local daemon, and send builds to it"
+    )
+    parser.add_argument("--port", type=int, default=DEFAULT_DAEMON_PORT)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the daemon")
+    serve_parser.add_argument(
+        "--clear-records",
+        action="store_true",
+        help="forget fetched upstream records after each job, so each build sees current data",
+    )
+    submit_parser = subparsers.add_parser(
+        "submit", help="run a build in the daemon and print its output"
+    )
+    submit_parser.add_argument("builder", choices=list(BUILDERS))
+    submit_parser.add_argument(
+        "args", nargs=argparse.REMAINDER, help="arguments for the builder"
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.port, clear_records=args.clear_records)
+        return
+    job = submit(args.builder, args.args, port=args.port)
+    if job["status"] != "succeeded":
+        print(f"Job {job['id']} failed: {job['error']}", file=sys.stderr)
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
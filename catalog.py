@@ -0,0 +1,292 @@
+# Catalog of built crates, for finding every crate which mentions an accession
+import argparse
+import json
+import os
+import re
+import sqlite3
+import zipfile
+from typing import Iterable, Iterator, NamedTuple
+from urllib.parse import unquote, urlsplit
+
+from merge_crates import read_metadata
+
+DEFAULT_CATALOG_DB = os.environ.get("BGE_CATALOG_DB", "catalog.sqlite")
+
+METADATA_FILE = "ro-crate-metadata.json"
+
+# accessions which may be embedded in longer ids, e.g. "#MHMXN361-07-sequencing"
+ACCESSION_PATTERN = re.compile(
+    r"""\b(
+        (?:SAM[EDN][A-Z]?|[EDS]R[SXRP]|PRJ[EDN][A-Z]|ERZ)\d+  # INSDC samples, experiments, runs, projects, analyses
+        | GC[AF]_\d+\.\d+  # assemblies
+        | [A-Z]{4}(?:[A-Z]{2})?\d{2}  # WGS sets, e.g. CAXLNB01
+        | [A-Z]{2,6}\d{3,6}-\d{2}  # BOLD process ids, e.g. MHMXN361-07
+        | BOLD:[A-Z]{3}\d{4}  # BOLD BINs
+    )\b""",
+    re.VERBOSE,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crates (
+    crate_id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    name TEXT
+);
+CREATE TABLE IF NOT EXISTS entities (
+    crate_id INTEGER NOT NULL REFERENCES crates ON DELETE CASCADE,
+    entity_id TEXT NOT NULL,
+    types TEXT NOT NULL,
+    PRIMARY KEY (crate_id, entity_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS keys (
+    key TEXT NOT NULL COLLATE NOCASE,
+    crate_id INTEGER NOT NULL REFERENCES crates ON DELETE CASCADE,
+    entity_id TEXT NOT NULL,
+    field TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS keys_by_key ON keys (key COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS keys_by_crate ON keys (crate_id);
+"""
+
+
+class CatalogHit(NamedTuple):
+    crate_path: str
+    entity_id: str
+    types: list[str]
+    field: str  # where the key was found: "@id", "identifier" or "sameAs"
+
+
+class UpdateSummary(NamedTuple):
+    indexed: int
+    unchanged: int
+    removed: int
+
+
+###################
+# key extraction  #
+###################
+
+
+def _values(value) -> Iterator[str]:
+    """String values of a JSON-LD property: plain strings, {"@id": ...} references and PropertyValue values."""
+    for item in value if isinstance(value, list) else [value]:
+        if isinstance(item, str):
+            yield item
+        elif isinstance(item, dict):
+            for field in ("@id", "value"):
+                if isinstance(item.get(field), str):
+                    yield item[field]
+
+
+def lookup_keys(value: str) -> set[str]:
+    """Keys under which a single id or identifier can be found.
+
+    Besides the value itself, these are the local part of a local (``#``) id,
+    the accession of an identifiers.org URI, the last segment of other URLs and
+    any accessions embedded in the value.
+    """
+    keys = {value}
+    if value.startswith("#"):
+        keys.add(unquote(value[1:]))
+    elif "://" in value:
+        url = urlsplit(value)
+        last_segment = unquote(url.path.rstrip("/").rsplit("/", 1)[-1])
+        if url.hostname == "identifiers.org":
+            last_segment = last_segment.split(":", 1)[-1]
+        if last_segment:
+            keys.add(last_segment)
+    keys.update(ACCESSION_PATTERN.findall(value))
+    return {key for key in keys if key}
+
+
+def entity_keys(entity: dict) -> Iterator[tuple[str, str]]:
+    """(key, field) pairs for everything which identifies an entity."""
+    for field in ("@id", "identifier", "sameAs"):
+        if field in entity:
+            for value in _values(entity[field]):
+                for key in lookup_keys(value):
+                    yield key, field
+
+
+###########
+# catalog #
+###########
+
+
+def _is_crate_zip(path: str) -> bool:
+    """Whether a file is a crate zip, as written by the builders' ``--zip``."""
+    if not path.endswith(".zip") or not zipfile.is_zipfile(path):
+        return False
+    with zipfile.ZipFile(path) as zf:
+        return METADATA_FILE in zf.namelist()
+
+
+def find_crates(roots: Iterable[str]) -> Iterator[str]:
+    """Paths of all crate metadata files and crate zips under the given folders (or metadata files and zips given directly)."""
+    for root in roots:
+        if os.path.isfile(root):
+            yield os.path.abspath(root)
+            continue
+        for dirpath, _, filenames in os.walk(root):
+            if METADATA_FILE in filenames:
+                yield os.path.abspath(os.path.join(dirpath, METADATA_FILE))
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if _is_crate_zip(path):
+                    yield os.path.abspath(path)
+
+
+class CrateCatalog:
+    """SQLite index from entity ids, identifiers and accessions to the crates which contain them.
+
+    Crates are indexed from their metadata file, or from the metadata inside a
+    crate zip. The catalog is updated incrementally: crates whose metadata file
+    (or zip) has the same size and modification time as when it was last indexed are skipped, and crates
+    which have disappeared are dropped.
+    """
+
+    def __init__(self, db_path: str = DEFAULT_CATALOG_DB):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript("PRAGMA foreign_keys = ON;" + SCHEMA)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _index_crate(self, path: str, stat: os.stat_result) -> None:
+        graph = read_metadata(path).get("@graph", [])
+        root = next((e for e in graph if e.get("@id") == "./"), {})
+        self._db.execute("DELETE FROM crates WHERE path = ?", (path,))
+        crate_id = self._db.execute(
+            "INSERT INTO crates (path, mtime_ns, size, name) VALUES (?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, root.get("name")),
+        ).lastrowid
+        entities = [e for e in graph if isinstance(e.get("@id"), str)]
+        self._db.executemany(
+            "INSERT OR REPLACE INTO entities VALUES (?, ?, ?)",
+            (
+                (crate_id, e["@id"], json.dumps(list(_values(e.get("@type", [])))))
+                for e in entities
+            ),
+        )
+        self._db.executemany(
+            "INSERT INTO keys VALUES (?, ?, ?, ?)",
+            (
+                (key, crate_id, e["@id"], field)
+                for e in entities
+                for key, field in set(entity_keys(e))
+            ),
+        )
+
+    def update(self, roots: Iterable[str]) -> UpdateSummary:
+        """Index new and changed crates under the given folders and drop crates which no longer exist.
+
+        :param roots: folders to search for crates (recursively), crate metadata files or crate zips
+        :return: number of crates indexed, skipped as unchanged, and removed
+        """
+        known = {
+            path: (mtime_ns, size)
+            for path, mtime_ns, size in self._db.execute(
+                "SELECT path, mtime_ns, size FROM crates"
+            )
+        }
+        roots = [os.path.abspath(root) for root in roots]
+        indexed = unchanged = 0
+        found = set()
+        with self._db:
+            for path in find_crates(roots):
+                found.add(path)
+                stat = os.stat(path)
+                if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                    unchanged += 1
+                    continue
+                self._index_crate(path, stat)
+                indexed += 1
+            # only forget crates under the folders which were searched
+            removed = [
+                path
+                for path in known
+                if path not in found
+                and any(path.startswith(os.path.join(root, "")) for root in roots)
+            ]
+            self._db.executemany(
+                "DELETE FROM crates WHERE path = ?", ((path,) for path in removed)
+            )
+        return UpdateSummary(indexed, unchanged, len(removed))
+
+    def lookup(self, key: str) -> list[CatalogHit]:
+        """Find every entity, in every crate, identified by a key.
+
+        :param key: an accession (e.g. "SAMEA114402090" or "MHMXN361-07"), entity id or identifier. Case-insensitive.
+        :return: matching entities, ordered by crate path
+        """
+        rows = self._db.execute(
+            """
+            SELECT DISTINCT crates.path, keys.entity_id, entities.types, keys.field
+            FROM keys
+            JOIN crates USING (crate_id)
+            JOIN entities USING (crate_id, entity_id)
+            WHERE keys.key = ?
+            ORDER BY crates.path, keys.entity_id, keys.field
+            """,
+            (key.strip(),),
+        )
+        return [
+            CatalogHit(path, entity_id, json.loads(types), field)
+            for path, entity_id, types, field in rows
+        ]
+
+    def crates_mentioning(self, key: str) -> list[str]:
+        """Paths of the crate metadata files and crate zips which mention a key, see ``lookup``."""
+        return list(dict.fromkeys(hit.crate_path for hit in self.lookup(key)))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Index built crates and find the crates which mention an accession."
+    )
+    parser.add_argument("--db", default=DEFAULT_CATALOG_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser(
+        "index", help="add new and changed crates to the catalog"
+    )
+    index_parser.add_argument(
+        "roots", nargs="+", help="folders to search for crate folders and crate zips"
+    )
+
+    lookup_parser = subparsers.add_parser(
+        "lookup", help="list the crates which mention an accession"
+    )
+    lookup_parser.add_argument("keys", nargs="+")
+    lookup_parser.add_argument(
+        "--crates-only",
+        action="store_true",
+        help="print only the crate paths, e.g. to feed a rebuild",
+    )
+
+    args = parser.parse_args(argv)
+    catalog = CrateCatalog(args.db)
+    if args.command == "index":
+        summary = catalog.update(args.roots)
+        print(
+            f"{summary.indexed} crates indexed, {summary.unchanged} unchanged, "
+            f"{summary.removed} removed"
+        )
+    elif args.crates_only:
+        for key in args.keys:
+            print(*catalog.crates_mentioning(key), sep="\n")
+    else:
+        for key in args.keys:
+            hits = [
+                f"{hit.crate_path}\t{hit.entity_id} ({', '.join(hit.types)}) via {hit.field}"
+                for hit in catalog.lookup(key)
+            ]
+            print(key, *(hits or ["not found"]), sep="\n  ")
+    catalog.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# Checkpointing of fetched upstream metadata, so interrupted crate builds can be resumed
+import argparse
+import json
+import os
+import threading
+
+from records import dump_record, load_record
+
+
+def checkpoint_path(output_dir: str) -> str:
+    return f"{output_dir.rstrip('/')}-checkpoint.jsonl"
+
+
+def add_resume_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--fresh",
+        action="store_true",
+        help="ignore the checkpoint left by an interrupted build and fetch everything again",
+    )
+
+
+class BuildCheckpoint:
+    """Append-only log of the records fetched during a build and the stages completed.
+
+    Each fetched record is appended as one JSON line as soon as it arrives, so
+    nothing fetched before a failure (or a Ctrl-C) is lost. Reopening the log
+    returns the records so the fetcher cache can be primed with them; the stages
+    then rebuild their entities from the cache without any network calls and the
+    build carries on from the first record that was never fetched.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self.path = None
+        self.completed_stages = []
+
+    def open(self, path: str, fresh: bool = False) -> list[tuple[tuple, object]]:
+        """Start checkpointing to ``path``, reading back what an earlier run left there.
+
+        :param path: state file, see ``checkpoint_path``
+        :param fresh: discard an existing state file instead of resuming from it
+        :return: (cache key, record) pairs fetched by the earlier run
+        """
+        records = []
+        self.completed_stages = []
+        if os.path.exists(path) and not fresh:
+            with open(path, encoding="utf-8") as f:
+                for line_number, line in enumerate(f, 1):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the previous run died while writing this line
+                        print(
+                            f"Warning: ignoring incomplete line {line_number} of {path}"
+                        )
+                        continue
+                    if "stage" in entry:
+                        self.completed_stages.append(entry["stage"])
+                    else:
+                        records.append(
+                            (
+                                tuple(entry["key"]),
+                                load_record(entry.get("type"), entry["record"]),
+                            )
+                        )
+            print(
+                f"Resuming from {path}: {len(records)} records already fetched, "
+                f"stages completed: {', '.join(self.completed_stages) or 'none'}"
+            )
+        self.path = path
+        self._file = open(path, "w" if fresh else "a", encoding="utf-8")
+        return records
+
+    def _append(self, entry: dict) -> None:
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self._file.flush()
+
+    def save_record(self, key: tuple, record) -> None:
+        record_type, value = dump_record(record)
+        entry = {"key": list(key), "record": value}
+        if record_type:
+            entry["type"] = record_type
+        self._append(entry)
+
+    def stage_completed(self, name: str) -> None:
+        self.completed_stages.append(name)
+        self._append({"stage": name})
+
+    def close(self, completed: bool) -> None:
+        """Stop checkpointing. The state file is removed if the build completed, and kept for a rerun otherwise."""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.close()
+            self._file = None
+        if completed:
+            os.remove(self.path)
+        else:
+            print(f"Build interrupted, rerun to resume from {self.path}")
+
+
+# checkpoint used by all fetchers in this process
+checkpoint = BuildCheckpoint()
@@ -0,0 +1,226 @@
+# Reusable crate validation, with a choice of severity and per-check timings
+import argparse
+from contextlib import contextmanager
+import threading
+import time
+from typing import NamedTuple
+
+from rdflib import URIRef
+from rocrate_validator import services, models
+from rocrate_validator.events import EventType, Subscriber
+from rocrate_validator.models import Profile
+from rocrate_validator.requirements.shacl.models import ShapesRegistry
+
+from jsonld_cache import context_cache
+from metrics import metrics
+
+DEFAULT_PROFILE = "ro-crate-1.1"
+SEVERITIES = ["REQUIRED", "RECOMMENDED", "OPTIONAL"]
+
+# number of checks listed when printing timings
+SLOWEST_CHECKS = 10
+
+
+class CheckTiming(NamedTuple):
+    identifier: str
+    name: str
+    seconds: float
+
+
+class _CheckTimer(Subscriber):
+    """Records how long each requirement check of a validation takes."""
+
+    def __init__(self):
+        super().__init__("check timer")
+        self.started = {}
+        self.timings = []
+
+    def update(self, event, ctx=None):
+        if event.event_type == EventType.REQUIREMENT_CHECK_VALIDATION_START:
+            self.started[id(event.requirement_check)] = time.perf_counter()
+        elif event.event_type == EventType.REQUIREMENT_CHECK_VALIDATION_END:
+            check = event.requirement_check
+            started = self.started.pop(id(check), None)
+            if started is not None:
+                self.timings.append(
+                    CheckTiming(
+                        check.identifier, check.name, time.perf_counter() - started
+                    )
+                )
+
+
+# loaded profiles and the crate base URI (publicID) they are bound to, by the other
+# arguments they were loaded with: the profiles folders, severity and override flag
+_profiles = {}
+_profiles_lock = threading.Lock()
+_load_profiles = Profile.load_profiles.__func__
+# rdflib's SPARQL parser, which the SHACL checks use, fails when two threads parse
+# queries at once, so validations in one process run one at a time
+_validation_lock = threading.Lock()
+
+
+def _mentions_base(profile: Profile, base: str) -> bool:
+    """Whether the shapes a profile has parsed so far name IRIs under a crate's base URI.
+
+    Profile shapes may use crate-relative IRIs such as ``sh:targetNode ro:README.md``,
+    which are resolved against the base of the crate they were parsed for.
+    """
+    graph = ShapesRegistry.get_instance(profile).shapes_graph
+    return any(
+        isinstance(term, URIRef) and term.startswith(base)
+        for triple in graph
+        for term in triple
+    )
+
+
+def _cached_load_profiles(
+    cls,
+    profiles_path,
+    extra_profiles_path=None,
+    publicID=None,
+    severity=models.Severity.REQUIRED,
+    allow_requirement_check_override=True,
+):
+    key = (
+        str(profiles_path),
+        str(extra_profiles_path),
+        severity,
+        allow_requirement_check_override,
+    )
+    with _profiles_lock:
+        profiles, base = _profiles.get(key, (None, None))
+        if profiles is not None and base != publicID:
+            if base and any(_mentions_base(profile, base) for profile in profiles):
+                profiles = None  # parsed for the other crate, load them again
+            else:
+                for profile in profiles:
+                    profile._publicID = publicID  # requirements not yet parsed use it
+        if profiles is None:
+            profiles = _load_profiles(
+                cls,
+                profiles_path,
+                extra_profiles_path,
+                publicID,
+                severity,
+                allow_requirement_check_override,
+            )
+        _profiles[key] = (profiles, publicID)
+    return profiles
+
+
+@contextmanager
+def _reuse_loaded_profiles():
+    # roc-validator parses every profile's shapes again for each validation and has
+    # no way to pass it loaded profiles, so serve repeat loads from _profiles instead
+    Profile.load_profiles = classmethod(_cached_load_profiles)
+    try:
+        yield
+    finally:
+        Profile.load_profiles = classmethod(_load_profiles)
+
+
+class CrateValidator:
+    """Validates crates against a profile, keeping loaded profiles for the next validation.
+
+    The settings are fixed when the validator is configured. Profiles are loaded
+    once and then bound to the base URI of each crate validated, so validating
+    another crate, or the same crate again after an edit, skips parsing the profile
+    shapes. Profiles whose shapes name crate-relative IRIs are loaded again for each
+    crate location. Validations from several threads run one at a time, as
+    rdflib's SPARQL parser is not thread-safe.
+    """
+
+    def __init__(self):
+        self.configure()
+
+    def configure(
+        self,
+        profile: str = DEFAULT_PROFILE,
+        severity: str = "REQUIRED",
+        quick: bool = False,
+        timings: bool = False,
+    ) -> None:
+        """
+        :param profile: identifier of the profile to validate against
+        :param severity: lowest severity of the checks to run: "REQUIRED", "RECOMMENDED" or "OPTIONAL"
+        :param quick: skip the checks which dereference remote data entities
+        :param timings: print the slowest checks after each validation
+        """
+        # settings are only made when validating, as making them sets up the
+        # validator's HTTP cache and fetches the profile's documents
+        self.settings = dict(
+            profile_identifier=profile,
+            requirement_severity=models.Severity[severity],
+            skip_availability_check=quick,
+        )
+        self.timings_enabled = timings
+        self.timings = []
+
+    def validate(
+        self, crate_uri: str, offline: bool = False
+    ) -> models.ValidationResult:
+        """Validate a crate folder or zip, print the issues found and return the result.
+
+        :param crate_uri: crate folder or zip
+        :param offline: serve all HTTP requests of the validator from its cache
+        :return: the validation result
+        """
+        settings = services.ValidationSettings(
+            **self.settings, rocrate_uri=crate_uri, offline=offline
+        )
+        # after the settings are made, as making them sets up the validator's HTTP cache
+        context_cache.install()
+        timer = _CheckTimer()
+        with _validation_lock, metrics.span("validate"), _reuse_loaded_profiles():
+            result = services.validate(settings, subscribers=[timer])
+        self.timings = timer.timings
+
+        if not result.has_issues():
+            print("RO-Crate is valid!")
+        else:
+            print("RO-Crate is invalid!")
+            for issue in result.get_issues():
+                # Every issue object has a reference to the check that failed, the severity of the issue, and a message describing the issue.
+                print(
+                    f'Detected issue of severity {issue.severity.name} with check "{issue.check.identifier}": {issue.message}'
+                )
+        if self.timings_enabled:
+            print(self.describe_timings())
+        return result
+
+    def describe_timings(self, limit: int = SLOWEST_CHECKS) -> str:
+        """The slowest checks of the last validation, slowest first.
+
+        SHACL checks all run in a single pass, whose time is reported against the first SHACL check.
+        """
+        slowest = sorted(self.timings, key=lambda t: t.seconds, reverse=True)
+        lines = [
+            f"{len(self.timings)} checks in {sum(t.seconds for t in self.timings):.2f}s, slowest:"
+        ]
+        lines += [
+            f"  {t.seconds:8.3f}s  {t.identifier}  {t.name}" for t in slowest[:limit]
+        ]
+        return "\n".join(lines)
+
+
+def add_validation_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--validation-severity",
+        choices=SEVERITIES,
+        default="REQUIRED",
+        help="lowest severity of the validation checks to run (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--quick-validation",
+        action="store_true",
+        help="skip validation checks which dereference remote data entities",
+    )
+    parser.add_argument(
+        "--validation-timings",
+        action="store_true",
+        help="print the slowest validation checks",
+    )
+
+
+# validator used by validate_crate in this process
+crate_validator = CrateValidator()
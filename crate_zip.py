@@ -0,0 +1,147 @@
+# Write crates straight to a zip file, without staging a copy of the data files
+import argparse
+import hashlib
+import os
+import time
+from typing import NamedTuple
+from urllib.parse import unquote
+import zipfile
+
+from rocrate.rocrate import ROCrate
+
+from reproducible import reproducible
+
+CHUNK_SIZE = 1024 * 1024
+
+COMPRESSION_METHODS = {
+    "store": zipfile.ZIP_STORED,
+    "deflate": zipfile.ZIP_DEFLATED,
+}
+# zstd support in zipfile is new in Python 3.14
+if hasattr(zipfile, "ZIP_ZSTANDARD"):
+    COMPRESSION_METHODS["zstd"] = zipfile.ZIP_ZSTANDARD
+
+# zip timestamps cannot be earlier than 1980
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+
+
+class ZipOptions(NamedTuple):
+    path: str
+    compression: str = "deflate"
+    level: int | None = None  # None for the method's default
+
+
+def add_zip_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--zip",
+        metavar="PATH",
+        help="write the crate as a zip file instead of a folder, streaming the data files into it",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=sorted(COMPRESSION_METHODS),
+        default="deflate",
+        help="zip compression method (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="compression level, 0-9 for deflate or 1-22 for zstd (default: the method's default)",
+    )
+
+
+def zip_options_from_args(args: argparse.Namespace) -> ZipOptions | None:
+    if not args.zip:
+        return None
+    return ZipOptions(args.zip, args.compression, args.compression_level)
+
+
+def _zip_info(
+    name: str, source: str | None, compress_type: int, level: int | None
+) -> zipfile.ZipInfo:
+    if reproducible.enabled:
+        info = zipfile.ZipInfo(name, date_time=ZIP_EPOCH)
+    elif source:
+        info = zipfile.ZipInfo.from_file(source, name)
+    else:
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = compress_type
+    # ZipFile only applies its compresslevel to the ZipInfos it makes itself
+    # (_compresslevel is an alias of compress_level from Python 3.13)
+    info._compresslevel = level
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _local_files(entity) -> list[tuple[str, str]]:
+    """(source path, path in the crate) of each local file a data entity stands for."""
+    source = getattr(entity, "source", None)
+    if not source or not os.path.exists(source):
+        return []  # remote or metadata-only entity, nothing to package
+    dest = unquote(entity.id).rstrip("/")
+    if os.path.isfile(source):
+        return [(str(source), dest)]
+    files = []
+    for dirpath, _, filenames in os.walk(source):
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            files.append((path, f"{dest}/{os.path.relpath(path, source)}"))
+    return files
+
+
+def write_crate_zip(crate: ROCrate, options: ZipOptions) -> str:
+    """Write a crate as a zip file in a single pass.
+
+    Local data files are streamed from their source paths straight into the zip,
+    and their SHA-256 and size are computed from the same stream and recorded on
+    their entities. The metadata file is written last, so it describes exactly
+    the bytes in the zip. The zip is written to a temporary file and renamed
+    into place once complete.
+
+    :param crate: crate to write
+    :param options: path, compression method and level of the zip
+    :raises ValueError: the compression method is not available
+    :return: path of the zip file
+    """
+    if options.compression not in COMPRESSION_METHODS:
+        raise ValueError(
+            f"Compression {options.compression!r} is not available, "
+            f"choose one of {', '.join(sorted(COMPRESSION_METHODS))}."
+        )
+    compress_type = COMPRESSION_METHODS[options.compression]
+    tmp_path = f"{options.path}.tmp"
+    with zipfile.ZipFile(
+        tmp_path, "w", compression=compress_type, compresslevel=options.level
+    ) as zf:
+        for entity in crate.data_entities:
+            files = _local_files(entity)
+            for source, name in files:
+                sha256 = hashlib.sha256()
+                size = 0
+                with open(source, "rb") as src, zf.open(
+                    _zip_info(name, source, compress_type, options.level),
+                    "w",
+                    force_zip64=True,
+                ) as dest:
+                    while chunk := src.read(CHUNK_SIZE):
+                        sha256.update(chunk)
+                        size += len(chunk)
+                        dest.write(chunk)
+                if len(files) == 1 and name == unquote(entity.id):
+                    entity["sha256"] = sha256.hexdigest()
+                    entity["contentSize"] = size
+
+        # metadata (and preview, if any) last, now that the data entities are complete
+        for entity in crate.default_entities:
+            chunks = {}
+            for name, chunk in entity.stream():
+                chunks.setdefault(name, []).append(chunk)
+            for name, parts in chunks.items():
+                # the root dataset streams itself as an empty folder
+                if not name.endswith("/"):
+                    zf.writestr(
+                        _zip_info(name, None, compress_type, options.level),
+                        b"".join(parts),
+                    )
+    os.replace(tmp_path, options.path)
+    return options.path
@@ -0,0 +1,216 @@
+# Structural diff of two versions of a crate, keyed by entity @id
+import argparse
+import json
+import re
+import sys
+from typing import NamedTuple
+
+from merge_crates import read_metadata
+
+# properties which change on every build without --reproducible, without the crate changing
+VOLATILE_PROPERTIES = {"sdDatePublished", "datePublished"}
+
+UUID_PATTERN = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE
+)
+
+
+class CrateDiff(NamedTuple):
+    added: list[str]
+    removed: list[str]
+    modified: dict[str, list[str]]  # changed properties of each modified entity
+    patch: list[dict]  # JSON patch from the old to the new graph, see ``diff_graphs``
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.patch)
+
+    def describe(self) -> str:
+        lines = [
+            f"{len(self.added)} entities added, {len(self.removed)} removed, {len(self.modified)} modified"
+        ]
+        lines += [f"  + {entity_id}" for entity_id in self.added]
+        lines += [f"  - {entity_id}" for entity_id in self.removed]
+        lines += [
+            f"  ~ {entity_id}: {', '.join(properties)}"
+            for entity_id, properties in self.modified.items()
+        ]
+        return "\n".join(lines)
+
+
+def _pointer(*parts: str) -> str:
+    """JSON pointer to an entity or property of a graph keyed by @id."""
+    return "".join("/" + p.replace("~", "~0").replace("/", "~1") for p in parts)
+
+
+def _same_value(old, new) -> bool:
+    if old == new:
+        return True
+    # JSON-LD lists are unordered unless they are @list, so reordering is no change
+    if isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        return sorted(json.dumps(v, sort_keys=True) for v in old) == sorted(
+            json.dumps(v, sort_keys=True) for v in new
+        )
+    return False
+
+
+def _uuid_free_ids(graph: list[dict]) -> dict[str, str]:
+    """New ids for local ids with random uuids, numbering them in graph order.
+
+    Builds which are not reproducible mint random uuids for protocols, processes
+    etc., so e.g. "#sequencing-process-<uuid>" becomes "#sequencing-process-<1>".
+    """
+    renamed = {}
+    counts = {}
+    for entity in graph:
+        entity_id = entity["@id"]
+        if UUID_PATTERN.search(entity_id):
+            stem = UUID_PATTERN.sub("", entity_id)
+            counts[stem] = counts.get(stem, 0) + 1
+            renamed[entity_id] = UUID_PATTERN.sub(f"<{counts[stem]}>", entity_id)
+    return renamed
+
+
+def _rename(value, renamed: dict[str, str]):
+    if isinstance(value, list):
+        return [_rename(v, renamed) for v in value]
+    if isinstance(value, dict):
+        return {
+            k: (
+                renamed.get(v, v)
+                if k == "@id" and isinstance(v, str)
+                else _rename(v, renamed)
+            )
+            for k, v in value.items()
+        }
+    return value
+
+
+def _index(graph: list[dict], ignore: set[str], ignore_uuids: bool) -> dict[str, dict]:
+    renamed = _uuid_free_ids(graph) if ignore_uuids else {}
+    index = {}
+    for entity in graph:
+        if renamed:
+            entity = _rename(entity, renamed)
+        index[entity["@id"]] = (
+            {k: v for k, v in entity.items() if k not in ignore}
+            if ignore & entity.keys()
+            else entity
+        )
+    return index
+
+
+def diff_graphs(
+    old: list[dict],
+    new: list[dict],
+    ignore: set[str] = VOLATILE_PROPERTIES,
+    ignore_uuids: bool = False,
+) -> CrateDiff:
+    """Compare two crate graphs entity by entity.
+
+    Entities are matched by @id, so the order of the graph and the formatting of
+    the file make no difference, and neither does the order of list values. The
+    patch is a JSON patch (RFC 6902) against the graph as an object keyed by @id:
+    "add" and "remove" whole entities or properties, "replace" property values.
+
+    :param old: @graph of the old crate
+    :param new: @graph of the new crate
+    :param ignore: properties to leave out of the comparison
+    :param ignore_uuids: match local ids which differ only in a random uuid
+    :return: the differences
+    """
+    old_index = _index(old, set(ignore), ignore_uuids)
+    new_index = _index(new, set(ignore), ignore_uuids)
+    added, removed, modified, patch = [], [], {}, []
+    for entity_id, entity in old_index.items():
+        if entity_id not in new_index:
+            removed.append(entity_id)
+            patch.append({"op": "remove", "path": _pointer(entity_id)})
+    for entity_id, entity in new_index.items():
+        previous = old_index.get(entity_id)
+        if previous is None:
+            added.append(entity_id)
+            patch.append({"op": "add", "path": _pointer(entity_id), "value": entity})
+            continue
+        if previous == entity:
+            continue
+        changed = []
+        for key in sorted(previous.keys() | entity.keys()):
+            path = _pointer(entity_id, key)
+            if key not in entity:
+                patch.append({"op": "remove", "path": path})
+            elif key not in previous:
+                patch.append({"op": "add", "path": path, "value": entity[key]})
+            elif not _same_value(previous[key], entity[key]):
+                patch.append({"op": "replace", "path": path, "value": entity[key]})
+            else:
+                continue
+            changed.append(key)
+        if changed:
+            modified[entity_id] = changed
+    return CrateDiff(added, removed, modified, patch)
+
+
+def diff_crates(
+    old: str,
+    new: str,
+    ignore: set[str] = VOLATILE_PROPERTIES,
+    ignore_uuids: bool = False,
+) -> CrateDiff:
+    """Compare two crate folders, zips or metadata files, see ``diff_graphs``."""
+    return diff_graphs(
+        read_metadata(old)["@graph"],
+        read_metadata(new)["@graph"],
+        ignore=ignore,
+        ignore_uuids=ignore_uuids,
+    )
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Show what changed between two versions of a crate"
+    )
+    parser.add_argument("old", help="old crate folder, zip or metadata file")
+    parser.add_argument("new", help="new crate folder, zip or metadata file")
+    parser.add_argument(
+        "--ignore",
+        action="append",
+        default=[],
+        metavar="PROPERTY",
+        help="property to leave out of the comparison as well as the defaults, may be repeated",
+    )
+    parser.add_argument(
+        "--no-default-ignores",
+        action="store_true",
+        help=f"also compare {', '.join(sorted(VOLATILE_PROPERTIES))}, which are ignored by default",
+    )
+    parser.add_argument(
+        "--ignore-uuids",
+        action="store_true",
+        help="match local ids which differ only in a random uuid (builds without --reproducible)",
+    )
+    parser.add_argument(
+        "--patch", metavar="FILE", help="write the JSON patch to FILE ('-' for stdout)"
+    )
+    args = parser.parse_args(argv)
+
+    ignore = set(args.ignore)
+    if not args.no_default_ignores:
+        ignore |= VOLATILE_PROPERTIES
+    diff = diff_crates(
+        args.old, args.new, ignore=ignore, ignore_uuids=args.ignore_uuids
+    )
+    if args.patch == "-":
+        json.dump(diff.patch, sys.stdout, separators=(",", ":"))
+        print()
+    else:
+        print(diff.describe())
+        if args.patch:
+            with open(args.patch, "w", encoding="utf-8") as f:
+                json.dump(diff.patch, f, separators=(",", ":"))
+    # like diff(1): 1 if the crates differ
+    raise SystemExit(1 if diff.changed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+# FASTA helpers for BGE RO-Crate creation
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+
+class FaiRecord(NamedTuple):
+    """One line of a samtools-compatible .fai index."""
+
+    name: str
+    length: int  # number of bases
+    offset: int  # byte offset of the first base
+    line_bases: int  # bases per line
+    line_width: int  # bytes per line, including the line ending
+
+    @property
+    def end(self) -> int:
+        """Byte offset just past the last base (excluding the final line ending)."""
+        if self.length == 0:
+            return self.offset
+        full_lines, remainder = divmod(self.length, self.line_bases)
+        if remainder:
+            return self.offset + full_lines * self.line_width + remainder
+        return (
+            self.offset
+            + full_lines * self.line_width
+            - (self.line_width - self.line_bases)
+        )
+
+
+def build_fai(fasta_path: str) -> list[FaiRecord]:
+    """Index a FASTA file in a single pass, as ``samtools faidx`` does.
+
+    :param fasta_path: FASTA file to index
+    :raises ValueError: a sequence has lines of different lengths (other than its last line)
+    :return: one record per sequence, in file order
+    """
+    records = []
+    name = None
+    position = 0
+
+    def finish():
+        if name is not None:
+            records.append(FaiRecord(name, length, offset, line_bases, line_width))
+
+    with open(fasta_path, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                finish()
+                name = line[1:].split(None, 1)[0].decode()
+                length = line_bases = line_width = 0
+                offset = position + len(line)
+                short_line_seen = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                # a final line without a line ending is indexed as if it had one
+                width = len(line) if line.endswith(b"\n") else bases + 1
+                if bases:
+                    if short_line_seen:
+                        raise ValueError(
+                            f"Different line length in sequence {name} of {fasta_path}."
+                        )
+                    if not line_bases:
+                        line_bases, line_width = bases, width
+                    elif bases != line_bases or width != line_width:
+                        if bases > line_bases:
+                            raise ValueError(
+                                f"Different line length in sequence {name} of {fasta_path}."
+                            )
+                        short_line_seen = True
+                    length += bases
+            position += len(line)
+        finish()
+    return records
+
+
+def write_fai(records: list[FaiRecord], fai_path: str) -> None:
+    tmp_path = f"{fai_path}.tmp"
+    with open(tmp_path, "w") as f:
+        for r in records:
+            f.write(
+                f"{r.name}\t{r.length}\t{r.offset}\t{r.line_bases}\t{r.line_width}\n"
+            )
+    os.replace(tmp_path, fai_path)
+
+
+def read_fai(fai_path: str) -> list[FaiRecord]:
+    with open(fai_path) as f:
+        return [
+            FaiRecord(name, *map(int, values))
+            for name, *values in (line.rstrip("\n").split("\t")[:5] for line in f)
+        ]
+
+
+def load_fai(fasta_path: str) -> list[FaiRecord]:
+    """Return the .fai index of a FASTA file, building it only if the FASTA changed since it was last indexed.
+
+    The index is cached next to the FASTA as ``<fasta_path>.fai``, so it can also be
+    used by samtools and other tools.
+
+    :param fasta_path: FASTA file
+    :return: one record per sequence, in file order
+    """
+    fai_path = f"{fasta_path}.fai"
+    if (
+        os.path.exists(fai_path)
+        and os.stat(fai_path).st_mtime >= os.stat(fasta_path).st_mtime
+    ):
+        return read_fai(fai_path)
+    records = build_fai(fasta_path)
+    write_fai(records, fai_path)
+    return records
+
+
+def _digest_ranges(fasta_path: str, ranges: list[tuple[int, int]]) -> list[str]:
+    digests = []
+    with open(fasta_path, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            residues = f.read(end - start).translate(None, b"\r\n").upper()
+            digests.append(hashlib.sha256(residues).hexdigest())
+    return digests
+
+
+# below this many bytes of sequence, hashing in one process beats starting a pool
+PARALLEL_DIGEST_MIN_BYTES = 64 * 1024 * 1024
+DIGEST_BATCH_BYTES = 16 * 1024 * 1024
+
+
+def sequence_digests(
+    fasta_path: str, records: list[FaiRecord], workers: int | None = None
+) -> list[str]:
+    """SHA-256 of each sequence's residues, ignoring line breaks and case.
+
+    Identical sequences get identical digests wherever they are in the file and
+    however they are wrapped. Large files are hashed in batches across processes.
+
+    :param fasta_path: FASTA file
+    :param records: its .fai index, see ``load_fai``
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: hex digests in the same order as ``records``
+    """
+    ranges = [(r.offset, r.end) for r in records]
+    total_bytes = sum(end - start for start, end in ranges)
+    if total_bytes < PARALLEL_DIGEST_MIN_BYTES or workers == 1:
+        return _digest_ranges(fasta_path, ranges)
+
+    batches = [[]]
+    batch_bytes = 0
+    for start, end in ranges:
+        if batch_bytes >= DIGEST_BATCH_BYTES:
+            batches.append([])
+            batch_bytes = 0
+        batches[-1].append((start, end))
+        batch_bytes += end - start
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_digest_ranges, [fasta_path] * len(batches), batches)
+        return [digest for batch in results for digest in batch]
+
+
+def read_sequence(fasta_path: str, record: FaiRecord) -> str:
+    """Read one sequence by seeking straight to its byte range."""
+    with open(fasta_path, "rb") as f:
+        f.seek(record.offset)
+        data = f.read(record.end - record.offset)
+    return data.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+
+##############
+# base stats #
+##############
+
+GAP_BYTES = b"-.~"
+NUCLEOTIDE_BYTES = b"ACGTUacgtu"
+AMBIGUITY_BYTES = b"RYSWKMBDHVNryswkmbdhvn"
+
+# byte -> class flags, so classifying a whole buffer is a single table lookup
+_NOT_RESIDUE = 1  # anything but a nucleotide, an ambiguity code or a line ending
+_AMBIGUOUS = 2
+_CLASS_TABLE = bytearray([_NOT_RESIDUE]) * 256
+for _byte in NUCLEOTIDE_BYTES + b"\r\n":
+    _CLASS_TABLE[_byte] = 0
+for _byte in AMBIGUITY_BYTES:
+    _CLASS_TABLE[_byte] = _AMBIGUOUS
+_CLASS_TABLE = bytes(_CLASS_TABLE)
+
+# bytes of the FASTA classified at a time, bounding the memory used
+STATS_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+class BaseCounts(NamedTuple):
+    """Per-sequence counts, aligned with the .fai records they were computed from."""
+
+    residues: np.ndarray  # nucleotides and ambiguity codes, i.e. everything but gaps
+    ambiguous: np.ndarray  # IUPAC ambiguity codes (including N)
+
+
+def _count_in_sequences(
+    positions: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    # assign each flagged byte to the sequence it falls in, dropping bytes in the headers between sequences
+    sequence = np.searchsorted(starts, positions, side="right") - 1
+    inside = (sequence >= 0) & (positions < ends[np.maximum(sequence, 0)])
+    return np.bincount(sequence[inside], minlength=len(starts))
+
+
+def base_counts(fasta_path: str, records: list[FaiRecord]) -> BaseCounts:
+    """Count residues and ambiguity codes of every sequence in a FASTA file.
+
+    The file is memory-mapped and classified with a byte lookup table in chunks of
+    consecutive sequences, so there is no per-character Python loop and memory use
+    does not grow with file size. Residues are the sequence length from the index
+    minus the gaps and other non-residue bytes, which are rare, so only the flagged
+    bytes are ever located individually.
+
+    :param fasta_path: FASTA file
+    :param records: its .fai index, see ``load_fai``
+    :return: counts in the same order as ``records``
+    """
+    lengths = np.fromiter(
+        (r.length for r in records), dtype=np.int64, count=len(records)
+    )
+    residues = lengths.copy()
+    ambiguous = np.zeros(len(records), dtype=np.int64)
+    if not records or not os.path.getsize(fasta_path):
+        return BaseCounts(residues, ambiguous)
+
+    data = np.memmap(fasta_path, dtype=np.uint8, mode="r")
+    starts = np.fromiter(
+        (r.offset for r in records), dtype=np.int64, count=len(records)
+    )
+    ends = np.fromiter((r.end for r in records), dtype=np.int64, count=len(records))
+
+    first = 0
+    while first < len(records):
+        # take as many whole sequences as fit in a chunk (always at least one)
+        last = int(
+            np.searchsorted(ends, starts[first] + STATS_CHUNK_BYTES, side="right")
+        )
+        last = max(last, first + 1)
+        chunk_start = starts[first]
+        block = data[chunk_start : ends[last - 1]]
+        classes = np.frombuffer(block.tobytes().translate(_CLASS_TABLE), dtype=np.uint8)
+        chunk_starts = starts[first:last] - chunk_start
+        chunk_ends = ends[first:last] - chunk_start
+
+        residues[first:last] -= _count_in_sequences(
+            np.flatnonzero(classes == _NOT_RESIDUE), chunk_starts, chunk_ends
+        )
+        ambiguous[first:last] = _count_in_sequences(
+            np.flatnonzero(classes == _AMBIGUOUS), chunk_starts, chunk_ends
+        )
+        first = last
+
+    return BaseCounts(residues, ambiguous)
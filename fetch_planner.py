@@ -0,0 +1,157 @@
+# Dependency-aware prefetching of upstream metadata for crate builds
+from concurrent.futures import ThreadPoolExecutor
+import math
+from typing import NamedTuple
+
+from metrics import metrics
+from ratelimit import rate_limiter
+from utils import fetch_ena_assembly_record, fetch_single_ena_record_by_accession
+
+ENA_HOST = "www.ebi.ac.uk"
+
+# rough figures for the dry-run estimate
+ESTIMATED_SECONDS_PER_CALL = 0.5
+ESTIMATED_RUNS_PER_ASSEMBLY = 2
+
+DEFAULT_WORKERS = 8
+
+
+class Lookup(NamedTuple):
+    """A single upstream record lookup, as done by ``fetch_single_ena_record_by_accession``.
+
+    The result type "assembly" is looked up with ``fetch_ena_assembly_record``, which
+    tries the assembly accession and then the assembly set accession.
+    """
+
+    result_type: str
+    accession: str
+    accession_field: str = "accession"
+
+    def fetch(self) -> dict:
+        if self.result_type == "assembly":
+            return fetch_ena_assembly_record(self.accession)
+        return fetch_single_ena_record_by_accession(
+            self.accession, self.result_type, self.accession_field
+        )
+
+    def __str__(self) -> str:
+        if self.accession_field == "accession":
+            return f"{self.result_type} {self.accession}"
+        return f"{self.result_type} {self.accession} (by {self.accession_field})"
+
+
+def follow_ups(lookup: Lookup, record: dict) -> list[Lookup]:
+    """Lookups which can only be planned once ``record`` has been fetched.
+
+    An assembly lists the runs it was built from (each resolved to its read
+    experiment) and the WGS set holding its sequence files.
+    """
+    if lookup.result_type != "assembly":
+        return []
+    lookups = [
+        Lookup("read_experiment", run, "run_accession")
+        for run in record["run_accession"].split(";")
+        if run
+    ]
+    if record.get("wgs_set"):
+        lookups.append(Lookup("wgs_set", record["wgs_set"], "wgs_set"))
+    return lookups
+
+
+def plan_genome_fetches(
+    sample_accessions: list[str],
+    sequencing_accessions: list[str],
+    analysis_accessions: list[str],
+) -> list[Lookup]:
+    """Lookups for the genome builder which depend only on the top-level accession lists."""
+    return [
+        *(Lookup("sample", a) for a in sample_accessions),
+        *(
+            Lookup("read_experiment", a, "experiment_accession")
+            for a in sequencing_accessions
+        ),
+        *(Lookup("assembly", a) for a in analysis_accessions),
+    ]
+
+
+def _fetch(lookup: Lookup) -> tuple[dict | None, Exception | None]:
+    try:
+        return lookup.fetch(), None
+    except (
+        Exception
+    ) as e:  # reported, then raised again by the stage which needs the record
+        return None, e
+
+
+def prefetch(lookups: list[Lookup], workers: int = DEFAULT_WORKERS) -> int:
+    """Fetch records in concurrent waves, one wave per level of the dependency graph.
+
+    Each wave fetches everything currently known in parallel (paced by the rate
+    limiter, in the caller's lane), then plans the follow-up lookups its responses reveal as the next wave.
+    Records land in the fetcher cache, so the build stages afterwards find them
+    without further network calls. Failed lookups are reported and skipped; the
+    stage that needs the record raises the error when it fetches it again.
+
+    :param lookups: initial lookups, see ``plan_genome_fetches``
+    :param workers: number of concurrent requests
+    :return: number of waves (the depth of the dependency graph)
+    """
+    wave = list(dict.fromkeys(lookups))
+    seen = set(wave)
+    depth = 0
+    fetch = rate_limiter.in_current_lane(_fetch)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while wave:
+            with metrics.span(f"prefetch_wave_{depth}"):
+                results = list(executor.map(fetch, wave))
+            next_wave = []
+            for lookup, (record, error) in zip(wave, results):
+                if error:
+                    print(f"Warning: prefetching {lookup} failed: {error}")
+                    continue
+                for follow_up in follow_ups(lookup, record):
+                    if follow_up not in seen:
+                        seen.add(follow_up)
+                        next_wave.append(follow_up)
+            print(f"Prefetch wave {depth}: {len(wave)} lookups")
+            wave = next_wave
+            depth += 1
+    return depth
+
+
+def describe_plan(lookups: list[Lookup], workers: int = DEFAULT_WORKERS) -> str:
+    """Describe the call graph ``prefetch`` would execute, with an estimated cost, without any network calls."""
+    wave = list(dict.fromkeys(lookups))
+    assemblies = [lookup for lookup in wave if lookup.result_type == "assembly"]
+    # each assembly leads to its runs' read experiments and its WGS set
+    follow_up_calls = len(assemblies) * (ESTIMATED_RUNS_PER_ASSEMBLY + 1)
+
+    lines = [f"Wave 0 ({len(wave)} calls):"]
+    lines += [f"  {lookup}" for lookup in wave]
+    if assemblies:
+        lines.append(
+            f"Wave 1 (discovered from wave 0 responses, ~{follow_up_calls} calls):"
+        )
+        for assembly in assemblies:
+            lines.append(
+                f"  read_experiment (by run_accession) for each run of {assembly.accession}"
+            )
+            lines.append(f"  wgs_set of {assembly.accession}")
+
+    rate, _ = rate_limiter.limit(ENA_HOST)
+    calls_per_wave = [len(wave)] + ([follow_up_calls] if assemblies else [])
+    # a wave takes as long as its slowest batch of concurrent calls, or as long as the rate limit allows
+    concurrent_seconds = sum(
+        max(
+            math.ceil(calls / workers) * ESTIMATED_SECONDS_PER_CALL,
+            calls / rate,
+        )
+        for calls in calls_per_wave
+    )
+    sequential_seconds = sum(calls_per_wave) * ESTIMATED_SECONDS_PER_CALL
+    lines.append(
+        f"Estimated: ~{sum(calls_per_wave)} calls in {len(calls_per_wave)} waves, "
+        f"~{concurrent_seconds:.1f} s with {workers} workers "
+        f"(~{sequential_seconds:.1f} s fetched one at a time)"
+    )
+    return "\n".join(lines)
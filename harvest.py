@@ -0,0 +1,229 @@
+# Bulk harvesting of upstream records, streamed page by page
+import argparse
+from typing import Iterator
+
+from records import BoldDocument, ena_record
+from utils import (
+    cached_record,
+    fetch_ena_assembly_record,
+    fetch_single_bold_record_by_id,
+    fetch_single_ena_record_by_accession,
+    http_get,
+)
+
+ENA_API = "https://www.ebi.ac.uk/ena/portal/api"
+BOLD_API = "https://portal.boldsystems.org/api"
+
+# records per request; each page is streamed, so this only bounds the size of a single response
+HARVEST_PAGE_SIZE = 1000
+
+
+###############
+# ENA studies #
+###############
+
+STUDY_RESULT_TYPES = ["sample", "read_experiment", "assembly"]
+
+
+def add_study_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--study",
+        metavar="ACCESSION",
+        help="harvest every sample, read experiment and assembly of an ENA study, e.g. PRJEB75414, "
+        "instead of using the example accessions",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=HARVEST_PAGE_SIZE,
+        help="records per ENA search request when harvesting a study (default: %(default)s)",
+    )
+
+
+def describe_harvest(study_accession: str, page_size: int = HARVEST_PAGE_SIZE) -> str:
+    """Summary of the requests a study harvest will make, for dry runs."""
+    return "\n".join(
+        [
+            f"Harvest of study {study_accession}, {page_size} records per request:",
+            *(
+                f"  {result_type}: paged search for study_accession={study_accession}"
+                for result_type in STUDY_RESULT_TYPES
+            ),
+            "Every harvested record is cached, so the stages make no further record lookups,",
+            "except for the WGS set of each assembly.",
+        ]
+    )
+
+
+def iter_ena_search(
+    result_type: str, query: str, page_size: int = HARVEST_PAGE_SIZE
+) -> Iterator[dict]:
+    """Stream every record matching an ENA portal search, one page at a time.
+
+    Pages are requested as TSV and parsed line by line as they arrive, so neither
+    the full result set nor a full page is ever held in memory.
+
+    :param result_type: the ENA data set to search, e.g. "read_experiment"
+    :param query: ENA portal query, e.g. 'study_accession="PRJEB75414"'
+    :param page_size: records per request
+    :return: records, with the same fields as ``fetch_single_ena_record_by_accession`` returns
+    """
+    offset = 0
+    while True:
+        params = {
+            "result": result_type,
+            "query": query,
+            "fields": "all",
+            "format": "tsv",
+            "limit": page_size,
+            "offset": offset,
+        }
+        with http_get(f"{ENA_API}/search", params=params, stream=True) as r:
+            r.raise_for_status()
+            lines = r.iter_lines(decode_unicode=True)
+            header = next(lines, None)
+            if not header:
+                return
+            columns = header.split("\t")
+            count = 0
+            for line in lines:
+                if line:
+                    count += 1
+                    yield dict(zip(columns, line.split("\t")))
+        if count < page_size:
+            return
+        offset += page_size
+
+
+def harvest_study(
+    study_accession: str, result_type: str, page_size: int = HARVEST_PAGE_SIZE
+) -> Iterator[str]:
+    """Accessions of all samples, read experiments or assemblies of an ENA study, in ENA's order.
+
+    Each harvested record is put in the fetcher cache as it streams past, so the
+    stage builders find it there instead of requesting it again one by one.
+    Experiments are also cached by run accession, which is how assemblies refer to them.
+    An experiment with more than one run is an error, as it is when fetched by accession.
+
+    :param study_accession: project or study accession, e.g. "PRJEB75414"
+    :param result_type: "sample", "read_experiment" or "assembly"
+    :param page_size: records per request
+    :raises ValueError: unsupported result type, or an experiment with more than one run
+    :return: distinct accessions, as the stage builders take them
+    """
+    query = f'study_accession="{study_accession}"'
+    seen = {}  # accession -> run accession, for experiments
+    for record in iter_ena_search(result_type, query, page_size):
+        record = ena_record(result_type, record)
+        if result_type == "sample":
+            accession = record["sample_accession"]
+            fetch_single_ena_record_by_accession.prime(record, accession, "sample")
+        elif result_type == "read_experiment":
+            accession = record["experiment_accession"]
+            # ENA lists an experiment once per run, but the stages describe an
+            # experiment from a single record, so as fetch_single_ena_record_by_accession
+            # does, refuse experiments with several runs rather than drop runs
+            if accession in seen:
+                raise ValueError(
+                    f"Unexpectedly retrieved multiple ENA records for accession {accession}: "
+                    f"runs {[seen[accession], record['run_accession']]}"
+                )
+            fetch_single_ena_record_by_accession.prime(
+                record, accession, "read_experiment", "experiment_accession"
+            )
+            if record.get("run_accession"):
+                fetch_single_ena_record_by_accession.prime(
+                    record, record["run_accession"], "read_experiment", "run_accession"
+                )
+        elif result_type == "assembly":
+            accession = record["assembly_accession"] or record["assembly_set_accession"]
+            fetch_ena_assembly_record.prime(record, accession)
+        else:
+            raise ValueError(f"Cannot harvest {result_type} records of a study.")
+        if accession not in seen:
+            seen[accession] = record.get("run_accession")
+            yield accession
+
+
+#################
+# BOLD projects #
+#################
+
+
+def _bold_query_id(query: str) -> str:
+    """Register a BOLD query, resolving wildcards first, and return its id for fetching documents."""
+    r = http_get(f"{BOLD_API}/query/preprocessor", params={"query": query})
+    r.raise_for_status()
+    try:
+        query = r.json()["successful_terms"][0]["matched"]
+    except (KeyError, IndexError):
+        raise ValueError(f"BOLD query preprocessing failed for {query}.")
+    r = http_get(f"{BOLD_API}/query", params={"query": query})
+    r.raise_for_status()
+    return r.json()["query_id"]
+
+
+def iter_bold_records(query: str, page_size: int = HARVEST_PAGE_SIZE) -> Iterator[dict]:
+    """Stream every BOLD record matching a query, one page of documents at a time.
+
+    :param query: BOLD query terms, e.g. "ids:processid:MHMXN361-07"
+    :param page_size: records per request
+    :return: records, as ``fetch_single_bold_record_by_id`` returns them
+    """
+    query_id = _bold_query_id(query)
+    start = 0
+    while True:
+        r = http_get(
+            f"{BOLD_API}/documents/{query_id}",
+            params={"start": start, "length": page_size},
+        )
+        r.raise_for_status()
+        page = r.json()["data"]
+        yield from page
+        if len(page) < page_size:
+            return
+        start += page_size
+
+
+def harvest_bold_project(
+    project_code: str,
+    query_field: str | None = None,
+    page_size: int = HARVEST_PAGE_SIZE,
+) -> Iterator[str]:
+    """Process ids of all records of a BOLD project or container, e.g. "BHNHM".
+
+    Each record is put in the fetcher cache under both its process id and its
+    sample id, which are the ids the barcode stages look records up by, so no
+    BOLD document is retrieved more than once.
+
+    :param project_code: project or container code
+    :param query_field: BOLD query prefix for the code. By default the BOLD API works it out, as for single records.
+    :param page_size: records per request
+    :raises ValueError: the BOLD API could not make a query of the code
+    :return: process ids, in BOLD's order
+    """
+    if query_field:
+        query = f"{query_field}:{project_code}"
+    else:
+        r = http_get(f"{BOLD_API}/query/parse", params={"query": project_code})
+        r.raise_for_status()
+        query = r.json()["terms"]
+    for record in map(BoldDocument, iter_bold_records(query, page_size)):
+        fetch_single_bold_record_by_id.prime(record, record["processid"])
+        if record.get("sampleid"):
+            fetch_single_bold_record_by_id.prime(record, record["sampleid"])
+        yield record["processid"]
+
+
+@cached_record
+def fetch_bold_project_process_ids(
+    project_code: str, query_field: str | None = None
+) -> list[str]:
+    """Harvest a BOLD project, see ``harvest_bold_project``.
+
+    The list is cached and checkpointed like a single record, so resumed builds
+    and builds from a snapshot bundle skip the harvest.
+
+    :return: process ids of all records of the project
+    """
+    return list(harvest_bold_project(project_code, query_field))
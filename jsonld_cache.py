@@ -0,0 +1,255 @@
+# Bundled copies of the JSON-LD contexts and vocabularies the BGE crates refer to
+import argparse
+from datetime import datetime, timezone
+import hashlib
+import io
+import json
+import os
+import re
+
+import requests
+from rocrate_validator.utils.http import HttpRequester
+from urllib3 import HTTPResponse
+
+DEFAULT_CONTEXT_DIR = os.environ.get(
+    "BGE_CONTEXT_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "jsonld-contexts"),
+)
+
+MANIFEST_FILE = "manifest.json"
+
+# documents the crates refer to (the context of the pinned rocrate, and of older crates),
+# and the ones the RO-Crate 1.1 profile of the validator reads
+BUNDLED_URLS = [
+    "https://w3id.org/ro/crate/1.1/context",
+    "https://w3id.org/ro/crate/1.3/context",
+    "https://w3id.org/ro/crate/1.1",
+    "https://bioschemas.org/profiles/Sample/0.2-RELEASE-2018_11_10",
+    "https://www.researchobject.org/ro-crate/specification/1.1/index.html",
+]
+
+ACCEPT = "application/ld+json, application/json;q=0.9, */*;q=0.1"
+
+
+def _file_name(url: str) -> str:
+    """Readable file name for a URL, e.g. "w3id.org_ro_crate_1.1_context"."""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", url.split("://", 1)[-1]).strip("_")
+
+
+class ContextCache:
+    """A folder of JSON-LD contexts and vocabularies, listed in a manifest.
+
+    The manifest records, for each URL, the file holding the document, its media
+    type, SHA-256 and when it was retrieved. Its ``version`` goes up whenever a
+    fetch changes a document, so the folder can be committed and pinned like code.
+    """
+
+    def __init__(self, folder: str = DEFAULT_CONTEXT_DIR):
+        self.folder = folder
+        self.manifest_path = os.path.join(folder, MANIFEST_FILE)
+        self.manifest = {"version": 0, "documents": {}}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        # document bodies, read on first use
+        self._content = {}
+        self._changed = False
+
+    @property
+    def documents(self) -> dict:
+        return self.manifest["documents"]
+
+    def __contains__(self, url: str) -> bool:
+        return url in self.documents
+
+    def content(self, url: str) -> bytes | None:
+        """The bundled document for a URL, or None if it is not bundled."""
+        if url not in self.documents:
+            return None
+        if url not in self._content:
+            with open(
+                os.path.join(self.folder, self.documents[url]["file"]), "rb"
+            ) as f:
+                self._content[url] = f.read()
+        return self._content[url]
+
+    def response(self, url: str) -> requests.Response | None:
+        """The bundled document for a URL as an HTTP response, or None if it is not bundled."""
+        content = self.content(url)
+        if content is None:
+            return None
+        r = requests.Response()
+        r.status_code = 200
+        r.reason = "OK"
+        r.url = url
+        r.headers["Content-Type"] = self.documents[url]["media_type"]
+        r.headers["Content-Length"] = str(len(content))
+        r.encoding = "utf-8"
+        r.request = requests.Request("GET", url).prepare()
+        # as received by requests, which the validator's HTTP cache stores it from
+        r.raw = HTTPResponse(
+            body=io.BytesIO(content),
+            headers=dict(r.headers),
+            status=200,
+            reason="OK",
+            preload_content=False,
+            request_url=url,
+        )
+        r._content = content
+        return r
+
+    def add(
+        self, url: str, content: bytes, media_type: str, retrieved_from: str
+    ) -> bool:
+        """Put a document in the folder under its URL, without writing the manifest, see ``save``.
+
+        :param url: URL the document is served from
+        :param content: the document
+        :param media_type: its media type, served as Content-Type
+        :param retrieved_from: where the document was obtained, e.g. the URL it was redirected to
+        :return: True if the document was added or changed
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        entry = self.documents.get(url)
+        if entry is not None and entry["sha256"] == digest:
+            return False
+        os.makedirs(self.folder, exist_ok=True)
+        file_name = _file_name(url)
+        with open(os.path.join(self.folder, file_name), "wb") as f:
+            f.write(content)
+        self.documents[url] = {
+            "file": file_name,
+            "media_type": media_type,
+            "sha256": digest,
+            "retrieved": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "retrieved_from": retrieved_from,
+        }
+        self._content.pop(url, None)
+        self._changed = True
+        return True
+
+    def save(self) -> None:
+        """Write the manifest, with a new version if any document was added or changed since the last save."""
+        if not self._changed:
+            return
+        self.manifest["version"] += 1
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+            f.write("\n")
+        self._changed = False
+
+    def fetch(self, urls: list[str], session: requests.Session | None = None) -> int:
+        """Download documents into the folder and update the manifest.
+
+        :param urls: URLs of the documents
+        :param session: session to download with, a new one by default
+        :return: number of documents which were added or changed
+        """
+        session = session or requests.Session()
+        changed = 0
+        for url in urls:
+            r = session.get(url, headers={"Accept": ACCEPT}, allow_redirects=True)
+            r.raise_for_status()
+            changed += self.add(
+                url,
+                r.content,
+                r.headers.get("Content-Type", "application/octet-stream"),
+                r.url,
+            )
+        self.save()
+        return changed
+
+    def verify(self) -> list[str]:
+        """URLs whose bundled file is missing or does not match the manifest."""
+        broken = []
+        for url, entry in self.documents.items():
+            path = os.path.join(self.folder, entry["file"])
+            if not os.path.exists(path):
+                broken.append(url)
+                continue
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).hexdigest() != entry["sha256"]:
+                    broken.append(url)
+        return broken
+
+    def install(self) -> None:
+        """Serve the bundled documents to the validator, online and offline alike.
+
+        The validator fetches contexts through its ``HttpRequester``, whose HTTP
+        cache answers offline requests only from earlier online runs. The bundled
+        documents are stored in that cache, replacing any copy fetched earlier, so
+        they need neither. Making ``ValidationSettings`` rebuilds the cache session,
+        so call this after making them.
+
+        :raises RuntimeError: the validator has no HTTP cache to store them in
+        """
+        if not self.documents:
+            return
+        cache = getattr(HttpRequester().session, "cache", None)
+        if not hasattr(cache, "save_response"):
+            raise RuntimeError(
+                "The validator's HTTP session has no requests-cache cache, so the bundled "
+                "JSON-LD contexts cannot be served to it. Check the roc-validator version "
+                "against requirements.txt."
+            )
+        for url in self.documents:
+            cache.save_response(self.response(url))
+
+
+# bundle used by http_get and the validator in this process
+context_cache = ContextCache()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Maintain the bundled JSON-LD contexts and vocabularies"
+    )
+    parser.add_argument("--dir", default=DEFAULT_CONTEXT_DIR)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="download documents into the bundle, or refresh them"
+    )
+    fetch_parser.add_argument(
+        "urls", nargs="*", help="URLs to add (default: all the profile uses)"
+    )
+    add_parser = subparsers.add_parser(
+        "add",
+        help="bundle a copy of a document obtained some other way, e.g. from a package",
+    )
+    add_parser.add_argument("url", help="URL the document is served from")
+    add_parser.add_argument("file", help="local copy of the document")
+    add_parser.add_argument("--media-type", default="application/ld+json")
+    add_parser.add_argument(
+        "--source",
+        help="where the copy comes from, recorded in the manifest (default: the file path)",
+    )
+    subparsers.add_parser("list", help="list the bundled documents")
+    subparsers.add_parser("verify", help="check the bundled files against the manifest")
+    args = parser.parse_args(argv)
+
+    cache = ContextCache(args.dir)
+    if args.command == "fetch":
+        changed = cache.fetch(args.urls or BUNDLED_URLS)
+        print(
+            f"{changed} documents added or changed, bundle version {cache.manifest['version']}"
+        )
+    elif args.command == "add":
+        with open(args.file, "rb") as f:
+            cache.add(args.url, f.read(), args.media_type, args.source or args.file)
+        cache.save()
+        print(f"{args.url} bundled, bundle version {cache.manifest['version']}")
+    elif args.command == "list":
+        for url, entry in sorted(cache.documents.items()):
+            print(
+                f"{url}\t{entry['file']}\t{entry['retrieved']}\t{entry['sha256'][:12]}"
+            )
+    else:
+        broken = cache.verify()
+        print(*broken or ["all bundled documents match the manifest"], sep="\n")
+        if broken:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
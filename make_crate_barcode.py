@@ -1,13 +1,35 @@
 # Create an RO-Crate following the in-development BGE profile
-from datetime import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
-import uuid
 import requests
 
 from rocrate.model import ContextEntity, Entity, Person
 from rocrate.rocrate import ROCrate
 from rocrate_validator import services, models
 
+from checkpoint import BuildCheckpoint, add_resume_argument
+from crate_validation import add_validation_arguments, crate_validator
+from crate_zip import (
+    ZipOptions,
+    add_zip_arguments,
+    write_crate_zip,
+    zip_options_from_args,
+)
+from fetch_planner import DEFAULT_WORKERS
+from harvest import fetch_bold_project_process_ids
+from metrics import metrics, timed_stage, write_build_reports
+from profiling import add_profile_argument, profile_build
+from ratelimit import BATCH, rate_limiter
+from reproducible import (
+    add_reproducible_argument,
+    passed_validation,
+    record_validation,
+    reproducible,
+    write_crate_if_changed,
+)
+from snapshot import add_snapshot_arguments
+from taxonomy import TaxonomyIndex, add_taxonomy_argument, open_taxonomy_index
 from utils import (
     validate_crate,
     fetch_single_bold_record_by_id,
@@ -15,6 +37,9 @@ from utils import (
     load_remote_crate,
     get_accession_permalink,
     get_copo_rocrate_uri_from_accession,
+    resumable_build,
+    load_snapshot,
+    save_snapshot,
 )
 
 #########
@@ -26,12 +51,14 @@ BIOSAMPLES_PREFIX = "biosample"  # identifiers.org prefix
 
 
 def add_species_metadata(
-    crate: ROCrate, species_names: list[str], bold_taxid: str | None = None
+    crate: ROCrate,
+    species_names: list[str],
+    bold_taxid: str | None = None,
+    taxonomy: TaxonomyIndex | None = None,
 ) -> None:
     if not bold_taxid:
         raise ValueError("BOLD taxid must be specified")
     for name in species_names:
-        # TODO: lookup species name in NCBI/BOLD to get id
         species = ContextEntity(
             crate,
             f"https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid={bold_taxid}",
@@ -45,6 +72,11 @@ def add_species_metadata(
             "taxonRank",
             f"https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid={bold_taxid}",
         )
+        # the BOLD taxid comes with the record, other sources come from the local index
+        taxa = taxonomy.resolve_all(name) if taxonomy else ()
+        if ncbi_taxon := next((t for t in taxa if t.source == "ncbi"), None):
+            species["sameAs"] = {"@id": ncbi_taxon.uri}
+            species.append_to("taxonRank", ncbi_taxon.uri)
 
     crate.add(species)
     crate.root_dataset.append_to("about", species)  # use this and/or taxonomicRange?
@@ -104,6 +136,7 @@ def add_authors_and_affiliations(crate: ROCrate) -> None:
 ################
 
 
+@timed_stage("sample")
 def add_sample_stage(crate: ROCrate, sample_accessions: list[str]) -> list[Entity]:
     # Physical sample collection
     multiple = True if len(sample_accessions) > 1 else False
@@ -172,13 +205,14 @@ def add_sample_stage(crate: ROCrate, sample_accessions: list[str]) -> list[Entit
 #################
 
 
+@timed_stage("sequencing")
 def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> Entity:
 
     # ideally this protocol would be an RO-Crate itself so we could include just minimal metadata here
     protocol_sequencing = crate.add(
         ContextEntity(
             crate,
-            f"#sequencing-protocol-{uuid.uuid4()}",
+            reproducible.local_id("sequencing-protocol"),
             properties={
                 "@type": "LabProtocol",
                 "name": f"Sequencing protocol",
@@ -239,7 +273,7 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
                     "name": f"Sequencing data for {sequencing_accession}",
                     # TODO automate description better
                     "description": f'example: PacBio sequencing of sample {sample_accession}, performed as part of process {sequencing_metadata["processid"]} for study accession XYZ.',
-                    "sdDatePublished": str(datetime.now()),
+                    "sdDatePublished": reproducible.timestamp(sequencing_metadata),
                     "contentSize": 0,
                     "encodingFormat": "TODO",
                 },
@@ -248,7 +282,9 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
 
         sequencing_process = crate.add_action(
             instrument=protocol_sequencing,
-            identifier=f"#sequencing-process-{uuid.uuid4()}",
+            identifier=reproducible.local_id(
+                "sequencing-process", sequencing_accession
+            ),
             object=sample_entity,
             result=sequenced_data,
             properties={
@@ -275,14 +311,17 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
 ##################
 
 
+@timed_stage("analysis")
 def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
 
     workflow_assembly = crate.add_workflow(
-        dest_path=f"#assembly-workflow-{uuid.uuid4()}",
+        dest_path=reproducible.local_id("assembly-workflow", *analysis_accessions),
         properties={
             "name": f"Assembly workflow (placeholder)",
             "description": "A placeholder for a workflow that could exist on WorkflowHub (etc) or be directly contained within the crate",
-            "sdDatePublished": str(datetime.now()),
+            "sdDatePublished": reproducible.timestamp(
+                *(fetch_single_bold_record_by_id(a) for a in analysis_accessions)
+            ),
         },
     )
 
@@ -320,7 +359,7 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
                 properties={
                     "@type": "BioChemEntity",
                     "name": f"Barcode data from process {analysis_accession}",
-                    "sdDatePublished": str(datetime.now()),
+                    "sdDatePublished": reproducible.timestamp(genome_assembly_metadata),
                     "hasRepresentation": genome_assembly_metadata["nuc"],
                 },
             )
@@ -342,7 +381,7 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
                 properties={
                     "name": f"Barcode assembly {record_id}",
                     "description": f"Barcode assembly stage for {record_id}. Contains the workflow used, the workflow execution details, and the output data.",
-                    "sdDatePublished": str(datetime.now()),
+                    "sdDatePublished": reproducible.timestamp(genome_assembly_metadata),
                     "@type": "Dataset",
                 },
             )
@@ -372,35 +411,42 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
     return analysis_collection["hasPart"] if multiple else [genome_assembly]
 
 
-def main():
+DEFAULT_PROCESS_ID = "MHMXN361-07"
 
-    target_bold_process_id = "MHMXN361-07"
 
-    # TODO - multiple?
-    bold_metadata = fetch_single_bold_record_by_id(target_bold_process_id)
-    print(bold_metadata)
-    species_names = [bold_metadata["species"]]
+def create_crate(
+    process_ids: list[str],
+    taxonomy: TaxonomyIndex | None = None,
+    state: BuildCheckpoint | None = None,
+    project_code: str | None = None,
+) -> ROCrate:
+    """Create the crate for one or more BOLD records, with one set of stages per record.
 
-    sample_accessions = [bold_metadata["sampleid"]]
-    # sample from specimen SAMEA114402071
-    sequencing_experiment_accessions = [bold_metadata["processid"]]
-    genome_assembly_accessions = [bold_metadata["processid"]]
+    :param process_ids: BOLD process ids
+    :param taxonomy: local taxonomy index, if any
+    :param state: checkpoint of the build, which is told of each completed stage
+    :param project_code: BOLD project the records were harvested from, if any
+    :return: the crate, ready to be written
+    """
+    records = [fetch_single_bold_record_by_id(id) for id in process_ids]
+    species_taxids = dict.fromkeys((r["species"], r["taxid"]) for r in records)
+    species_names = [species for species, _ in species_taxids]
 
-    bold_process_id = bold_metadata["processid"]
-    bold_sample_id = bold_metadata["sampleid"]
-    bold_record_id = bold_metadata["record_id"]
+    sample_accessions = [r["sampleid"] for r in records]
+    # sample from specimen SAMEA114402071
+    sequencing_experiment_accessions = [r["processid"] for r in records]
+    genome_assembly_accessions = [r["processid"] for r in records]
 
     crate = ROCrate()
-    output_dir = "bge-crate-barcode/"
 
     ##################
     # core metadata  #
     ##################
 
-    name = species_names[0]
+    name = species_names[0] if len(species_names) == 1 else project_code
 
-    crate.name = f"Barcode of {name}"
-    crate.description = f"Barcode of {name}"
+    crate.name = f"Barcode of {name}" if len(records) == 1 else f"Barcodes of {name}"
+    crate.description = crate.name
     license = crate.add(
         ContextEntity(
             crate,
@@ -414,28 +460,38 @@ def main():
     )
     crate.license = license
 
-    add_species_metadata(
-        crate=crate, species_names=species_names, bold_taxid=bold_metadata["taxid"]
-    )
+    for species, taxid in species_taxids:
+        add_species_metadata(
+            crate=crate,
+            species_names=[species],
+            bold_taxid=taxid,
+            taxonomy=taxonomy,
+        )
 
-    crate.root_dataset["identifier"] = [
-        "TODO project identifiers for barcoding"
-    ]  # BioProject identifiers
+    crate.root_dataset["identifier"] = (
+        [project_code] if project_code else ["TODO project identifiers for barcoding"]
+    )  # BioProject identifiers
 
     ##########################################################
 
     add_authors_and_affiliations(crate=crate)
 
     samples = add_sample_stage(crate=crate, sample_accessions=sample_accessions)
+    if state:
+        state.stage_completed("sample")
 
     sequenced_data = add_sequencing_stage(
         crate=crate, sequencing_accessions=sequencing_experiment_accessions
     )
+    if state:
+        state.stage_completed("sequencing")
 
     assemblies = add_analysis_stage(
         crate=crate,
         analysis_accessions=genome_assembly_accessions,
     )
+    if state:
+        state.stage_completed("analysis")
 
     # TODO: add_validation_stage
     barcode_validator = crate.add(
@@ -458,17 +514,225 @@ def main():
 
     # what would a ROC export from BOLD look like?
 
-    #################
-    # write & check #
-    #################
     crate.root_dataset["hasPart"] = [*samples, *sequenced_data, *assemblies]
     # the final barcode is the focus of the crate
     crate.root_dataset["mainEntity"] = assemblies
+    return crate
+
+
+def write_crate(
+    crate: ROCrate, output_dir: str, zip_options: ZipOptions | None = None
+) -> None:
+    """Write a crate to a folder or zip, and validate it if it changed."""
+    reproducible.finalize(crate)
 
     # Writing the RO-Crate metadata:
-    crate.write(output_dir)
+    with metrics.span("write", crate=crate):
+        if zip_options:
+            # straight to a zip, without copying the data files into output_dir first
+            output, changed = write_crate_zip(crate, zip_options), True
+        else:
+            output = output_dir
+            changed = write_crate_if_changed(crate, output_dir)
+
+    if changed or not passed_validation(output):
+        record_validation(output, validate_crate(output).passed())
+
+
+def build_crate(
+    output_dir: str,
+    taxonomy: TaxonomyIndex | None = None,
+    fresh: bool = False,
+    zip_options: ZipOptions | None = None,
+    process_id: str = DEFAULT_PROCESS_ID,
+) -> None:
+
+    # fetched records are checkpointed, so a rerun after a failure resumes where this one stopped
+    with resumable_build(output_dir, fresh=fresh) as state:
+        bold_metadata = fetch_single_bold_record_by_id(process_id)
+        print(bold_metadata)
+        crate = create_crate([process_id], taxonomy=taxonomy, state=state)
+
+    #################
+    # write & check #
+    #################
+    write_crate(crate, output_dir, zip_options)
+
+    write_build_reports(output_dir, crate)
+
+
+def build_project_crates(
+    project_code: str,
+    output_dir: str,
+    taxonomy: TaxonomyIndex | None = None,
+    fresh: bool = False,
+    zip_options: ZipOptions | None = None,
+    combined: bool = False,
+    workers: int = DEFAULT_WORKERS,
+) -> int:
+    """Build barcode crates for every record of a BOLD project.
+
+    The project's records are harvested first, in pages, and every crate is then
+    built from the cached records. All of its requests go in the batch lane of the
+    rate limiter, including those of the crates built concurrently.
+
+    :param project_code: BOLD project or container code, e.g. "BHNHM"
+    :param output_dir: folder for the combined crate, or for one crate folder per process id
+    :param combined: build one crate with stages for every record, instead of one crate per record
+    :param workers: number of crates built concurrently
+    :return: number of records whose crate could not be built
+    """
+    # the harvest, the records fetched for each crate and each crate built are checkpointed,
+    # so a rerun after a failure neither repeats the harvest nor rebuilds the crates already built
+    with resumable_build(output_dir, fresh=fresh) as state:
+        with rate_limiter.priority(BATCH):
+            with metrics.span("harvest"):
+                process_ids = fetch_bold_project_process_ids(project_code)
+            state.stage_completed("harvest")
+            print(
+                f"Harvested {len(process_ids)} records of BOLD project {project_code}"
+            )
+            if combined:
+                crate = create_crate(
+                    process_ids,
+                    taxonomy=taxonomy,
+                    state=state,
+                    project_code=project_code,
+                )
+            else:
+                failed = _build_record_crates(
+                    process_ids, output_dir, taxonomy, zip_options, workers, state
+                )
+                if failed:
+                    # keep the checkpoint, so a rerun only builds the crates which failed
+                    state.close(completed=False)
+
+    if combined:
+        write_crate(crate, output_dir, zip_options)
+        write_build_reports(output_dir, crate)
+        return 0
+
+    write_build_reports(output_dir)
+    return failed
+
+
+def _build_record_crates(
+    process_ids: list[str],
+    output_dir: str,
+    taxonomy: TaxonomyIndex | None,
+    zip_options: ZipOptions | None,
+    workers: int,
+    state: BuildCheckpoint,
+) -> int:
+    """Build a crate per record, skipping those an earlier run checkpointed as built, see ``build_project_crates``."""
+    built_before = set(state.completed_stages)
+    remaining = [p for p in process_ids if f"crate:{p}" not in built_before]
+    if len(remaining) < len(process_ids):
+        print(
+            f"Skipping {len(process_ids) - len(remaining)} crates already built by an earlier run"
+        )
+
+    if zip_options:
+        # --zip names a folder of zips here, one per record
+        os.makedirs(zip_options.path, exist_ok=True)
+
+    def build_record_crate(process_id: str) -> bool:
+        try:
+            crate = create_crate([process_id], taxonomy=taxonomy)
+            write_crate(
+                crate,
+                os.path.join(output_dir, process_id),
+                zip_options
+                and zip_options._replace(
+                    path=os.path.join(zip_options.path, f"{process_id}.zip")
+                ),
+            )
+        except Exception as e:
+            print(f"Warning: no crate for {process_id}: {e!r}")
+            return False
+        state.stage_completed(f"crate:{process_id}")
+        return True
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        built = list(
+            executor.map(rate_limiter.in_current_lane(build_record_crate), remaining)
+        )
+    failed = built.count(False)
+    print(f"Built {len(built) - failed} crates in {output_dir}, {failed} failed")
+    return failed
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Create an example RO-Crate for a BGE barcode."
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="bge-crate-barcode/",
+        help="folder to write the crate to",
+    )
+    parser.add_argument(
+        "--process-id",
+        default=DEFAULT_PROCESS_ID,
+        help="BOLD process id of the record to build a crate for (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--project",
+        metavar="CODE",
+        help="build crates for every record of a BOLD project or container, e.g. BHNHM",
+    )
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help="with --project, build one crate covering all records instead of one crate per record",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="with --project, number of crates built concurrently (default: %(default)s)",
+    )
+    add_profile_argument(parser)
+    add_reproducible_argument(parser)
+    add_zip_arguments(parser)
+    add_validation_arguments(parser)
+    add_resume_argument(parser)
+    add_snapshot_arguments(parser)
+    add_taxonomy_argument(parser)
+    args = parser.parse_args(argv)
+    reproducible.enable(args.reproducible)
+    crate_validator.configure(
+        severity=args.validation_severity,
+        quick=args.quick_validation,
+        timings=args.validation_timings,
+    )
+
+    if args.snapshot:
+        load_snapshot(args.snapshot)
+
+    with profile_build(args.output_dir, enabled=args.profile):
+        if args.project:
+            build_project_crates(
+                args.project,
+                output_dir=args.output_dir,
+                taxonomy=open_taxonomy_index(args.taxonomy_db),
+                fresh=args.fresh,
+                zip_options=zip_options_from_args(args),
+                combined=args.combined,
+                workers=args.workers,
+            )
+        else:
+            build_crate(
+                output_dir=args.output_dir,
+                taxonomy=open_taxonomy_index(args.taxonomy_db),
+                zip_options=zip_options_from_args(args),
+                fresh=args.fresh,
+                process_id=args.process_id,
+            )
 
-    validate_crate(output_dir)
+    if args.save_snapshot:
+        save_snapshot(args.save_snapshot)
 
 
 if __name__ == "__main__":
@@ -1,16 +1,39 @@
 # Create an RO-Crate following the in-development BGE profile
-from datetime import datetime
+import argparse
 import os
-import uuid
 import requests
 import pandas as pd
 
-from rocrate.model import ContextEntity, Person
+from rocrate.model import ContextEntity, Entity, Person
 from rocrate.rocrate import ROCrate
 from rocrate_validator import services, models
 
+from crate_validation import add_validation_arguments, crate_validator
+from crate_zip import (
+    ZipOptions,
+    add_zip_arguments,
+    write_crate_zip,
+    zip_options_from_args,
+)
+from fasta import FaiRecord, base_counts, load_fai, sequence_digests
+from metrics import metrics, timed_stage, write_build_reports
+from profiling import add_profile_argument, profile_build
+from reproducible import (
+    add_reproducible_argument,
+    passed_validation,
+    record_validation,
+    reproducible,
+    write_crate_if_changed,
+)
+from taxonomy import (
+    TaxonomyIndex,
+    add_taxon_entities,
+    add_taxon_entity,
+    add_taxonomy_argument,
+    open_taxonomy_index,
+)
 from utils import validate_crate, fetch_single_ena_record_by_accession
-
+from validation_tsv import ValidationSummary, summarise_validation_tsv
 
 ##################
 # crate creation #
@@ -20,19 +43,313 @@ from utils import validate_crate, fetch_single_ena_record_by_accession
 target_fasta = "example-data/BGE00146_MGE-BGE_r1_1.3_1.5_s50_100.fasta"
 target_tsv = "example-data/BGE00146_MGE-BGE_r1_1.3_1.5_s50_100.fasta.tsv"
 
-df = pd.read_table(target_tsv)
 
-species_names = df["species"].unique()
-print(species_names)
+def add_species_metadata(
+    crate: ROCrate, name: str, taxonomy: TaxonomyIndex | None = None
+) -> None:
+    taxa = taxonomy.resolve_all(name) if taxonomy else ()
+    species = add_taxon_entity(crate, name, taxa)
 
-name = species_names[0]
-output_dir = "bge-crate-barcode-validation/"
+    crate.root_dataset["about"] = species  # use this and/or taxonomicRange?
+    crate.root_dataset["taxonomicRange"] = species  # what uri to use for taxonomy?
+    crate.root_dataset["scientificName"] = name  # is this necessary?
 
-crate = ROCrate()
 
-crate.name = f"Barcode of {name}"
-crate.description = f"Barcode of {name} created by iBOL and BGE"
-license = crate.add(
+@timed_stage("data_files")
+def add_data_files(crate: ROCrate) -> tuple[Entity, Entity]:
+    fasta_format = crate.add(
+        ContextEntity(
+            crate,
+            "https://blast.ncbi.nlm.nih.gov/doc/blast-topics/#fasta",
+            properties={"name": "FASTA file format", "@type": ["WebPage", "Standard"]},
+        )
+    )
+
+    # barcoding skimming outputs
+    barcodes_file = crate.add_file(
+        source=target_fasta,
+        properties={
+            "name": "Barcodes in FASTA format",
+            "description": "description of barcodes and what run they came from",
+            "sdDatePublished": reproducible.file_timestamp(target_fasta),
+            "contentSize": os.stat(target_fasta).st_size,
+            "encodingFormat": "text/x-fasta",
+        },
+    )
+    barcodes_file.append_to("encodingFormat", fasta_format)
+
+    # barcoding skimming outputs
+    barcodes_tsv_file = crate.add_file(
+        source=target_tsv,
+        properties={
+            "name": "Barcode process details in TSV format",
+            "description": "A TSV containing details of each barcode validation run with different parameters",
+            "sdDatePublished": reproducible.file_timestamp(target_tsv),
+            "contentSize": os.stat(target_tsv).st_size,
+            "encodingFormat": "text/tab-separated-values",
+        },
+    )
+
+    return barcodes_file, barcodes_tsv_file
+
+
+# the byte range of a sequence in the FASTA, as in an HTTP Range header
+BYTE_RANGE_PROPERTY = "https://www.rfc-editor.org/rfc/rfc9110#name-byte-ranges"
+
+
+@timed_stage("sequences")
+def add_sequence_entities(
+    crate: ROCrate, barcodes_file: Entity, fai: list[FaiRecord]
+) -> dict[str, Entity]:
+    """Add one entity per distinct sequence in the barcodes FASTA, pointing at its byte range in the file.
+
+    Sequences are identified by the SHA-256 of their residues, so identical sequences
+    from different sweep runs share one entity which lists all their names. Its byte
+    range is an additionalProperty, a PropertyValue with the inclusive range as value.
+    The byte ranges come from a samtools-compatible .fai index, which is cached next
+    to the FASTA and only rebuilt when the FASTA changes. The index is also added to
+    the crate so consumers can use it directly.
+    """
+    crate.add_file(
+        source=f"{target_fasta}.fai",
+        properties={
+            "name": "Index of the barcodes FASTA",
+            "description": "samtools faidx index: sequence name, length, offset, bases per line and bytes per line",
+            "sdDatePublished": reproducible.file_timestamp(target_fasta),
+            "contentSize": os.stat(f"{target_fasta}.fai").st_size,
+            "encodingFormat": "text/tab-separated-values",
+            "about": barcodes_file,
+        },
+    )
+
+    # sweep variants often produce byte-identical sequences, so group them by content
+    # and describe each distinct sequence once
+    records_by_digest = {}
+    for record, digest in zip(fai, sequence_digests(target_fasta, fai)):
+        records_by_digest.setdefault(digest, []).append(record)
+
+    sequences = {}
+    for digest, records in records_by_digest.items():
+        # identical content, so any occurrence will do for random access
+        record = records[0]
+        names = [r.name for r in records]
+        # byteRange is no term of the crate's context, so the range is a PropertyValue
+        byte_range = crate.add(
+            ContextEntity(
+                crate,
+                f"#sequence-sha256-{digest}-byte-range",
+                properties={
+                    "@type": "PropertyValue",
+                    "name": "byte range",
+                    "propertyID": BYTE_RANGE_PROPERTY,
+                    # inclusive, as in an HTTP Range header
+                    "value": f"{record.offset}-{record.end - 1}",
+                    "unitText": "bytes",
+                },
+            )
+        )
+        entity = crate.add(
+            ContextEntity(
+                crate,
+                f"#sequence-sha256-{digest}",
+                properties={
+                    "@type": "BioChemEntity",
+                    "name": f"Barcode sequence {record.name}"
+                    + (f" and {len(names) - 1} identical" if len(names) > 1 else ""),
+                    "identifier": names,
+                    "sha256": digest,
+                    "hasRepresentation": barcodes_file,
+                    "additionalProperty": byte_range,
+                    "contentSize": record.end - record.offset,
+                },
+            )
+        )
+        sequences.update(dict.fromkeys(names, entity))
+
+    print(f"{len(fai)} sequences in the FASTA, {len(records_by_digest)} distinct")
+    return sequences
+
+
+# TSV columns which can be recomputed from the FASTA alone and the BaseCounts field
+# holding the recomputed value. nuc_basecount, ambig_basecount and stop_codons refer to
+# the barcode region found by the validator, so cannot be checked without its alignment.
+BASECOUNT_COLUMNS = {
+    "nuc_full_basecount": "residues",
+    "ambig_full_basecount": "ambiguous",
+}
+
+
+@timed_stage("basecount_check")
+def check_basecounts(
+    crate: ROCrate,
+    rows: pd.DataFrame,
+    fai: list[FaiRecord],
+    sequences: dict[str, Entity],
+    barcodes_tsv_file: Entity,
+) -> int:
+    """Cross-check the base counts claimed by the TSV against the sequences in the FASTA.
+
+    Each disagreement is recorded as a Comment on the TSV file, about the sequence concerned.
+
+    :param rows: sequence_id and the ``BASECOUNT_COLUMNS`` of each TSV row
+    :return: number of mismatches found
+    """
+    counts = base_counts(target_fasta, fai)
+    computed = pd.DataFrame(
+        {
+            "sequence_id": [record.name for record in fai],
+            **{
+                f"{column}_fasta": getattr(counts, field)
+                for column, field in BASECOUNT_COLUMNS.items()
+            },
+        }
+    )
+    merged = rows[["sequence_id", *BASECOUNT_COLUMNS]].merge(
+        computed, on="sequence_id", how="left"
+    )
+
+    mismatches = 0
+    for column in BASECOUNT_COLUMNS:
+        differs = merged[column] != merged[f"{column}_fasta"]
+        for sequence_id, claimed, actual in merged.loc[
+            differs, ["sequence_id", column, f"{column}_fasta"]
+        ].itertuples(index=False, name=None):
+            if pd.isna(actual):
+                text = f"The TSV gives {column} = {claimed} for {sequence_id}, but the sequence is not in the FASTA."
+            else:
+                text = f"The TSV gives {column} = {claimed} for {sequence_id}, but the sequence in the FASTA has {int(actual)}."
+            comment = crate.add(
+                ContextEntity(
+                    crate,
+                    f"#basecount-mismatch-{sequence_id}-{column}",
+                    properties={
+                        "@type": "Comment",
+                        "name": f"{column} mismatch for {sequence_id}",
+                        "text": text,
+                        "about": sequences.get(sequence_id, sequence_id),
+                    },
+                )
+            )
+            barcodes_tsv_file.append_to("comment", comment)
+            mismatches += 1
+
+    print(f"Base count check: {mismatches} mismatches between the TSV and the FASTA")
+    return mismatches
+
+
+@timed_stage("validation")
+def add_validation_stage(
+    crate: ROCrate,
+    summary: ValidationSummary,
+    barcodes_file: Entity,
+    barcodes_tsv_file: Entity,
+    sequences: dict[str, Entity],
+    taxonomy: TaxonomyIndex | None = None,
+) -> None:
+    # names repeat across the parameter sweep, so resolve each distinct name once
+    # and have every action refer to the shared Taxon entities
+    names = summary.names
+    taxa = add_taxon_entities(crate, names["name"], taxonomy)
+    names_by_process = dict(list(names.groupby("bold_process_id")))
+
+    barcode_validator = crate.add(
+        ContextEntity(
+            crate,
+            "https://github.com/naturalis/barcode_validator",
+            properties={
+                "name": "DNA Barcode Validator",
+                "description": "A Python-based toolkit for validating DNA barcode sequences through structural and taxonomic validation.",
+                "version": "TODO",  # TODO
+            },
+        )
+    )
+
+    for bold_process_id in summary.process_ids:
+        # entity representing BOLD record - or a process?
+        # BOLD Process IDs are unique codes automatically generated for each new record added to a project.
+        #   They serve to connect specimen information, such as taxonomy, collection data and images,
+        #   to the DNA barcode sequence for that specimen.
+        # BOLD Process IDs consist of a standard format including the project code and sequential numbers,
+        # followed by the year the record was added to the database. For example, the first record uploaded
+        # to project PROJ in 2012 would be assigned BOLD Process ID PROJ001-12 . This format ensures BOLD
+        # Process IDs are always unique in the system, as well as identifying the year the record was uploaded
+        # and the original project it was uploaded to.
+
+        # a CreateAction
+        # object: specimen id
+        # result: the barcode sequence(s) on BOLD
+
+        validation_process = crate.add_action(
+            instrument=barcode_validator,
+            identifier=f"#{bold_process_id}",
+            object="TODO specimen id",  # is this actually the barcodes file?
+            result=[
+                barcodes_file,
+                barcodes_tsv_file,
+                # identical sweep runs share an entity, so list each one once
+                *dict.fromkeys(
+                    sequences[sequence_id]
+                    for sequence_id in summary.sequence_ids[bold_process_id]
+                    if sequence_id in sequences
+                ),
+            ],
+            properties={"name": f"Validation for BOLD process ID {bold_process_id}"},
+        )
+
+        if bold_process_id in names_by_process:
+            process_names = names_by_process[bold_process_id]
+            is_species = process_names["role"] == "species"
+            # expected species
+            validation_process["about"] = [
+                taxa[name] for name in process_names.loc[is_species, "name"]
+            ]
+            # identified and observed taxa
+            validation_process["mentions"] = [
+                taxa[name] for name in process_names.loc[~is_species, "name"].unique()
+            ]
+
+        # context entity - the barcode(s)
+        # are these the FASTA file? or are these represented by BINs
+
+    # the whole file represents a workflow run
+    # instrument: https://github.com/bge-barcoding/barcode_validator (I think)
+    # object: the fasta file
+    # result: the tsv file
+    # agent: unknown - is this captured?
+
+    # this is VALIDATION - confirming that a particular run/sample/whatever matches what's in BOLD
+    # so maybe not all the detailed metadata is needed for the validation bit
+    # do we actually have two different things here
+    # the "source of truth" - the barcode in BOLD - these are the reference points - list in "mentions"?
+    # BOLD references are essentially another type of input, conceptually, but hmm
+    # the validation of additional samples - the workflow executions and analysis in these example files
+
+    # what would a ROC export from BOLD look like?
+
+
+def build_crate(
+    output_dir: str,
+    taxonomy: TaxonomyIndex | None = None,
+    zip_options: ZipOptions | None = None,
+    workers: int | None = None,
+) -> None:
+
+    # large TSVs are read and grouped in blocks, across processes
+    with metrics.span("read_tsv"):
+        summary = summarise_validation_tsv(
+            target_tsv, columns=list(BASECOUNT_COLUMNS), workers=workers
+        )
+
+    species_names = summary.species
+    print(species_names)
+
+    name = species_names[0]
+
+    crate = ROCrate()
+
+    crate.name = f"Barcode of {name}"
+    crate.description = f"Barcode of {name} created by iBOL and BGE"
+    license = crate.add(
         ContextEntity(
             crate,
             "https://spdx.org/licenses/CC0-1.0",
@@ -45,131 +362,93 @@ license = crate.add(
     )
     crate.license = license
 
-# TODO get this info from API
-species = ContextEntity(
-    crate,
-    "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",  # WRONG ID
-    properties={
-        "@type": "Taxon",
-        "name": name,
-        "scientificName": name,
-        "taxonRank": [  # which to include?
-            "https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid=304734",  # WRONG ID
-            "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",  # WRONG ID
-            "https://www.wikidata.org/wiki/Q13855218",  # WRONG ID
-        ],
-    },
-)
+    add_species_metadata(crate=crate, name=name, taxonomy=taxonomy)
 
-crate.add(species)
-crate.root_dataset["about"] = species  # use this and/or taxonomicRange?
-crate.root_dataset["taxonomicRange"] = species  # what uri to use for taxonomy?
-crate.root_dataset["scientificName"] = name  # is this necessary?
-crate.root_dataset["identifier"] = [
-    "TODO project identifiers for barcoding"
-]  # BioProject identifiers
-
-fasta_format = crate.add(
-    ContextEntity(
-        crate,
-        "https://blast.ncbi.nlm.nih.gov/doc/blast-topics/#fasta",
-        properties={"name": "FASTA file format", "@type": ["WebPage", "Standard"]},
-    )
-)
+    crate.root_dataset["identifier"] = [
+        "TODO project identifiers for barcoding"
+    ]  # BioProject identifiers
 
-# barcoding skimming outputs
-barcodes_file = crate.add_file(
-    source=target_fasta,
-    properties={
-        "name": "Barcodes in FASTA format",
-        "description": "description of barcodes and what run they came from",
-        "sdDatePublished": str(datetime.now()),
-        "contentSize": os.stat(target_fasta).st_size,
-        "encodingFormat": "text/x-fasta",
-    },
-)
-barcodes_file.append_to("encodingFormat", fasta_format)
-
-# barcoding skimming outputs
-barcodes_tsv_file = crate.add_file(
-    source=target_tsv,
-    properties={
-        "name": "Barcode process details in TSV format",
-        "description": "A TSV containing details of each barcode validation run with different parameters",
-        "sdDatePublished": str(datetime.now()),
-        "contentSize": os.stat(target_tsv).st_size,
-        "encodingFormat": "text/tab-separated-values",
-    },
-)
+    barcodes_file, barcodes_tsv_file = add_data_files(crate=crate)
 
+    with metrics.span("index_fasta"):
+        fai = load_fai(target_fasta)
 
-df["bold_process_id"] = df.sequence_id.apply(lambda x: x.split("_")[0])
+    sequences = add_sequence_entities(crate=crate, barcodes_file=barcodes_file, fai=fai)
 
-barcode_validator = crate.add(
-    ContextEntity(
-        crate,
-        "https://github.com/naturalis/barcode_validator",
-        properties={
-            "name": "DNA Barcode Validator",
-            "description": "A Python-based toolkit for validating DNA barcode sequences through structural and taxonomic validation.",
-            "version": "TODO",  # TODO
-        },
+    check_basecounts(
+        crate=crate,
+        rows=summary.rows,
+        fai=fai,
+        sequences=sequences,
+        barcodes_tsv_file=barcodes_tsv_file,
     )
-)
 
-for bold_process_id in df["bold_process_id"].unique():
-    # entity representing BOLD record - or a process?
-    # BOLD Process IDs are unique codes automatically generated for each new record added to a project.
-    #   They serve to connect specimen information, such as taxonomy, collection data and images,
-    #   to the DNA barcode sequence for that specimen.
-    # BOLD Process IDs consist of a standard format including the project code and sequential numbers,
-    # followed by the year the record was added to the database. For example, the first record uploaded
-    # to project PROJ in 2012 would be assigned BOLD Process ID PROJ001-12 . This format ensures BOLD
-    # Process IDs are always unique in the system, as well as identifying the year the record was uploaded
-    # and the original project it was uploaded to.
-
-    # a CreateAction
-    # object: specimen id
-    # result: the barcode sequence(s) on BOLD
-
-    crate.add_action(
-        instrument=barcode_validator,
-        identifier=f"#{bold_process_id}",
-        object="TODO specimen id",  # is this actually the barcodes file?
-        result=[barcodes_file, barcodes_tsv_file],
-        properties={"name": f"Validation for BOLD process ID {bold_process_id}"},
+    add_validation_stage(
+        crate=crate,
+        summary=summary,
+        barcodes_file=barcodes_file,
+        barcodes_tsv_file=barcodes_tsv_file,
+        sequences=sequences,
+        taxonomy=taxonomy,
     )
 
-    # context entity - the barcode(s)
-    # are these the FASTA file? or are these represented by BINs
-
-    pass
+    print(
+        f"{len(summary.rows)} validation runs of {len(summary.process_ids)} BOLD process ids"
+    )
 
-# the whole file represents a workflow run
-# instrument: https://github.com/bge-barcoding/barcode_validator (I think)
-# object: the fasta file
-# result: the tsv file
-# agent: unknown - is this captured?
+    # Writing the RO-Crate metadata:
+    reproducible.finalize(crate)
 
-# this is VALIDATION - confirming that a particular run/sample/whatever matches what's in BOLD
-# so maybe not all the detailed metadata is needed for the validation bit
-# do we actually have two different things here
-# the "source of truth" - the barcode in BOLD - these are the reference points - list in "mentions"?
-# BOLD references are essentially another type of input, conceptually, but hmm
-# the validation of additional samples - the workflow executions and analysis in these example files
+    with metrics.span("write", crate=crate):
+        if zip_options:
+            # straight to a zip, without copying the data files into output_dir first
+            output, changed = write_crate_zip(crate, zip_options), True
+        else:
+            output = output_dir
+            changed = write_crate_if_changed(crate, output_dir)
 
-# what would a ROC export from BOLD look like?
+    if changed or not passed_validation(output):
+        record_validation(output, validate_crate(output).passed())
 
+    write_build_reports(output_dir, crate)
 
-print(df.loc[df["species"] == name])
 
-# Writing the RO-Crate metadata:
-crate.write(output_dir)
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Create an RO-Crate for BGE barcode validation outputs."
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="bge-crate-barcode-validation/",
+        help="folder to write the crate to",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes reading a large TSV (default: the number of CPUs)",
+    )
+    add_profile_argument(parser)
+    add_reproducible_argument(parser)
+    add_zip_arguments(parser)
+    add_validation_arguments(parser)
+    add_taxonomy_argument(parser)
+    args = parser.parse_args(argv)
+    reproducible.enable(args.reproducible)
+    crate_validator.configure(
+        severity=args.validation_severity,
+        quick=args.quick_validation,
+        timings=args.validation_timings,
+    )
 
-validate_crate(output_dir)
+    with profile_build(args.output_dir, enabled=args.profile):
+        build_crate(
+            output_dir=args.output_dir,
+            taxonomy=open_taxonomy_index(args.taxonomy_db),
+            zip_options=zip_options_from_args(args),
+            workers=args.workers,
+        )
 
 
-# if __name__ == "__main__":
-#     create_ro_crate(
-#         input_file=sys.argv[1], workflow_file=sys.argv[2], output_dir=sys.argv[3]
-#     )
+if __name__ == "__main__":
+    main()
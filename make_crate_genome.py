@@ -1,19 +1,66 @@
 # Create an RO-Crate following the in-development BGE profile
-from datetime import datetime
+import argparse
+import itertools
 import os
-import uuid
+from typing import Iterable
 import requests
 
-from rocrate.model import ContextEntity, Entity, Person
+from rocrate.model import ContextEntity, Entity, File, Person
 from rocrate.rocrate import ROCrate
 from rocrate_validator import services, models
 
+from checkpoint import add_resume_argument
+from crate_validation import add_validation_arguments, crate_validator
+from crate_zip import (
+    ZipOptions,
+    add_zip_arguments,
+    write_crate_zip,
+    zip_options_from_args,
+)
+from fetch_planner import (
+    DEFAULT_WORKERS,
+    describe_plan,
+    plan_genome_fetches,
+    prefetch,
+)
+from harvest import (
+    HARVEST_PAGE_SIZE,
+    add_study_arguments,
+    describe_harvest,
+    harvest_study,
+)
+from metrics import metrics, timed_stage, write_build_reports
+from profiling import add_profile_argument, profile_build
+from remote_files import (
+    add_head_fallback_argument,
+    describe_with_head,
+    ena_files,
+    remote_file_properties,
+)
+from reproducible import (
+    add_reproducible_argument,
+    passed_validation,
+    record_validation,
+    reproducible,
+    write_crate_if_changed,
+)
+from snapshot import add_snapshot_arguments
+from taxonomy import (
+    TaxonomyIndex,
+    add_taxon_entity,
+    add_taxonomy_argument,
+    open_taxonomy_index,
+)
 from utils import (
     validate_crate,
+    fetch_ena_assembly_record,
     fetch_single_ena_record_by_accession,
     load_remote_crate,
     get_accession_permalink,
     get_copo_rocrate_uri_from_accession,
+    resumable_build,
+    load_snapshot,
+    save_snapshot,
 )
 
 #########
@@ -24,26 +71,32 @@ ENA_PREFIX = "ena.embl"  # identifiers.org prefix
 BIOSAMPLES_PREFIX = "biosample"  # identifiers.org prefix
 
 
-def add_species_metadata(crate: ROCrate, species_names: list[str]) -> None:
+def add_species_metadata(
+    crate: ROCrate, species_names: list[str], taxonomy: TaxonomyIndex | None = None
+) -> None:
 
     for name in species_names:
-        # TODO: lookup species name in NCBI/BOLD to get id
-        species = ContextEntity(
-            crate,
-            "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",
-            properties={
-                "@type": "Taxon",
-                "name": name,
-                "scientificName": name,
-                "taxonRank": [  # which to include?
-                    "https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid=304734",
-                    "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",
-                    "https://www.wikidata.org/wiki/Q13855218",
-                ],
-            },
-        )
+        taxa = taxonomy.resolve_all(name) if taxonomy else ()
+        if taxa:
+            species = add_taxon_entity(crate, name, taxa)
+        else:
+            # name not in the local taxonomy index, fall back to hand-curated ids
+            species = ContextEntity(
+                crate,
+                "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",
+                properties={
+                    "@type": "Taxon",
+                    "name": name,
+                    "scientificName": name,
+                    "taxonRank": [  # which to include?
+                        "https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid=304734",
+                        "https://www.ncbi.nlm.nih.gov/taxonomy/1464561",
+                        "https://www.wikidata.org/wiki/Q13855218",
+                    ],
+                },
+            )
+            crate.add(species)
 
-        crate.add(species)
         crate.root_dataset.append_to(
             "about", species
         )  # use this and/or taxonomicRange?
@@ -83,7 +136,8 @@ def add_authors_and_affiliations(crate: ROCrate) -> None:
 ################
 
 
-def add_sample_stage(crate: ROCrate, sample_accessions: list[str]) -> list[Entity]:
+@timed_stage("sample")
+def add_sample_stage(crate: ROCrate, sample_accessions: Iterable[str]) -> list[Entity]:
     # Physical sample collection
     sample_collection = crate.add(
         ContextEntity(
@@ -134,7 +188,7 @@ def add_sample_stage(crate: ROCrate, sample_accessions: list[str]) -> list[Entit
                             identifiers_org_ena_uri,
                             identifiers_org_biosamples_uri,
                         ],
-                        "sdDatePublished": str(datetime.now()),
+                        "sdDatePublished": reproducible.timestamp(sample_metadata),
                     },
                 )
             )
@@ -198,7 +252,10 @@ def add_sample_stage(crate: ROCrate, sample_accessions: list[str]) -> list[Entit
 #################
 
 
-def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> Entity:
+@timed_stage("sequencing")
+def add_sequencing_stage(
+    crate: ROCrate, sequencing_accessions: Iterable[str]
+) -> Entity:
 
     # ideally this protocol would be an RO-Crate itself so we could include just minimal metadata here
     protocol_wet_lab = crate.add(
@@ -215,7 +272,7 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
     protocol_sequencing = crate.add(
         ContextEntity(
             crate,
-            f"#sequencing-protocol-{uuid.uuid4()}",
+            reproducible.local_id("sequencing-protocol"),
             properties={
                 "@type": "LabProtocol",
                 "name": f"Sequencing protocol",
@@ -262,7 +319,7 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
         processed_dna = crate.add(
             ContextEntity(
                 crate,
-                f"#processed-dna-rna-{uuid.uuid4()}",
+                reproducible.local_id("processed-dna-rna", sequencing_accession),
                 properties={
                     "@type": "BioSample",
                     "name": f"Processed DNA/RNA ({sequencing_accession})",
@@ -283,7 +340,7 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
         # action connects protocol and output
         wet_lab_process = crate.add_action(
             instrument=protocol_wet_lab,
-            identifier=f"#wet-lab-process-{uuid.uuid4()}",
+            identifier=reproducible.local_id("wet-lab-process", sequencing_accession),
             object=sample_entity,  # sample or biobank? assume sample...
             result=processed_dna,
             properties={
@@ -303,29 +360,31 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
 
         # Sequencing
 
-        download_uris = sequencing_metadata["fastq_ftp"].split(";")
-        download_sizes = sequencing_metadata["fastq_bytes"].split(";")
+        # size, checksum and format come from the ENA record, nothing is downloaded
         sequenced_data = []
 
-        for uri, size in zip(download_uris, download_sizes):
+        for remote_file in ena_files(
+            sequencing_metadata, "fastq_ftp", "fastq_bytes", "fastq_md5"
+        ):
             sequenced_data.append(
                 crate.add_file(
-                    source=f"ftp://{uri}",
-                    validate_url=True,
+                    source=remote_file.url,
+                    validate_url=False,
                     properties={
-                        "name": f'{sequencing_metadata["experiment_title"]}: {os.path.basename(uri)}',
+                        "name": f'{sequencing_metadata["experiment_title"]}: {os.path.basename(remote_file.url)}',
                         # TODO automate description better
                         "description": "example: PacBio sequencing of library ERGA_PI14589222, constructed from sample accession SAMEA114402090 for study accession PRJEB75413.",
-                        "sdDatePublished": str(datetime.now()),
-                        "contentSize": size,
-                        "encodingFormat": "TODO file type for FASTA",
+                        "sdDatePublished": reproducible.timestamp(sequencing_metadata),
+                        **remote_file_properties(crate, remote_file),
                     },
                 )
             )
 
         sequencing_process = crate.add_action(
             instrument=protocol_sequencing,
-            identifier=f"#sequencing-process-{uuid.uuid4()}",
+            identifier=reproducible.local_id(
+                "sequencing-process", sequencing_accession
+            ),
             object=processed_dna,
             result=sequenced_data,
             properties={
@@ -353,14 +412,19 @@ def add_sequencing_stage(crate: ROCrate, sequencing_accessions: list[str]) -> En
 ##################
 
 
-def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
+@timed_stage("analysis")
+def add_analysis_stage(crate: ROCrate, analysis_accessions: Iterable[str]) -> Entity:
+    # needed twice, for the workflow and for the assemblies; a handful per study
+    analysis_accessions = list(analysis_accessions)
 
     workflow_assembly = crate.add_workflow(
-        dest_path=f"#assembly-workflow-{uuid.uuid4()}",
+        dest_path=reproducible.local_id("assembly-workflow", *analysis_accessions),
         properties={
             "name": f"Assembly workflow (placeholder)",
             "description": "A placeholder for a workflow that could exist on WorkflowHub (etc) or be directly contained within the crate",
-            "sdDatePublished": str(datetime.now()),
+            "sdDatePublished": reproducible.timestamp(
+                *(fetch_ena_assembly_record(a) for a in analysis_accessions)
+            ),
         },
     )
 
@@ -377,16 +441,7 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
     crate.root_dataset.append_to("hasPart", analysis_collection)
 
     for analysis_accession in analysis_accessions:
-        # try main accession first, then set accession, as they are similar but different...
-        genome_assembly_metadata = {}
-        try:
-            genome_assembly_metadata = fetch_single_ena_record_by_accession(
-                analysis_accession, "assembly", "assembly_accession"
-            )
-        except ValueError:
-            genome_assembly_metadata = fetch_single_ena_record_by_accession(
-                analysis_accession, "assembly", "assembly_set_accession"
-            )
+        genome_assembly_metadata = fetch_ena_assembly_record(analysis_accession)
 
         # fetch experiment accessions to connect to sequencing stage
         # but the assembly metadata only has the runs
@@ -411,19 +466,18 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
             wgs_set_accession, "wgs_set", "wgs_set"
         )
 
-        download_uris = wgs_set_metadata["set_fasta_ftp"].split(";")
-
+        # ENA lists no sizes or checksums for WGS sets, see describe_with_head
         genome_assembly_data = []
 
-        for uri in download_uris:
+        for remote_file in ena_files(wgs_set_metadata, "set_fasta_ftp"):
             genome_assembly_data.append(
                 crate.add_file(
-                    source=f"ftp://{uri}",
-                    validate_url=True,
+                    source=remote_file.url,
+                    validate_url=False,
                     properties={
                         "name": f'{wgs_set_metadata["description"]}',
-                        "sdDatePublished": str(datetime.now()),
-                        "encodingFormat": "TODO file type for FASTA",
+                        "sdDatePublished": reproducible.timestamp(wgs_set_metadata),
+                        **remote_file_properties(crate, remote_file),
                         "identifier": get_accession_permalink(
                             ENA_PREFIX, wgs_set_accession
                         ),
@@ -434,11 +488,12 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
         genome_assembly = crate.add_dataset(
             # source=get_accession_permalink(ENA_PREFIX, analysis_accession), # TODO identifiers.org doesn't work with the underscore?
             source=f"https://www.ebi.ac.uk/ena/browser/view/{analysis_accession}",
-            validate_url=True,
+            # validating the URL on write restamps sdDatePublished with the time of the write
+            validate_url=not reproducible.enabled,
             properties={
                 "name": f'{genome_assembly_metadata["assembly_title"]}',
                 "description": genome_assembly_metadata["description_comment"],
-                "sdDatePublished": str(datetime.now()),
+                "sdDatePublished": reproducible.timestamp(genome_assembly_metadata),
             },
         )
         genome_assembly.append_to("hasPart", genome_assembly_data)
@@ -449,7 +504,7 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
 
         assembly_process = crate.add_action(
             instrument=workflow_assembly,
-            identifier=f"#assembly-process-{uuid.uuid4()}",
+            identifier=reproducible.local_id("assembly-process", analysis_accession),
             object=experiment_entities,
             result=genome_assembly,
             properties={
@@ -465,7 +520,17 @@ def add_analysis_stage(crate: ROCrate, analysis_accessions: str) -> Entity:
     return analysis_collection["hasPart"]
 
 
-def main():
+def build_crate(
+    output_dir: str,
+    taxonomy: TaxonomyIndex | None = None,
+    workers: int = DEFAULT_WORKERS,
+    dry_run: bool = False,
+    fresh: bool = False,
+    zip_options: ZipOptions | None = None,
+    head_fallback: bool = False,
+    study: str | None = None,
+    page_size: int = HARVEST_PAGE_SIZE,
+) -> None:
     species_names = [
         "Culex laticinctus",
         # "Culex modestus",
@@ -491,49 +556,93 @@ def main():
         "GCA_964187835.1",
     ]
 
-    crate = ROCrate()
-    output_dir = "bge-crate-genome/"
-
-    ##################
-    # core metadata  #
-    ##################
-
-    name = species_names[0]
+    project_identifiers = [
+        get_accession_permalink(ENA_PREFIX, "PRJEB75414"),
+        "https://www.ncbi.nlm.nih.gov/bioproject/1109235",
+    ]  # BioProject identifiers
 
-    crate.name = f"Genome of {name}"
-    crate.description = f"Genome of {name} created by ERGA-BGE"
-    license = crate.add(
-        ContextEntity(
-            crate,
-            "https://spdx.org/licenses/CC0-1.0",
-            properties={
-                "@type": "CreativeWork",
-                "name": "Creative Commons Zero v1.0 Universal",
-                "url": "https://creativecommons.org/publicdomain/zero/1.0/legalcode",
-            },
+    if study:
+        # accessions stream in from paged searches as the stages consume them
+        if dry_run:
+            print(describe_harvest(study, page_size=page_size))
+            return
+        lookups = []
+        sample_accessions = harvest_study(study, "sample", page_size)
+        sequencing_experiment_accessions = harvest_study(
+            study, "read_experiment", page_size
         )
-    )
-    crate.license = license
+        genome_assembly_accessions = harvest_study(study, "assembly", page_size)
+        project_identifiers = [get_accession_permalink(ENA_PREFIX, study)]
+    else:
+        # fetch all upstream metadata up front, one concurrent wave per dependency level
+        lookups = plan_genome_fetches(
+            sample_accessions,
+            sequencing_experiment_accessions,
+            genome_assembly_accessions,
+        )
+        if dry_run:
+            print(describe_plan(lookups, workers=workers))
+            return
+    # fetched records are checkpointed, so a rerun after a failure resumes where this one stopped
+    with resumable_build(output_dir, fresh=fresh) as state:
+        prefetch(lookups, workers=workers)
+
+        if study:
+            # the species is only known once the first sample has been harvested
+            first_sample = next(sample_accessions, None)
+            if first_sample is None:
+                raise ValueError(f"No ENA samples found for study {study}.")
+            species_names = [
+                fetch_single_ena_record_by_accession(first_sample, "sample")[
+                    "scientific_name"
+                ]
+            ]
+            sample_accessions = itertools.chain([first_sample], sample_accessions)
+
+        crate = ROCrate()
+
+        ##################
+        # core metadata  #
+        ##################
+
+        name = species_names[0]
+
+        crate.name = f"Genome of {name}"
+        crate.description = f"Genome of {name} created by ERGA-BGE"
+        license = crate.add(
+            ContextEntity(
+                crate,
+                "https://spdx.org/licenses/CC0-1.0",
+                properties={
+                    "@type": "CreativeWork",
+                    "name": "Creative Commons Zero v1.0 Universal",
+                    "url": "https://creativecommons.org/publicdomain/zero/1.0/legalcode",
+                },
+            )
+        )
+        crate.license = license
 
-    add_species_metadata(crate=crate, species_names=species_names)
+        add_species_metadata(
+            crate=crate, species_names=species_names, taxonomy=taxonomy
+        )
 
-    crate.root_dataset["identifier"] = [
-        get_accession_permalink(ENA_PREFIX, "PRJEB75414"),
-        "https://www.ncbi.nlm.nih.gov/bioproject/1109235",
-    ]  # BioProject identifiers
+        crate.root_dataset["identifier"] = project_identifiers
 
-    add_authors_and_affiliations(crate=crate)
+        add_authors_and_affiliations(crate=crate)
 
-    samples = add_sample_stage(crate=crate, sample_accessions=sample_accessions)
+        samples = add_sample_stage(crate=crate, sample_accessions=sample_accessions)
+        state.stage_completed("sample")
 
-    sequenced_data = add_sequencing_stage(
-        crate=crate, sequencing_accessions=sequencing_experiment_accessions
-    )
+        sequenced_data = add_sequencing_stage(
+            crate=crate, sequencing_accessions=sequencing_experiment_accessions
+        )
+        state.stage_completed("sequencing")
 
-    assemblies = add_analysis_stage(
-        crate=crate,
-        analysis_accessions=genome_assembly_accessions,
-    )
+        assemblies = add_analysis_stage(
+            crate=crate,
+            analysis_accessions=genome_assembly_accessions,
+        )
+        state.stage_completed("analysis")
 
     #################
     # write & check #
@@ -542,10 +651,91 @@ def main():
     # the assembled genomes are the focus of the crate
     crate.root_dataset["mainEntity"] = assemblies
 
+    if head_fallback:
+        remote_files = [
+            e for e in crate.data_entities if isinstance(e, File) and "://" in e.id
+        ]
+        with metrics.span("head_fallback"):
+            updated = describe_with_head(remote_files, workers=workers)
+        print(f"Described {updated} remote files with HEAD requests")
+
+    reproducible.finalize(crate)
+
     # Writing the RO-Crate metadata:
-    crate.write(output_dir)
+    with metrics.span("write", crate=crate):
+        if zip_options:
+            # straight to a zip, without copying the data files into output_dir first
+            output, changed = write_crate_zip(crate, zip_options), True
+        else:
+            output = output_dir
+            changed = write_crate_if_changed(crate, output_dir)
+
+    if changed or not passed_validation(output):
+        record_validation(output, validate_crate(output).passed())
+
+    write_build_reports(output_dir, crate)
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Create an example RO-Crate for a BGE genome."
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        default="bge-crate-genome/",
+        help="folder to write the crate to",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of concurrent upstream requests (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print the planned upstream calls and an estimated cost, then exit",
+    )
+    add_profile_argument(parser)
+    add_reproducible_argument(parser)
+    add_zip_arguments(parser)
+    add_validation_arguments(parser)
+    add_head_fallback_argument(parser)
+    add_resume_argument(parser)
+    add_snapshot_arguments(parser)
+    add_study_arguments(parser)
+    add_taxonomy_argument(parser)
+    args = parser.parse_args(argv)
+    if args.study and args.snapshot:
+        parser.error(
+            "--study harvests from ENA, so it cannot be combined with --snapshot"
+        )
+    reproducible.enable(args.reproducible)
+    crate_validator.configure(
+        severity=args.validation_severity,
+        quick=args.quick_validation,
+        timings=args.validation_timings,
+    )
+
+    if args.snapshot:
+        load_snapshot(args.snapshot)
+
+    with profile_build(args.output_dir, enabled=args.profile):
+        build_crate(
+            output_dir=args.output_dir,
+            taxonomy=None if args.dry_run else open_taxonomy_index(args.taxonomy_db),
+            workers=args.workers,
+            dry_run=args.dry_run,
+            fresh=args.fresh,
+            zip_options=zip_options_from_args(args),
+            head_fallback=args.head_fallback,
+            study=args.study,
+            page_size=args.page_size,
+        )
 
-    validate_crate(output_dir)
+    if args.save_snapshot and not args.dry_run:
+        save_snapshot(args.save_snapshot)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,316 @@
+# Merge BGE crates, e.g. the barcode and genome crates of one species, into one crate
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from typing import NamedTuple
+from urllib.parse import unquote
+import zipfile
+
+from crate_validation import add_validation_arguments, crate_validator
+
+METADATA_FILE = "ro-crate-metadata.json"
+ROOT_ID = "./"
+
+# properties which take the latest of the merged values rather than conflicting
+LATEST_WINS = {"datePublished", "dateModified", "sdDatePublished"}
+
+
+class Conflict(NamedTuple):
+    entity_id: str
+    property: str
+    kept: object
+    dropped: object
+
+
+class MergeResult(NamedTuple):
+    graph: list[dict]
+    conflicts: list[Conflict]
+    renamed: dict[str, str]  # ids of the second crate which were changed, old -> new
+
+
+def read_metadata(crate: str) -> dict:
+    """The metadata of a crate folder, crate zip or metadata file."""
+    if zipfile.is_zipfile(crate):
+        with zipfile.ZipFile(crate) as zf:
+            return json.loads(zf.read(METADATA_FILE))
+    if os.path.isdir(crate):
+        crate = os.path.join(crate, METADATA_FILE)
+    with open(crate, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _ids(value) -> list[str]:
+    """Ids referenced by a property value, e.g. sameAs."""
+    values = value if isinstance(value, list) else [value]
+    return [v["@id"] for v in values if isinstance(v, dict) and "@id" in v]
+
+
+def _types(entity: dict) -> set[str]:
+    types = entity.get("@type", [])
+    return {types} if isinstance(types, str) else set(types)
+
+
+def _rewrite(value, renamed: dict[str, str]):
+    """A property value with its references to renamed entities replaced."""
+    if isinstance(value, list):
+        return [_rewrite(v, renamed) for v in value]
+    if isinstance(value, dict):
+        if "@id" in value and len(value) == 1:
+            return {"@id": renamed.get(value["@id"], value["@id"])}
+        return {k: _rewrite(v, renamed) for k, v in value.items()}
+    return value
+
+
+def _union(a, b) -> list:
+    values = {}
+    for v in (a if isinstance(a, list) else [a]) + (b if isinstance(b, list) else [b]):
+        values.setdefault(json.dumps(v, sort_keys=True), v)
+    return list(values.values())
+
+
+def _merge_entity(
+    kept: dict, other: dict, prefer_first: bool, conflicts: list[Conflict]
+) -> None:
+    for key, value in other.items():
+        if key == "@id":
+            continue
+        if key not in kept:
+            kept[key] = value
+        elif kept[key] == value:
+            continue
+        elif key in LATEST_WINS and isinstance(value, str):
+            kept[key] = max(kept[key], value)
+        elif (
+            key == "@type"
+            or isinstance(kept[key], (list, dict))
+            or isinstance(value, (list, dict))
+        ):
+            # lists and references accumulate, e.g. hasPart, about, sameAs
+            kept[key] = _union(kept[key], value)
+            if key == "@type" and len(kept[key]) == 1:
+                kept[key] = kept[key][0]
+        else:
+            dropped, kept[key] = (
+                (value, kept[key]) if prefer_first else (kept[key], value)
+            )
+            conflicts.append(Conflict(kept["@id"], key, kept[key], dropped))
+
+
+def _rename_ids(first: dict[str, dict], second: list[dict]) -> dict[str, str]:
+    """Ids of entities in the second graph which must change to join the first graph.
+
+    An entity joins the entity of the first graph with the same id, or the one it
+    is sameAs (either way). A local ("#") id taken in the first graph by an
+    entity of another type gets a new suffix instead, as it is a different thing.
+    """
+    aliases = {
+        alias: entity_id
+        for entity_id, entity in first.items()
+        for alias in _ids(entity.get("sameAs", []))
+    }
+    second_ids = {entity["@id"] for entity in second}
+    renamed = {}
+    for entity in second:
+        entity_id = entity["@id"]
+        if entity_id in first:
+            if entity_id.startswith("#") and not _types(entity) & _types(
+                first[entity_id]
+            ):
+                n = 2
+                while f"{entity_id}-{n}" in first or f"{entity_id}-{n}" in second_ids:
+                    n += 1
+                renamed[entity_id] = f"{entity_id}-{n}"
+        elif entity_id in aliases:
+            renamed[entity_id] = aliases[entity_id]
+        else:
+            same = [i for i in _ids(entity.get("sameAs", [])) if i in first]
+            if same:
+                renamed[entity_id] = same[0]
+    return renamed
+
+
+def merge_graphs(
+    first: list[dict], second: list[dict], prefer_first: bool = True
+) -> MergeResult:
+    """Join two crate graphs by @id, in time and memory linear in their size.
+
+    Entities with the same id (or linked by sameAs) become one entity: lists and
+    references are combined, dates take the latest value, and other differing
+    values are conflicts, resolved in favour of the first (or second) graph.
+    References in the second graph are rewritten to the ids its entities took.
+
+    :param first: @graph of the first crate
+    :param second: @graph of the second crate
+    :param prefer_first: resolve conflicts in favour of the first graph
+    :return: the merged graph, the conflicts and the renamed ids
+    """
+    merged = {entity["@id"]: dict(entity) for entity in first}
+    renamed = _rename_ids(merged, second)
+    conflicts = []
+    for entity in second:
+        entity = _rewrite(entity, renamed)
+        entity["@id"] = renamed.get(entity["@id"], entity["@id"])
+        if entity["@id"] not in merged:
+            merged[entity["@id"]] = entity
+            continue
+        _merge_entity(merged[entity["@id"]], entity, prefer_first, conflicts)
+    # keep the ids the second graph used as aliases of the entities they joined
+    for old_id, new_id in renamed.items():
+        if not old_id.startswith("#"):
+            entity = merged[new_id]
+            entity["sameAs"] = _union(entity.get("sameAs", []), {"@id": old_id})
+    return MergeResult(list(merged.values()), conflicts, renamed)
+
+
+def _local_files(graph: list[dict]) -> dict[str, str]:
+    """Paths in the crate of the local data files its graph describes."""
+    files = {}
+    for entity in graph:
+        entity_id = entity["@id"]
+        if entity_id in (ROOT_ID, METADATA_FILE) or entity_id.startswith("#"):
+            continue
+        if "://" in entity_id or "File" not in _types(entity):
+            continue
+        files[entity_id] = unquote(entity_id)
+    return files
+
+
+def _copy_files(crate: str, files: dict[str, str], output_dir: str) -> None:
+    archive = zipfile.ZipFile(crate) if zipfile.is_zipfile(crate) else None
+    members = set(archive.namelist()) if archive is not None else set()
+    try:
+        for path in files.values():
+            dest = os.path.join(output_dir, path)
+            if archive is not None:
+                if path not in members:
+                    continue
+                os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+                with archive.open(path) as src, open(dest, "wb") as out:
+                    shutil.copyfileobj(src, out)
+            elif os.path.isfile(source := os.path.join(crate, path)):
+                os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+                shutil.copyfile(source, dest)
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def _file_digest(crate: str, path: str) -> bytes | None:
+    sha256 = hashlib.sha256()
+    if zipfile.is_zipfile(crate):
+        with zipfile.ZipFile(crate) as zf:
+            if path not in zf.namelist():
+                return None
+            with zf.open(path) as f:
+                while chunk := f.read(1024 * 1024):
+                    sha256.update(chunk)
+    else:
+        source = os.path.join(crate, path)
+        if not os.path.isfile(source):
+            return None
+        with open(source, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                sha256.update(chunk)
+    return sha256.digest()
+
+
+def merge_crates(
+    first: str,
+    second: str,
+    output_dir: str,
+    prefer_first: bool = True,
+    name: str | None = None,
+    description: str | None = None,
+) -> MergeResult:
+    """Merge two crates into a new crate folder, with the data files of both.
+
+    :param first: first crate folder or zip
+    :param second: second crate folder or zip
+    :param output_dir: folder to write the merged crate to
+    :param prefer_first: resolve conflicts in favour of the first crate
+    :param name: name of the merged crate, by default the name of the preferred crate
+    :param description: description of the merged crate
+    :raises ValueError: both crates hold a different file at the same path
+    :return: the merge result
+    """
+    metadata = [read_metadata(first), read_metadata(second)]
+    result = merge_graphs(
+        metadata[0]["@graph"], metadata[1]["@graph"], prefer_first=prefer_first
+    )
+    root = next(entity for entity in result.graph if entity["@id"] == ROOT_ID)
+    if name:
+        root["name"] = name
+    if description:
+        root["description"] = description
+
+    files = [_local_files(metadata[0]["@graph"])]
+    files.append(
+        {
+            result.renamed.get(entity_id, entity_id): path
+            for entity_id, path in _local_files(metadata[1]["@graph"]).items()
+        }
+    )
+    for entity_id in files[0].keys() & files[1].keys():
+        if _file_digest(first, files[0][entity_id]) != _file_digest(
+            second, files[1][entity_id]
+        ):
+            raise ValueError(
+                f"Both crates have a different {files[0][entity_id]}, merge them by hand."
+            )
+
+    os.makedirs(output_dir, exist_ok=True)
+    _copy_files(first, files[0], output_dir)
+    _copy_files(second, files[1], output_dir)
+    with open(os.path.join(output_dir, METADATA_FILE), "w", encoding="utf-8") as f:
+        json.dump(
+            {"@context": metadata[0]["@context"], "@graph": result.graph}, f, indent=4
+        )
+    return result
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Merge two crates, e.g. the barcode and genome crates of one species"
+    )
+    parser.add_argument("first", help="first crate folder or zip")
+    parser.add_argument("second", help="second crate folder or zip")
+    parser.add_argument("-o", "--output-dir", default="bge-crate-merged")
+    parser.add_argument(
+        "--prefer",
+        choices=["first", "second"],
+        default="first",
+        help="crate whose value is kept when the crates disagree (default: %(default)s)",
+    )
+    parser.add_argument("--name", help="name of the merged crate")
+    parser.add_argument("--description", help="description of the merged crate")
+    add_validation_arguments(parser)
+    args = parser.parse_args(argv)
+
+    result = merge_crates(
+        args.first,
+        args.second,
+        args.output_dir,
+        prefer_first=args.prefer == "first",
+        name=args.name,
+        description=args.description,
+    )
+    print(
+        f"Merged into {len(result.graph)} entities in {args.output_dir}, "
+        f"{len(result.renamed)} ids rewritten, {len(result.conflicts)} conflicts"
+    )
+    for conflict in result.conflicts:
+        print(
+            f"  {conflict.entity_id} {conflict.property}: kept {conflict.kept!r}, dropped {conflict.dropped!r}"
+        )
+    crate_validator.configure(
+        severity=args.validation_severity,
+        quick=args.quick_validation,
+        timings=args.validation_timings,
+    )
+    crate_validator.validate(args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# Build instrumentation for BGE RO-Crate creation
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory_bytes() -> int | None:
+    """Peak resident set size of this process, or None if it cannot be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def count_entities(crate) -> int:
+    return sum(1 for _ in crate.get_entities())
+
+
+class BuildMetrics:
+    """Collects timings, HTTP traffic and cache statistics for a single crate build.
+
+    Spans are recorded for build stages (``add_sample_stage``, ``crate.write``, ...)
+    and for the individual API fetchers. At the end of a build the collected data
+    can be written as a JSON report (``write_report``) or as a Chrome trace file
+    (``write_chrome_trace``) which can be opened in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._start = time.perf_counter()
+            self.stages = []
+            self.fetchers = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+            self.http = defaultdict(
+                lambda: {"calls": 0, "bytes": 0, "seconds": 0.0, "statuses": {}}
+            )
+            self.cache_hits = 0
+            self.cache_misses = 0
+            self._trace_events = []
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self._start) * 1e6
+
+    def _http_calls(self) -> int:
+        return sum(host["calls"] for host in self.http.values())
+
+    @contextmanager
+    def span(self, name: str, category: str = "stage", crate=None):
+        """Time the enclosed block.
+
+        :param name: name of the span, e.g. "sample" or "fetch_single_bold_record_by_id"
+        :param category: "stage" spans are listed individually in the report,
+            any other category is aggregated per name.
+        :param crate: if given, the number of entities in the crate is recorded before and after
+        """
+        entities_before = count_entities(crate) if crate is not None else None
+        http_calls_before = self._http_calls()
+        start_us = self._now_us()
+        try:
+            yield
+        finally:
+            end_us = self._now_us()
+            seconds = (end_us - start_us) / 1e6
+            args = {}
+            with self._lock:
+                if category == "stage":
+                    stage = {
+                        "name": name,
+                        "start_seconds": start_us / 1e6,
+                        "seconds": seconds,
+                        "http_calls": self._http_calls() - http_calls_before,
+                        "peak_memory_bytes": peak_memory_bytes(),
+                    }
+                    if crate is not None:
+                        stage["entities_added"] = (
+                            count_entities(crate) - entities_before
+                        )
+                        stage["entities_total"] = count_entities(crate)
+                    self.stages.append(stage)
+                    args = {k: v for k, v in stage.items() if k != "name"}
+                else:
+                    self.fetchers[name]["calls"] += 1
+                    self.fetchers[name]["seconds"] += seconds
+                self._trace_events.append(
+                    {
+                        "name": name,
+                        "cat": category,
+                        "ph": "X",
+                        "ts": start_us,
+                        "dur": end_us - start_us,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                        "args": args,
+                    }
+                )
+
+    def record_http_bytes(self, response, nbytes: int) -> None:
+        """Add body bytes of a streamed response, as they are read, to its host's traffic."""
+        host = urlparse(response.url).hostname or "unknown"
+        with self._lock:
+            self.http[host]["bytes"] += nbytes
+
+    def record_http(self, response, nbytes: int | None = None) -> None:
+        """Record a completed HTTP request against its host.
+
+        :param response: a ``requests.Response``
+        :param nbytes: size of the body, if it was not (or not yet) read into ``response.content``
+        """
+        host = urlparse(response.url).hostname or "unknown"
+        if nbytes is None:
+            nbytes = len(response.content)
+        elapsed = response.elapsed.total_seconds()
+        end_us = self._now_us()
+        with self._lock:
+            stats = self.http[host]
+            stats["calls"] += 1
+            stats["bytes"] += nbytes
+            stats["seconds"] += elapsed
+            status = str(response.status_code)
+            stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+            self._trace_events.append(
+                {
+                    "name": f"{response.request.method} {host}",
+                    "cat": "http",
+                    "ph": "X",
+                    "ts": end_us - elapsed * 1e6,
+                    "dur": elapsed * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": {"url": response.url, "status": response.status_code},
+                }
+            )
+
+    def record_cache(self, hit: bool) -> None:
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def report(self, crate=None) -> dict:
+        with self._lock:
+            return {
+                "total_seconds": self._now_us() / 1e6,
+                "peak_memory_bytes": peak_memory_bytes(),
+                "entities": count_entities(crate) if crate is not None else None,
+                "stages": list(self.stages),
+                "fetchers": {k: dict(v) for k, v in self.fetchers.items()},
+                "http": {k: dict(v) for k, v in self.http.items()},
+                "cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+            }
+
+    def write_report(self, path: str, crate=None) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(crate), f, indent=2)
+        print(f"Build report written to {path}")
+
+    def write_chrome_trace(self, path: str) -> None:
+        with self._lock:
+            events = list(self._trace_events)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print(f"Build trace written to {path}")
+
+
+# metrics for the build running in this process
+metrics = BuildMetrics()
+
+
+def timed_stage(name: str):
+    """Decorator recording a build stage span. The wrapped function must take ``crate`` as its first argument."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            crate = kwargs["crate"] if "crate" in kwargs else args[0]
+            with metrics.span(name, crate=crate):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def write_build_reports(output_dir: str, crate=None) -> None:
+    """Write the JSON report and the Chrome trace next to the crate in ``output_dir``."""
+    base = output_dir.rstrip("/")
+    metrics.write_report(f"{base}-build-report.json", crate)
+    metrics.write_chrome_trace(f"{base}-build-trace.json")
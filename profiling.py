@@ -0,0 +1,166 @@
+# Opt-in profiling for the BGE RO-Crate builders
+import argparse
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+MAX_STACK_DEPTH = 128
+
+# call paths worth less than this fraction of the profile are folded into their first frame
+MIN_STACK_FRACTION = 1e-4
+
+
+def add_profile_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="run under cProfile and tracemalloc and write the results next to the crate output"
+        " (threads started during the build, such as prefetch and per-record workers, included)",
+    )
+
+
+def _frame_label(func: tuple) -> str:
+    filename, lineno, name = func
+    if filename == "~":  # built-in functions
+        return name
+    return f"{os.path.basename(filename)}:{lineno}({name})"
+
+
+def write_collapsed_stacks(stats: pstats.Stats, path: str) -> None:
+    """Write a collapsed-stack file (as used by flamegraph.pl and speedscope) from profile stats.
+
+    cProfile only records caller/callee pairs, so full stacks are reconstructed by
+    walking down from the root functions and splitting each function's time between
+    its callers in proportion to the time spent on each call edge.
+
+    A call graph shared by many callers has exponentially many paths, so a path is
+    only followed while its share of the profile is at least ``MIN_STACK_FRACTION``.
+    The whole time of a callee below that is written as the callee's own. As the
+    shares of a function's callees add up to at most its own share, each depth has
+    at most ``1 / MIN_STACK_FRACTION`` paths.
+
+    :param stats: profile statistics
+    :param path: file to write, one "frame;frame;frame microseconds" line per stack
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, (_, _, _, edge_cumtime) in callers.items():
+            callees.setdefault(caller, []).append((func, edge_cumtime))
+    roots = [func for func, values in stats.stats.items() if not values[4]]
+    min_time = sum(stats.stats[root][3] for root in roots) * MIN_STACK_FRACTION
+    labels = {func: _frame_label(func) for func in stats.stats}
+
+    totals = {}
+
+    def add(key, seconds):
+        if seconds * 1e6 >= 1:
+            totals[key] = totals.get(key, 0) + seconds * 1e6
+
+    def walk(func, key, on_stack, depth, scale):
+        _, _, tottime, cumtime, _ = stats.stats[func]
+        if cumtime * scale < min_time or depth >= MAX_STACK_DEPTH:
+            add(key, cumtime * scale)
+            return
+        add(key, tottime * scale)
+        on_stack.add(func)
+        for callee, edge_cumtime in callees.get(func, []):
+            callee_cumtime = stats.stats[callee][3]
+            if callee in on_stack or not callee_cumtime:
+                continue  # recursion is folded into the outermost frame
+            walk(
+                callee,
+                f"{key};{labels[callee]}",
+                on_stack,
+                depth + 1,
+                scale * edge_cumtime / callee_cumtime,
+            )
+        on_stack.discard(func)
+
+    for root in roots:
+        walk(root, labels[root], set(), 1, 1.0)
+
+    with open(path, "w") as f:
+        for key, value in sorted(totals.items()):
+            f.write(f"{key} {round(value)}\n")
+
+
+def write_allocation_sites(
+    snapshot: tracemalloc.Snapshot, path: str, limit: int = 50
+) -> None:
+    """Write the top allocation sites of a tracemalloc snapshot, largest first."""
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ]
+    )
+    stats = snapshot.statistics("traceback")
+    with open(path, "w") as f:
+        f.write(f"Total allocated: {sum(s.size for s in stats) / 1024:.1f} KiB\n\n")
+        for index, stat in enumerate(stats[:limit], 1):
+            f.write(f"#{index}: {stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+            for line in stat.traceback.format(most_recent_first=True):
+                f.write(f"{line}\n")
+            f.write("\n")
+
+
+def _profile_new_threads(profilers: list) -> None:
+    """Start a profiler in each thread started from now on, and add it to ``profilers``.
+
+    Before Python 3.12, cProfile only sees the calls of the thread that enabled it,
+    so the thread pools of a build would be missing from its profile.
+    """
+
+    def start(frame, event, arg):
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()  # replaces this hook for the rest of the thread
+
+    threading.setprofile(start)
+
+
+@contextmanager
+def profile_build(output_dir: str, enabled: bool = True):
+    """Run the enclosed block under cProfile and tracemalloc.
+
+    Results are written to ``<output_dir>-profile/``:
+    ``build.pstats`` (load with ``python -m pstats`` or snakeviz),
+    ``build.collapsed`` (feed to flamegraph.pl or speedscope) and
+    ``allocations.txt`` (top allocation sites).
+    Calls made in threads started within the block are included in the profile.
+
+    :param output_dir: crate output directory the profile belongs to
+    :param enabled: if False, the block runs without profiling
+    """
+    if not enabled:
+        yield
+        return
+
+    profile_dir = f"{output_dir.rstrip('/')}-profile"
+    profiler = cProfile.Profile()
+    thread_profilers = []
+    if sys.version_info < (3, 12):  # from 3.12 on, cProfile sees every thread
+        _profile_new_threads(thread_profilers)
+    tracemalloc.start(25)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        os.makedirs(profile_dir, exist_ok=True)
+        stats = pstats.Stats(profiler)
+        if thread_profilers:
+            stats.add(*thread_profilers)
+        stats.dump_stats(os.path.join(profile_dir, "build.pstats"))
+        write_collapsed_stacks(stats, os.path.join(profile_dir, "build.collapsed"))
+        write_allocation_sites(snapshot, os.path.join(profile_dir, "allocations.txt"))
+        print(f"Profile written to {profile_dir}/")
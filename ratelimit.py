@@ -0,0 +1,180 @@
+# Per-host rate limiting for upstream API calls
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# priority lanes - lower values are served first
+INTERACTIVE = 0
+BATCH = 1
+
+# requests per second and burst size for each API host
+# ENA documents a limit of 50 requests per second; BOLD and COPO publish no limit so stay conservative
+DEFAULT_HOST_LIMITS = {
+    "www.ebi.ac.uk": (20.0, 20),
+    "portal.boldsystems.org": (5.0, 5),
+    "copo-project.org": (5.0, 5),
+}
+DEFAULT_LIMIT = (5.0, 5)
+
+# never slow a host below this rate, however often it throttles us
+MIN_RATE = 0.2
+# after a 429 without a Retry-After header, pause the host for this many seconds
+DEFAULT_BACKOFF = 2.0
+
+
+class HostLimiter:
+    """Token bucket for a single host, with adaptive backoff and priority lanes.
+
+    Each request takes one token; tokens refill at ``rate`` per second up to ``burst``.
+    When the host answers 429 the rate is halved and the host is paused until its
+    Retry-After has passed. Each successful request then recovers 10% of the
+    configured rate. Waiting requests in a lower-numbered lane always get the next
+    token before requests in a higher-numbered lane.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.configured_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = {}
+        self.condition = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def _higher_priority_waiting(self, lane: int) -> bool:
+        return any(count for other, count in self.waiting.items() if other < lane)
+
+    def acquire(self, lane: int = INTERACTIVE) -> None:
+        with self.condition:
+            self.waiting[lane] = self.waiting.get(lane, 0) + 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if (
+                        now >= self.paused_until
+                        and self.tokens >= 1
+                        and not self._higher_priority_waiting(lane)
+                    ):
+                        self.tokens -= 1
+                        return
+                    wait = max(
+                        self.paused_until - now, (1 - self.tokens) / self.rate, 0.01
+                    )
+                    self.condition.wait(timeout=wait)
+            finally:
+                self.waiting[lane] -= 1
+                self.condition.notify_all()
+
+    def throttled(self, retry_after: float | None = None) -> None:
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self.tokens = 0
+            pause = retry_after if retry_after is not None else DEFAULT_BACKOFF
+            self.paused_until = max(self.paused_until, now + pause)
+            self.condition.notify_all()
+
+    def succeeded(self) -> None:
+        with self.condition:
+            if self.rate < self.configured_rate:
+                self._refill(time.monotonic())
+                self.rate = min(
+                    self.configured_rate, self.rate + self.configured_rate * 0.1
+                )
+
+
+class RateLimiter:
+    """Per-host token buckets shared by all fetchers in this process."""
+
+    def __init__(self, limits: dict[str, tuple[float, int]] | None = None):
+        self._lock = threading.Lock()
+        self._limits = dict(DEFAULT_HOST_LIMITS if limits is None else limits)
+        self._hosts = {}
+        self._local = threading.local()
+
+    def configure(self, host: str, rate: float, burst: int | None = None) -> None:
+        """Set the limit for a host.
+
+        :param host: host name, e.g. "www.ebi.ac.uk"
+        :param rate: requests per second
+        :param burst: number of requests which may be sent back to back. Defaults to ``rate`` (at least 1).
+        """
+        burst = burst if burst is not None else max(1, int(rate))
+        with self._lock:
+            self._limits[host] = (rate, burst)
+            self._hosts.pop(host, None)
+
+    def limit(self, host: str) -> tuple[float, int]:
+        """Configured (rate, burst) for a host."""
+        with self._lock:
+            return self._limits.get(host, DEFAULT_LIMIT)
+
+    def host(self, host: str) -> HostLimiter:
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = HostLimiter(*self._limits.get(host, DEFAULT_LIMIT))
+            return self._hosts[host]
+
+    @property
+    def lane(self) -> int:
+        return getattr(self._local, "lane", INTERACTIVE)
+
+    @contextmanager
+    def priority(self, lane: int):
+        """Send requests made by this thread inside the block in the given lane."""
+        previous = self.lane
+        self._local.lane = lane
+        try:
+            yield
+        finally:
+            self._local.lane = previous
+
+    def in_current_lane(self, func):
+        """Wrap ``func`` to send its requests in this thread's lane from whichever thread calls it.
+
+        The lane is kept per thread, so work handed to a thread pool would otherwise
+        run in the interactive lane.
+        """
+        lane = self.lane
+
+        @functools.wraps(func)
+        def in_lane(*args, **kwargs):
+            with self.priority(lane):
+                return func(*args, **kwargs)
+
+        return in_lane
+
+    def acquire(self, host: str) -> None:
+        self.host(host).acquire(self.lane)
+
+    def throttled(self, host: str, retry_after: float | None = None) -> None:
+        self.host(host).throttled(retry_after)
+
+    def succeeded(self, host: str) -> None:
+        self.host(host).succeeded()
+
+
+def parse_limits(spec: str) -> dict[str, tuple[float, int]]:
+    """Parse host limits of the form "host=rate[:burst],host=rate[:burst]"."""
+    limits = {}
+    for item in filter(None, (i.strip() for i in spec.split(","))):
+        host, _, limit = item.partition("=")
+        rate, _, burst = limit.partition(":")
+        limits[host] = (float(rate), int(burst) if burst else max(1, int(float(rate))))
+    return limits
+
+
+# limiter used by all fetchers in this process
+# override limits with e.g. BGE_RATE_LIMITS="www.ebi.ac.uk=10:10,portal.boldsystems.org=2"
+rate_limiter = RateLimiter(
+    {**DEFAULT_HOST_LIMITS, **parse_limits(os.environ.get("BGE_RATE_LIMITS", ""))}
+)
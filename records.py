@@ -0,0 +1,165 @@
+# Compact types for the upstream records the builders keep in memory
+import json
+import zlib
+
+
+class Record:
+    """An upstream record reduced to the fields the builders read.
+
+    Upstream APIs return hundreds of fields per record (ENA with ``fields=all``),
+    of which a build reads a handful. Those are kept in slots; the whole payload
+    is kept as compressed JSON and only decoded when some other field is asked
+    for, or for ``raw``. Records can be read like the dicts they replace:
+    ``record["field"]`` and ``record.get("field")`` work for any field.
+    """
+
+    __slots__ = ("_payload",)
+    fields: tuple[str, ...] = ()
+    _field_set = frozenset()
+
+    def __init__(self, payload: dict):
+        for name in self.fields:
+            setattr(self, name, payload.get(name))
+        self._payload = zlib.compress(
+            json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        )
+
+    @property
+    def raw(self) -> dict:
+        """The record as the API returned it, decoded again on each access."""
+        return json.loads(zlib.decompress(self._payload))
+
+    def __getitem__(self, key: str):
+        if key in self._field_set:
+            return getattr(self, key)
+        return self.raw[key]
+
+    def get(self, key: str, default=None):
+        if key in self._field_set:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.raw.get(key, default)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self._payload == other._payload
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.fields)
+        return f"{type(self).__name__}({fields})"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._field_set = frozenset(cls.fields)
+
+
+# date fields entities are dated by, in order of preference (ENA first, then BOLD).
+# Every record type keeps all of them in slots, so dating an entity never decodes a payload.
+DATE_FIELDS = (
+    "last_updated",
+    "first_public",
+    "sequence_upload_date",
+    "collection_date_start",
+)
+
+
+# slot names are listed in fields and __slots__ alike, so no instance has a __dict__
+class EnaSample(Record):
+    fields = (
+        "sample_accession",
+        "sample_description",
+        "scientific_name",
+        "study_accession",
+        "location",
+        "collected_by",
+        "identified_by",
+        "related_sample_accession",
+        *DATE_FIELDS,
+    )
+    __slots__ = fields
+
+
+class EnaReadExperiment(Record):
+    fields = (
+        "experiment_accession",
+        "run_accession",
+        "sample_accession",
+        "study_accession",
+        "experiment_title",
+        "fastq_ftp",
+        "fastq_bytes",
+        "fastq_md5",
+        *DATE_FIELDS,
+    )
+    __slots__ = fields
+
+
+class EnaAssembly(Record):
+    fields = (
+        "assembly_accession",
+        "assembly_set_accession",
+        "assembly_title",
+        "description_comment",
+        "run_accession",
+        "wgs_set",
+        "study_accession",
+        *DATE_FIELDS,
+    )
+    __slots__ = fields
+
+
+class EnaWgsSet(Record):
+    fields = (
+        "wgs_set",
+        "description",
+        "set_fasta_ftp",
+        *DATE_FIELDS,
+    )
+    __slots__ = fields
+
+
+class BoldDocument(Record):
+    fields = (
+        "processid",
+        "sampleid",
+        "record_id",
+        "species",
+        "taxid",
+        "coord",
+        "collectors",
+        "identified_by",
+        "sampling_protocol",
+        "sequence_run_site",
+        "insdc_acs",
+        "nuc",
+        *DATE_FIELDS,
+    )
+    __slots__ = fields
+
+
+# record type of each ENA result type
+ENA_RECORD_TYPES = {
+    "sample": EnaSample,
+    "read_experiment": EnaReadExperiment,
+    "assembly": EnaAssembly,
+    "wgs_set": EnaWgsSet,
+}
+
+RECORD_TYPES = {cls.__name__: cls for cls in [*ENA_RECORD_TYPES.values(), BoldDocument]}
+
+
+def ena_record(result_type: str, payload: dict) -> Record | dict:
+    """The record type for an ENA result, or the payload itself for result types the builders do not read."""
+    record_type = ENA_RECORD_TYPES.get(result_type)
+    return record_type(payload) if record_type else payload
+
+
+def dump_record(record) -> tuple[str | None, object]:
+    """(type name, JSON value) to store a record under, see ``load_record``."""
+    if isinstance(record, Record):
+        return type(record).__name__, record.raw
+    return None, record
+
+
+def load_record(record_type: str | None, value):
+    """A record stored with ``dump_record``. Values stored without a type are returned as they are."""
+    return RECORD_TYPES[record_type](value) if record_type else value
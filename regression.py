@@ -0,0 +1,363 @@
+# Golden-output and performance regression checks of the builders, on recorded upstream records
+import argparse
+from datetime import datetime, timezone
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from diff_crates import diff_crates
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+REGRESSION_DIR = os.path.join(REPO_DIR, "regression")
+DEFAULT_RECORDING = os.path.join(REGRESSION_DIR, "upstream.jsonl.gz")
+DEFAULT_HISTORY = os.path.join(REGRESSION_DIR, "history.jsonl")
+
+# builder script of each build
+BUILDS = {
+    "genome": "make_crate_genome.py",
+    "barcode": "make_crate_barcode.py",
+}
+
+# crate shipped with the scripts which each build reproduces, from the same upstream records
+EXAMPLES = {
+    "genome": "example-bge-crate-genome",
+    "barcode": "example-bge-crate-barcode",
+}
+
+# files kept for each build when its output is accepted
+METADATA_FILE = "ro-crate-metadata.json"
+VALIDATION_FILE = "validation-issues.txt"
+EXAMPLE_DIFF_FILE = "example-diff.txt"
+
+# as printed by the builders, see CrateValidator.validate
+VALIDATION_ISSUE = re.compile(r"^Detected issue of severity .*$", re.MULTILINE)
+VALIDATED = re.compile(r"^RO-Crate is (in)?valid!$", re.MULTILINE)
+# object addresses, which some issue messages include
+OBJECT_ADDRESS = re.compile(r" at 0x[0-9a-f]+")
+
+# measurements compared with earlier runs, from the build report and the run itself
+MEASUREMENTS = ["seconds", "peak_memory_bytes", "record_lookups"]
+
+DEFAULT_THRESHOLD = 0.2
+BASELINE_RUNS = 5
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def golden_path(name: str, filename: str = METADATA_FILE) -> str:
+    """What the builder made from the recording when its output was last accepted.
+
+    :param name: one of ``BUILDS``
+    :param filename: the metadata, its validation issues or its difference from the example crate
+    """
+    return os.path.join(REGRESSION_DIR, "golden", name, filename)
+
+
+def _builder_env() -> dict:
+    # no taxonomy index, wherever the developer keeps one, so the output only depends on the recording
+    env = dict(os.environ)
+    env.pop("BGE_TAXONOMY_DB", None)
+    env.pop("SOURCE_DATE_EPOCH", None)
+    return env
+
+
+def record_upstream(recording: str = DEFAULT_RECORDING) -> None:
+    """Run both builders online, recording every upstream record they fetch.
+
+    :param recording: snapshot bundle to record to, replaced if it exists
+    """
+    os.makedirs(os.path.dirname(recording) or ".", exist_ok=True)
+    if os.path.exists(recording):
+        os.remove(recording)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, script in BUILDS.items():
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.join(REPO_DIR, script),
+                    "-o",
+                    os.path.join(tmp_dir, name),
+                    "--save-snapshot",
+                    os.path.abspath(recording),
+                ],
+                check=True,
+                cwd=tmp_dir,
+                env=_builder_env(),
+            )
+
+
+def run_build(
+    name: str, output_dir: str, recording: str
+) -> tuple[dict, list[str] | None]:
+    """Run a builder on the recorded upstream records and measure it.
+
+    :param name: one of ``BUILDS``
+    :param output_dir: folder to build the crate in
+    :param recording: snapshot bundle written by ``record_upstream``
+    :raises subprocess.CalledProcessError: the build failed, its output is printed
+    :return: the measurements, see ``MEASUREMENTS``, and the issues validation
+        found, sorted, or None if the crate was not validated
+    """
+    script = BUILDS[name]
+    start = time.perf_counter()
+    build = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(REPO_DIR, script),
+            "-o",
+            output_dir,
+            "--snapshot",
+            os.path.abspath(recording),
+            "--reproducible",
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+        cwd=os.path.dirname(output_dir.rstrip("/")),
+        env=_builder_env(),
+    )
+    seconds = time.perf_counter() - start
+    if build.returncode:
+        sys.stdout.write(build.stdout)
+        raise subprocess.CalledProcessError(build.returncode, build.args, build.stdout)
+    issues = None
+    if VALIDATED.search(build.stdout):
+        issues = sorted(
+            {
+                OBJECT_ADDRESS.sub("", issue)
+                for issue in VALIDATION_ISSUE.findall(build.stdout)
+            }
+        )
+    with open(f"{output_dir.rstrip('/')}-build-report.json") as f:
+        report = json.load(f)
+    measurements = {
+        "seconds": round(seconds, 3),
+        "peak_memory_bytes": report["peak_memory_bytes"],
+        "record_lookups": report["cache"]["hits"] + report["cache"]["misses"],
+        "entities": report["entities"],
+    }
+    return measurements, issues
+
+
+def _read_lines(path: str) -> list[str] | None:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def _check_lines(
+    name: str, what: str, path: str, lines: list[str], accept: bool
+) -> bool:
+    """Compare lines describing a build with the ones accepted earlier, or accept them.
+
+    :return: True if they match or were accepted
+    """
+    expected = _read_lines(path)
+    if lines == expected:
+        return True
+    if accept:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.writelines(line + "\n" for line in lines)
+        print(f"{name}: {what} updated")
+        return True
+    if expected is None:
+        print(f"{name}: no {what} at {path}, make them with 'run --accept'")
+        return False
+    print(f"{name}: {what} differ from {path}")
+    for line in lines:
+        if line not in expected:
+            print(f"  + {line}")
+    for line in expected:
+        if line not in lines:
+            print(f"  - {line}")
+    return False
+
+
+def _read_history(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(
+    measurements: dict,
+    history: list[dict],
+    threshold: float = DEFAULT_THRESHOLD,
+    baseline_runs: int = BASELINE_RUNS,
+) -> list[str]:
+    """Measurements which are worse than the median of recent runs by more than ``threshold``.
+
+    :param measurements: measurements of this run, by build name
+    :param history: earlier runs, oldest first, as written to the history file
+    :param threshold: allowed increase, as a fraction of the baseline
+    :param baseline_runs: number of recent runs the baseline is the median of
+    :return: one description per regression
+    """
+    regressions = []
+    for name, current in measurements.items():
+        earlier = [run["builds"][name] for run in history if name in run["builds"]]
+        earlier = earlier[-baseline_runs:]
+        for measurement in MEASUREMENTS:
+            values = [run[measurement] for run in earlier if run.get(measurement)]
+            if not values or not current.get(measurement):
+                continue
+            baseline = statistics.median(values)
+            if current[measurement] > baseline * (1 + threshold):
+                regressions.append(
+                    f"{name} {measurement}: {current[measurement]} against {baseline} "
+                    f"(+{current[measurement] / baseline - 1:.0%})"
+                )
+    return regressions
+
+
+def run_regression(
+    recording: str = DEFAULT_RECORDING,
+    history_path: str = DEFAULT_HISTORY,
+    threshold: float = DEFAULT_THRESHOLD,
+    accept: bool = False,
+) -> bool:
+    """Build both crates from the recording, compare them with the goldens and with earlier runs.
+
+    The builds are reproducible, so their metadata is compared with the goldens
+    entity by entity, timestamps included. The issues validation finds and the
+    differences from the example crates (see ``EXAMPLES``) are compared with the
+    ones accepted with the goldens. Measurements are appended to the history file.
+
+    :param recording: snapshot bundle written by ``record_upstream``
+    :param history_path: JSONL file of the measurements of earlier runs
+    :param threshold: allowed increase of a measurement, as a fraction of the median of recent runs
+    :param accept: make the new metadata, validation issues and differences from the examples the goldens, instead of failing on changes
+    :raises FileNotFoundError: there is no recording
+    :return: True if the output matched and nothing regressed
+    """
+    if not os.path.exists(recording):
+        raise FileNotFoundError(
+            f"No upstream recording at {recording}, make one with 'python regression.py record'."
+        )
+    ok = True
+    measurements = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name in BUILDS:
+            output_dir = os.path.join(tmp_dir, name)
+            measurements[name], issues = run_build(name, output_dir, recording)
+            output = os.path.join(output_dir, METADATA_FILE)
+            if issues is None:
+                print(f"{name}: the build did not validate the crate")
+                ok = False
+            elif not _check_lines(
+                name,
+                "validation issues",
+                golden_path(name, VALIDATION_FILE),
+                issues,
+                accept,
+            ):
+                ok = False
+            example = diff_crates(
+                os.path.join(REPO_DIR, EXAMPLES[name], METADATA_FILE),
+                output,
+                ignore_uuids=True,
+            )
+            example_diff = example.describe().splitlines() if example.changed else []
+            if not _check_lines(
+                name,
+                "differences from the example crate",
+                golden_path(name, EXAMPLE_DIFF_FILE),
+                example_diff,
+                accept,
+            ):
+                ok = False
+            golden = golden_path(name)
+            if not os.path.exists(golden):
+                diff = None
+            else:
+                diff = diff_crates(golden, output, ignore=set())
+                if not diff.changed:
+                    print(f"{name}: output matches the golden")
+                    continue
+            if accept:
+                os.makedirs(os.path.dirname(golden), exist_ok=True)
+                with open(output, "rb") as src, open(golden, "wb") as dest:
+                    dest.write(src.read())
+                print(
+                    f"{name}: golden updated" + (f", {diff.describe()}" if diff else "")
+                )
+            elif diff is None:
+                print(f"{name}: no golden at {golden}, make one with 'run --accept'")
+                ok = False
+            else:
+                print(f"{name}: output differs from the golden, {diff.describe()}")
+                ok = False
+
+    history = _read_history(history_path)
+    regressions = find_regressions(measurements, history, threshold)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    for name, values in measurements.items():
+        print(f"{name}: " + ", ".join(f"{k} {v}" for k, v in values.items()))
+
+    os.makedirs(os.path.dirname(history_path) or ".", exist_ok=True)
+    with open(history_path, "a") as f:
+        run = {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _git_commit(),
+            "builds": measurements,
+        }
+        f.write(json.dumps(run, separators=(",", ":")) + "\n")
+    return ok and not regressions
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Check the builders against their golden outputs and against earlier runs"
+    )
+    parser.add_argument("--recording", default=DEFAULT_RECORDING)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser(
+        "record", help="record the upstream records of both builds (needs network)"
+    )
+    run_parser = subparsers.add_parser(
+        "run", help="build from the recording, compare and measure"
+    )
+    run_parser.add_argument("--history", default=DEFAULT_HISTORY)
+    run_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed increase of time, memory or record lookups over recent runs (default: %(default)s)",
+    )
+    run_parser.add_argument(
+        "--accept",
+        action="store_true",
+        help="make the new output, its validation issues and its differences from the example crates the goldens",
+    )
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        record_upstream(args.recording)
+    elif not run_regression(
+        args.recording, args.history, threshold=args.threshold, accept=args.accept
+    ):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
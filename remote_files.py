@@ -0,0 +1,197 @@
+# Describing remote data files from upstream metadata, without downloading them
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from typing import NamedTuple
+import requests
+
+from rocrate.model import ContextEntity, Entity
+from rocrate.rocrate import ROCrate
+
+from ratelimit import rate_limiter
+from utils import http_request
+
+DEFAULT_HEAD_WORKERS = 8
+
+
+class FileFormat(NamedTuple):
+    media_type: str
+    uri: str  # EDAM format
+    name: str
+
+
+EDAM_FASTQ = "http://edamontology.org/format_1930"
+EDAM_FASTA = "http://edamontology.org/format_1929"
+EDAM_EMBL = "http://edamontology.org/format_1927"
+EDAM_BAM = "http://edamontology.org/format_2572"
+EDAM_CRAM = "http://edamontology.org/format_3462"
+
+# MD5 algorithm identifier of XML Signature (RFC 6931), the propertyID of MD5 checksums
+MD5_PROPERTY = "http://www.w3.org/2001/04/xmldsig-more#md5"
+
+# formats of ENA downloads by file name suffix, longest suffixes first
+FILE_FORMATS = [
+    (".fastq.gz", FileFormat("application/gzip", EDAM_FASTQ, "FASTQ")),
+    (".fq.gz", FileFormat("application/gzip", EDAM_FASTQ, "FASTQ")),
+    (".fasta.gz", FileFormat("application/gzip", EDAM_FASTA, "FASTA")),
+    (".fa.gz", FileFormat("application/gzip", EDAM_FASTA, "FASTA")),
+    (".dat.gz", FileFormat("application/gzip", EDAM_EMBL, "EMBL")),
+    (".bam", FileFormat("application/octet-stream", EDAM_BAM, "BAM")),
+    (".cram", FileFormat("application/octet-stream", EDAM_CRAM, "CRAM")),
+    (".fastq", FileFormat("text/plain", EDAM_FASTQ, "FASTQ")),
+    (".fasta", FileFormat("text/x-fasta", EDAM_FASTA, "FASTA")),
+]
+
+
+class RemoteFile(NamedTuple):
+    url: str
+    size: int | None
+    md5: str | None
+
+
+def file_format(path: str) -> FileFormat | None:
+    for suffix, fmt in FILE_FORMATS:
+        if path.lower().endswith(suffix):
+            return fmt
+    return None
+
+
+def ena_files(
+    record: dict,
+    url_field: str,
+    bytes_field: str | None = None,
+    md5_field: str | None = None,
+) -> list[RemoteFile]:
+    """Files listed in an ENA record, with their sizes and MD5 checksums where ENA provides them.
+
+    ENA lists the files of a record as ";"-separated values in parallel fields,
+    e.g. ``fastq_ftp``, ``fastq_bytes`` and ``fastq_md5`` of a read experiment.
+    URLs are given without a scheme and are served over FTP.
+
+    :param record: ENA record
+    :param url_field: field with the file locations, e.g. "fastq_ftp"
+    :param bytes_field: field with the file sizes, e.g. "fastq_bytes"
+    :param md5_field: field with the MD5 checksums, e.g. "fastq_md5"
+    :return: one entry per file
+    """
+
+    def split(field):
+        values = record.get(field) if field else None
+        return values.split(";") if values else []
+
+    urls = split(url_field)
+    sizes = split(bytes_field)
+    md5s = split(md5_field)
+    return [
+        RemoteFile(
+            url if "://" in url else f"ftp://{url}",
+            int(sizes[i]) if i < len(sizes) and sizes[i] else None,
+            md5s[i] if i < len(md5s) and md5s[i] else None,
+        )
+        for i, url in enumerate(urls)
+        if url
+    ]
+
+
+def add_format_entity(crate: ROCrate, fmt: FileFormat) -> Entity:
+    return crate.get(fmt.uri) or crate.add(
+        ContextEntity(
+            crate,
+            fmt.uri,
+            properties={"name": f"{fmt.name} file format", "@type": "Standard"},
+        )
+    )
+
+
+def add_md5_entity(crate: ROCrate, md5: str) -> Entity:
+    """PropertyValue holding an MD5 checksum, as md5 is no term of the crate's context."""
+    return crate.get(f"#md5-{md5}") or crate.add(
+        ContextEntity(
+            crate,
+            f"#md5-{md5}",
+            properties={
+                "@type": "PropertyValue",
+                "name": "MD5 checksum",
+                "propertyID": MD5_PROPERTY,
+                "value": md5,
+            },
+        )
+    )
+
+
+def remote_file_properties(crate: ROCrate, remote_file: RemoteFile) -> dict:
+    """contentSize, MD5 checksum (an additionalProperty) and encodingFormat properties for a remote File entity, as far as they are known."""
+    properties = {}
+    if remote_file.size is not None:
+        properties["contentSize"] = str(remote_file.size)
+    if remote_file.md5:
+        properties["additionalProperty"] = {
+            "@id": add_md5_entity(crate, remote_file.md5).id
+        }
+    if fmt := file_format(remote_file.url):
+        properties["encodingFormat"] = [
+            fmt.media_type,
+            {"@id": add_format_entity(crate, fmt).id},
+        ]
+    return properties
+
+
+##################
+# HEAD fallback  #
+##################
+
+
+def add_head_fallback_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--head-fallback",
+        action="store_true",
+        help="look up the size of remote files whose upstream metadata has none with HTTP HEAD requests",
+    )
+
+
+def https_url(url: str) -> str:
+    """HTTPS location of an ENA FTP URL (ENA serves its FTP areas over HTTPS too, which supports HEAD)."""
+    if url.startswith("ftp://"):
+        return f"https://{url[len('ftp://'):]}"
+    return url
+
+
+def _head(url: str) -> dict:
+    try:
+        r = http_request("HEAD", https_url(url), allow_redirects=True, timeout=30)
+    except requests.RequestException as e:
+        print(f"Warning: HEAD {https_url(url)} failed: {e}")
+        return {}
+    if r.status_code != 200:
+        print(f"Warning: HEAD {https_url(url)} answered {r.status_code}")
+        return {}
+    properties = {}
+    if size := r.headers.get("Content-Length"):
+        properties["contentSize"] = size
+    if last_modified := r.headers.get("Last-Modified"):
+        properties["dateModified"] = parsedate_to_datetime(last_modified).isoformat()
+    return properties
+
+
+def describe_with_head(
+    entities: list[Entity], workers: int = DEFAULT_HEAD_WORKERS
+) -> int:
+    """Fill in the size of remote File entities which have none, with concurrent HEAD requests.
+
+    Only headers are transferred. Requests are paced by the per-host rate limiter.
+
+    :param entities: File entities whose ids are remote URLs
+    :param workers: number of concurrent requests
+    :return: number of entities updated
+    """
+    missing = [e for e in entities if not e.get("contentSize")]
+    if not missing:
+        return 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(rate_limiter.in_current_lane(_head), (e.id for e in missing))
+        )
+    for entity, properties in zip(missing, results):
+        for key, value in properties.items():
+            entity[key] = value
+    return sum(1 for properties in results if properties)
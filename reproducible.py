@@ -0,0 +1,199 @@
+# Reproducible crate builds: ids and dates derived from the inputs instead of the time of the build
+import argparse
+from datetime import datetime, timezone
+import filecmp
+import hashlib
+import json
+import os
+import uuid
+
+from rocrate.rocrate import ROCrate
+
+from records import DATE_FIELDS
+
+# namespace for the name-based (version 5) UUIDs of local entity ids
+ID_NAMESPACE = uuid.uuid5(
+    uuid.NAMESPACE_URL, "https://github.com/eScienceLab/bge-ro-package-profile"
+)
+
+# date fields of upstream records, in order of preference, all kept in slots by the record types
+RECORD_DATE_FIELDS = DATE_FIELDS
+
+
+def add_reproducible_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="derive ids and dates from the inputs, so identical inputs give an identical crate "
+        "(which is then not rewritten, nor revalidated once it passed validation)",
+    )
+
+
+def source_date_epoch() -> str | None:
+    """Date given by the SOURCE_DATE_EPOCH convention (https://reproducible-builds.org/specs/source-date-epoch/), if set."""
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if not epoch:
+        return None
+    return datetime.fromtimestamp(int(epoch), timezone.utc).isoformat()
+
+
+def _record_date(record) -> str | None:
+    for field in RECORD_DATE_FIELDS:
+        if date := record.get(field):
+            return date
+    return None
+
+
+class ReproducibleBuild:
+    """Mints local ids and timestamps for crate entities.
+
+    By default ids are random and timestamps are the time of the build, as before.
+    With reproducible builds enabled, ids are name-based UUIDs of the accessions
+    the entity describes and timestamps are taken from the upstream records, so
+    building the same inputs twice gives byte-identical metadata.
+    """
+
+    def __init__(self):
+        self.enabled = False
+
+    def enable(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+
+    def local_id(self, kind: str, *keys: str) -> str:
+        """Id for a local (``#``) entity, e.g. ``#sequencing-process-<uuid>``.
+
+        :param kind: kind of entity, used as the id prefix
+        :param keys: accessions or other inputs which identify the entity among others of its kind
+        """
+        if self.enabled:
+            return f"#{kind}-{uuid.uuid5(ID_NAMESPACE, '/'.join((kind, *keys)))}"
+        return f"#{kind}-{uuid.uuid4()}"
+
+    def timestamp(self, *records: dict) -> str:
+        """Timestamp for an entity built from the given upstream records.
+
+        :param records: upstream records the entity was built from. The newest of their dates is used.
+        :raises ValueError: reproducible builds are enabled, but there is no date to use
+        :return: the date, or the current time if reproducible builds are disabled
+        """
+        if not self.enabled:
+            return str(datetime.now())
+        dates = [d for d in map(_record_date, records) if d]
+        date = max(dates) if dates else source_date_epoch()
+        if not date:
+            raise ValueError(
+                "No upstream date available for a reproducible timestamp, set SOURCE_DATE_EPOCH."
+            )
+        return date
+
+    def file_timestamp(self, path: str) -> str:
+        """Timestamp for an entity built from a local file: the file's modification time, or SOURCE_DATE_EPOCH if set."""
+        if not self.enabled:
+            return str(datetime.now())
+        return (
+            source_date_epoch()
+            or datetime.fromtimestamp(
+                int(os.stat(path).st_mtime), timezone.utc
+            ).isoformat()
+        )
+
+    def finalize(self, crate: ROCrate) -> None:
+        """Date the crate itself by the newest input it was built from, rather than the time of the build.
+
+        The inputs' dates are the ``sdDatePublished`` of the crate's entities, so
+        crates built concurrently in one process each get their own date.
+        """
+        if self.enabled:
+            dates = [
+                date
+                for entity in crate.get_entities()
+                if isinstance(date := entity.get("sdDatePublished"), str)
+            ]
+            crate.datePublished = source_date_epoch() or max(dates, default=None)
+
+
+# settings used by all builders in this process
+reproducible = ReproducibleBuild()
+
+
+def _data_files_unchanged(crate: ROCrate, output_dir: str) -> bool:
+    for entity in crate.data_entities:
+        source = getattr(entity, "source", None)
+        if not source or not os.path.isfile(source):
+            continue  # remote or metadata-only entity, nothing is copied
+        dest = os.path.join(output_dir, entity.id)
+        if not os.path.isfile(dest) or not filecmp.cmp(source, dest, shallow=False):
+            return False
+    return True
+
+
+def write_crate_if_changed(crate: ROCrate, output_dir: str) -> bool:
+    """Write a crate unless ``output_dir`` already holds an identical one.
+
+    The crate counts as unchanged if its generated metadata equals the existing
+    ro-crate-metadata.json and every local data file is already there with the
+    same content. Without reproducible builds the metadata always differs (fresh
+    ids and dates), so the crate is always written. An unchanged crate still
+    needs validating unless it passed before, see ``passed_validation``.
+
+    :param crate: crate to write
+    :param output_dir: folder to write the crate to
+    :return: True if the crate was written, False if it was unchanged
+    """
+    metadata_path = os.path.join(output_dir, "ro-crate-metadata.json")
+    if os.path.exists(metadata_path):
+        with open(metadata_path, encoding="utf-8") as f:
+            existing = json.load(f)
+        if existing == crate.metadata.generate() and _data_files_unchanged(
+            crate, output_dir
+        ):
+            print(f"RO-Crate in {output_dir} is unchanged, not rewriting it")
+            return False
+    crate.write(output_dir)
+    return True
+
+
+def validation_marker_path(output_dir: str) -> str:
+    return f"{output_dir.rstrip('/')}-validated.json"
+
+
+def _metadata_sha256(output_dir: str) -> str | None:
+    metadata_path = os.path.join(output_dir, "ro-crate-metadata.json")
+    if not os.path.isfile(metadata_path):
+        return None
+    with open(metadata_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def passed_validation(output_dir: str) -> bool:
+    """Whether the crate in ``output_dir`` passed validation, as recorded by ``record_validation``.
+
+    Only the metadata which was validated counts: once the crate is rewritten
+    with different metadata, it has to be validated again.
+    """
+    try:
+        with open(validation_marker_path(output_dir), encoding="utf-8") as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    sha256 = _metadata_sha256(output_dir)
+    return sha256 is not None and marker.get("metadata_sha256") == sha256
+
+
+def record_validation(output_dir: str, passed: bool) -> None:
+    """Record the outcome of validating the crate in ``output_dir``, next to it.
+
+    A crate which failed validation (or whose validation never finished, so
+    nothing was recorded) is validated again by the next build.
+
+    :param output_dir: crate folder which was validated
+    :param passed: whether the crate passed validation
+    """
+    marker_path = validation_marker_path(output_dir)
+    sha256 = _metadata_sha256(output_dir) if passed else None
+    if sha256 is None:
+        if os.path.exists(marker_path):
+            os.remove(marker_path)
+        return
+    with open(marker_path, "w", encoding="utf-8") as f:
+        json.dump({"metadata_sha256": sha256}, f)
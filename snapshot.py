@@ -0,0 +1,62 @@
+# Snapshot bundles of upstream metadata, for building crates without network access
+import argparse
+import gzip
+import json
+import os
+from typing import Iterable
+
+from records import dump_record, load_record
+
+
+def add_snapshot_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--snapshot",
+        metavar="PATH",
+        help="build offline, taking all upstream metadata from this snapshot bundle",
+    )
+    parser.add_argument(
+        "--save-snapshot",
+        metavar="PATH",
+        help="add the upstream metadata fetched by this build to a snapshot bundle (created if missing)",
+    )
+
+
+def read_snapshot(path: str) -> list[tuple[tuple, object]]:
+    """Read a snapshot bundle.
+
+    :param path: gzipped JSONL file written by ``write_snapshot``
+    :return: (cache key, record) pairs
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [
+            (tuple(entry["key"]), load_record(entry.get("type"), entry["record"]))
+            for entry in map(json.loads, f)
+        ]
+
+
+def write_snapshot(path: str, entries: Iterable[tuple[tuple, object]]) -> int:
+    """Write records to a snapshot bundle, merged with the records already in it.
+
+    Records are written one JSON object per line, sorted by key, so bundles
+    built from the same records are identical. Where both have a record for the
+    same key, the new record wins.
+
+    :param path: gzipped JSONL file
+    :param entries: (cache key, record) pairs
+    :return: number of records in the bundle
+    """
+    records = dict(read_snapshot(path)) if os.path.exists(path) else {}
+    records.update(entries)
+    tmp_path = f"{path}.tmp"
+    # mtime=0 keeps the gzip header, and so the file, independent of the time of writing
+    with open(tmp_path, "wb") as raw, gzip.GzipFile(
+        fileobj=raw, mode="wb", mtime=0
+    ) as f:
+        for key in sorted(records, key=lambda key: json.dumps(key)):
+            record_type, value = dump_record(records[key])
+            entry = {"key": list(key), "record": value}
+            if record_type:
+                entry["type"] = record_type
+            f.write((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+    os.replace(tmp_path, path)
+    return len(records)
@@ -0,0 +1,363 @@
+# Local taxonomy index for resolving species names to taxon ids offline
+import argparse
+from contextlib import contextmanager
+import csv
+import io
+import os
+import sqlite3
+import tarfile
+from typing import Callable, Iterable, Iterator, NamedTuple
+from urllib.parse import quote
+
+from rocrate.model import ContextEntity
+from rocrate.rocrate import ROCrate
+
+DEFAULT_TAXONOMY_DB = os.environ.get("BGE_TAXONOMY_DB", "taxonomy.sqlite")
+
+TAXON_URIS = {
+    "ncbi": "https://www.ncbi.nlm.nih.gov/taxonomy/{taxid}",
+    "bold": "https://bench.boldsystems.org/index.php/TaxBrowser_TaxonPage?taxid={taxid}",
+}
+
+# NCBI name classes which identify a taxon (common names and misspellings are left out)
+NCBI_NAME_CLASSES = {
+    "scientific name",
+    "synonym",
+    "equivalent name",
+    "genbank synonym",
+    "anamorph",
+    "teleomorph",
+}
+
+SCHEMA = """
+CREATE TABLE taxa (
+    source TEXT NOT NULL,
+    taxid TEXT NOT NULL,
+    scientific_name TEXT NOT NULL,
+    rank TEXT,
+    parent_taxid TEXT,
+    PRIMARY KEY (source, taxid)
+) WITHOUT ROWID;
+CREATE TABLE names (
+    name TEXT NOT NULL COLLATE NOCASE,
+    source TEXT NOT NULL,
+    taxid TEXT NOT NULL,
+    is_scientific INTEGER NOT NULL
+);
+"""
+INDEXES = """
+CREATE INDEX names_by_name ON names (name COLLATE NOCASE, is_scientific DESC);
+"""
+
+
+class Taxon(NamedTuple):
+    source: str  # "ncbi" or "bold"
+    taxid: str
+    scientific_name: str
+    rank: str | None
+
+    @property
+    def uri(self) -> str:
+        return TAXON_URIS[self.source].format(taxid=self.taxid)
+
+
+###############
+# index build #
+###############
+
+
+def _split_dmp(line: str) -> list[str]:
+    return [field.strip() for field in line.rstrip("\t|\n").split("\t|\t")]
+
+
+@contextmanager
+def _open_taxdump(taxdump: str) -> Iterator[Callable[[str], io.TextIOBase]]:
+    """Open an NCBI taxdump (tar.gz or extracted folder), yielding a function which opens one of its files."""
+    if os.path.isdir(taxdump):
+        yield lambda member: open(os.path.join(taxdump, member), encoding="utf-8")
+        return
+    with tarfile.open(taxdump) as archive:
+        yield lambda member: io.TextIOWrapper(
+            archive.extractfile(member), encoding="utf-8"
+        )
+
+
+def _ncbi_names(names_dmp: Iterable[str], scientific_names: dict) -> Iterator[tuple]:
+    """Rows of the names table from names.dmp, collecting the scientific name of each taxid on the way."""
+    for line in names_dmp:
+        taxid, name, _, name_class = _split_dmp(line)[:4]
+        if name_class == "scientific name":
+            scientific_names[taxid] = name
+        if name_class in NCBI_NAME_CLASSES:
+            yield name, "ncbi", taxid, int(name_class == "scientific name")
+
+
+def _ncbi_taxa(nodes_dmp: Iterable[str], scientific_names: dict) -> Iterator[tuple]:
+    for line in nodes_dmp:
+        taxid, parent_taxid, rank = _split_dmp(line)[:3]
+        yield "ncbi", taxid, scientific_names.get(taxid, ""), rank, parent_taxid
+
+
+def _read_bold_tsv(bold_tsv: str) -> list[dict]:
+    with open(bold_tsv, newline="", encoding="utf-8") as f:
+        return list(csv.DictReader(f, delimiter="\t"))
+
+
+def build_taxonomy_index(
+    db_path: str, ncbi_taxdump: str | None = None, bold_tsv: str | None = None
+) -> None:
+    """Build a SQLite taxonomy index from an NCBI taxdump and/or a BOLD taxonomy export.
+
+    :param db_path: SQLite file to create. An existing file is replaced once the new index is complete.
+    :param ncbi_taxdump: path to taxdump.tar.gz (or an extracted folder) from https://ftp.ncbi.nlm.nih.gov/pub/taxonomy/
+    :param bold_tsv: TSV with columns "taxid", "name", "rank" and optionally "parent_taxid" and "synonyms"
+        (separated by ";"), e.g. exported from the BOLD taxonomy browser
+    :raises ValueError: no taxonomy source given
+    """
+    if not ncbi_taxdump and not bold_tsv:
+        raise ValueError("At least one of an NCBI taxdump or a BOLD TSV is required.")
+
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    db.executescript("PRAGMA journal_mode = OFF; PRAGMA synchronous = OFF;")
+    db.executescript(SCHEMA)
+
+    if ncbi_taxdump:
+        # names.dmp is read once, for the names and for the scientific names of the taxa
+        scientific_names = {}
+        with _open_taxdump(ncbi_taxdump) as open_member:
+            with open_member("names.dmp") as f:
+                db.executemany(
+                    "INSERT INTO names VALUES (?, ?, ?, ?)",
+                    _ncbi_names(f, scientific_names),
+                )
+            with open_member("nodes.dmp") as f:
+                db.executemany(
+                    "INSERT INTO taxa VALUES (?, ?, ?, ?, ?)",
+                    _ncbi_taxa(f, scientific_names),
+                )
+
+    if bold_tsv:
+        rows = _read_bold_tsv(bold_tsv)
+        db.executemany(
+            "INSERT OR REPLACE INTO taxa VALUES (?, ?, ?, ?, ?)",
+            (
+                ("bold", r["taxid"], r["name"], r.get("rank"), r.get("parent_taxid"))
+                for r in rows
+            ),
+        )
+        db.executemany(
+            "INSERT INTO names VALUES (?, ?, ?, ?)",
+            (
+                (name.strip(), "bold", r["taxid"], int(name == r["name"]))
+                for r in rows
+                for name in [r["name"], *(r.get("synonyms") or "").split(";")]
+                if name.strip()
+            ),
+        )
+
+    db.executescript(INDEXES)
+    db.commit()
+    db.close()
+    os.replace(tmp_path, db_path)
+
+
+##########
+# lookup #
+##########
+
+
+class TaxonomyIndex:
+    """Read-only access to a taxonomy index built by ``build_taxonomy_index``.
+
+    Lookups are case-insensitive, match synonyms as well as scientific names,
+    and are memoised, so resolving the same name repeatedly is free.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = sqlite3.connect(
+            f"file:{db_path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._resolved = {}
+
+    def close(self) -> None:
+        self._db.close()
+
+    def resolve_all(self, name: str) -> tuple[Taxon, ...]:
+        """Resolve a name to at most one taxon per source, NCBI first.
+
+        Where a name is ambiguous within a source, the taxon for which it is the
+        scientific name wins over taxa for which it is a synonym.
+        """
+        if name in self._resolved:
+            return self._resolved[name]
+        rows = self._db.execute(
+            """
+            SELECT taxa.source, taxa.taxid, taxa.scientific_name, taxa.rank
+            FROM names JOIN taxa USING (source, taxid)
+            WHERE names.name = ?
+            ORDER BY taxa.source DESC, names.is_scientific DESC
+            """,
+            (name.strip(),),
+        ).fetchall()
+        taxa = {}
+        for row in rows:
+            taxa.setdefault(row[0], Taxon(*row))
+        self._resolved[name] = tuple(taxa.values())
+        return self._resolved[name]
+
+    def resolve(self, name: str, source: str | None = None) -> Taxon | None:
+        """Resolve a scientific name or synonym to a taxon.
+
+        :param name: name to look up
+        :param source: "ncbi" or "bold". By default the NCBI taxon is preferred.
+        :return: the taxon, or None if the name is not in the index
+        """
+        for taxon in self.resolve_all(name):
+            if source is None or taxon.source == source:
+                return taxon
+        return None
+
+
+# indexes opened by open_taxonomy_index, by path: (modification time, index)
+_open_indexes = {}
+
+
+def open_taxonomy_index(db_path: str | None = None) -> TaxonomyIndex | None:
+    """Open the taxonomy index, or return None (with a warning) if it has not been built.
+
+    Builds in the same process (e.g. the jobs of the build daemon) share one
+    open index per file, with its connection and resolved names, until the
+    file is rebuilt.
+    """
+    db_path = db_path or DEFAULT_TAXONOMY_DB
+    if not os.path.exists(db_path):
+        print(
+            f"Warning: no taxonomy index at {db_path}, taxon ids will not be resolved. "
+            "Build one with `python taxonomy.py build`."
+        )
+        return None
+    key = os.path.abspath(db_path)
+    mtime = os.stat(db_path).st_mtime_ns
+    if key in _open_indexes:
+        opened_mtime, index = _open_indexes[key]
+        if opened_mtime == mtime:
+            return index
+        index.close()
+    index = TaxonomyIndex(db_path)
+    _open_indexes[key] = (mtime, index)
+    return index
+
+
+def add_taxonomy_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--taxonomy-db",
+        default=DEFAULT_TAXONOMY_DB,
+        help="taxonomy index built with `python taxonomy.py build` (default: %(default)s)",
+    )
+
+
+#################
+# crate helpers #
+#################
+
+
+def add_taxon_entity(
+    crate: ROCrate, name: str, taxa: tuple[Taxon, ...]
+) -> ContextEntity:
+    """Add a Taxon entity for a name to the crate.
+
+    The entity id is the URI of the first resolved taxon; other sources are listed in sameAs.
+    Names which could not be resolved get a local id. If the crate already has an
+    entity for the taxon (e.g. added under a synonym), that entity is reused.
+
+    :param crate: crate to add the entity to
+    :param name: name as it appears in the input data
+    :param taxa: taxa resolved for the name, see ``TaxonomyIndex.resolve_all``
+    :return: the Taxon entity
+    """
+    taxon_id = taxa[0].uri if taxa else f"#taxon-{quote(name.replace(' ', '_'))}"
+    if existing := crate.get(taxon_id):
+        if name != existing.get("name"):
+            existing.append_to("alternateName", name)
+        return existing
+
+    if not taxa:
+        return crate.add(
+            ContextEntity(
+                crate,
+                taxon_id,
+                properties={"@type": "Taxon", "name": name, "scientificName": name},
+            )
+        )
+    taxon, *others = taxa
+    properties = {
+        "@type": "Taxon",
+        "name": name,
+        "scientificName": taxon.scientific_name,
+        "identifier": taxon.taxid,
+    }
+    if taxon.rank:
+        properties["taxonRank"] = taxon.rank
+    if others:
+        properties["sameAs"] = [{"@id": other.uri} for other in others]
+    return crate.add(ContextEntity(crate, taxon_id, properties=properties))
+
+
+def add_taxon_entities(
+    crate: ROCrate, names: Iterable[str], taxonomy: TaxonomyIndex | None = None
+) -> dict[str, ContextEntity]:
+    """Resolve many names at once and add a single Taxon entity per distinct taxon.
+
+    Names are deduplicated before resolution, so the cost is proportional to the
+    number of distinct names however often each one occurs in the input.
+
+    :param crate: crate to add the entities to
+    :param names: names, possibly with repeats
+    :param taxonomy: index to resolve the names against. If None, all names get local ids.
+    :return: mapping from each distinct name to its Taxon entity
+    """
+    return {
+        name: add_taxon_entity(
+            crate, name, taxonomy.resolve_all(name) if taxonomy else ()
+        )
+        for name in sorted(set(names))
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Build or query the local taxonomy index."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build the index")
+    build_parser.add_argument(
+        "--ncbi-taxdump", help="taxdump.tar.gz or extracted folder"
+    )
+    build_parser.add_argument("--bold-tsv", help="BOLD taxonomy export (TSV)")
+    build_parser.add_argument("--db", default=DEFAULT_TAXONOMY_DB)
+
+    lookup_parser = subparsers.add_parser("lookup", help="resolve names")
+    lookup_parser.add_argument("names", nargs="+")
+    lookup_parser.add_argument("--db", default=DEFAULT_TAXONOMY_DB)
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        build_taxonomy_index(args.db, args.ncbi_taxdump, args.bold_tsv)
+        print(f"Taxonomy index written to {args.db}")
+    else:
+        index = TaxonomyIndex(args.db)
+        for name in args.names:
+            taxa = [
+                f"{t.source}:{t.taxid} ({t.rank}) {t.uri}"
+                for t in index.resolve_all(name)
+            ]
+            print(name, *(taxa or ["not found"]), sep="\t")
+
+
+if __name__ == "__main__":
+    main()
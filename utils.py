@@ -1,52 +1,252 @@
 # Helper functions for BGE RO-Crate creation
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import functools
+import inspect
 import os
+from urllib.parse import urlparse
 import uuid
 import requests
+from requests.utils import stream_decode_response_unicode
 
 from rocrate.model import ContextEntity, Person
 from rocrate.rocrate import ROCrate
 from rocrate_validator import services, models
 
+from checkpoint import checkpoint, checkpoint_path
+from crate_validation import crate_validator
+from jsonld_cache import context_cache
+from metrics import metrics
+from snapshot import read_snapshot, write_snapshot
+from ratelimit import rate_limiter
+from records import BoldDocument, Record, ena_record
+
 
 #####################
 #  crate validation #
 #####################
 def validate_crate(crate_uri):
-    # Create an instance of `ValidationSettings` class to configure the validation
-    settings = services.ValidationSettings(
-        # Set the path to the RO-Crate root directory
-        rocrate_uri=crate_uri,
-        # Set the identifier of the RO-Crate profile to use for validation.
-        # If not set, the system will attempt to automatically determine the appropriate validation profile.
-        profile_identifier="ro-crate-1.1",
-        # Set the requirement level for the validation
-        requirement_severity=models.Severity.REQUIRED,
-        # requirement_severity=models.Severity.RECOMMENDED, # use for best practices!
-    )
-
-    # Call the validation service with the settings
-    result = services.validate(settings)
-
-    # Check if the validation was successful
-    if not result.has_issues():
-        print("RO-Crate is valid!")
-    else:
-        print("RO-Crate is invalid!")
-        # Explore the issues
-        for issue in result.get_issues():
-            # Every issue object has a reference to the check that failed, the severity of the issue, and a message describing the issue.
-            print(
-                f'Detected issue of severity {issue.severity.name} with check "{issue.check.identifier}": {issue.message}'
-            )
+    # offline builds validate against the validator's HTTP cache from an earlier online run
+    return crate_validator.validate(crate_uri, offline=_offline)
 
 
 ####################
 # helper functions #
 ####################
+
+# shared session so connections to the same API host are reused
+session = requests.Session()
+
+
+# give up on a host after this many consecutive 429 responses
+MAX_THROTTLE_RETRIES = 5
+
+
+def _retry_after_seconds(response: requests.Response) -> float | None:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return max(
+            0.0,
+            (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(),
+        )
+
+
+def _count_streamed_bytes(response: requests.Response) -> None:
+    """Record the body of a streamed response in the build metrics as it is read."""
+    iter_content = response.iter_content
+
+    def counted(chunk_size=1, decode_unicode=False):
+        def chunks():
+            for chunk in iter_content(chunk_size):
+                metrics.record_http_bytes(response, len(chunk))
+                yield chunk
+
+        if decode_unicode:
+            return stream_decode_response_unicode(chunks(), response)
+        return chunks()
+
+    # iter_lines reads through iter_content too
+    response.iter_content = counted
+
+
+def http_request(method: str, url: str, **kwargs) -> requests.Response:
+    """Send a request through the shared session.
+
+    Requests are paced by the per-host rate limiter and retried when the host answers
+    429 Too Many Requests. Every call is recorded in the build metrics. JSON-LD
+    contexts and vocabularies in the bundle (``jsonld_cache``) are served locally.
+
+    :param method: HTTP method, e.g. "GET"
+    :param url: URL to request
+    :return: the response
+    """
+    if method == "GET" and not kwargs.get("params"):
+        bundled = context_cache.response(url)
+        if bundled is not None:
+            return bundled
+    if _offline:
+        raise requests.ConnectionError(
+            f"Not requesting {url}: the build is offline (--snapshot)."
+        )
+    host = urlparse(url).hostname
+    for attempt in range(MAX_THROTTLE_RETRIES + 1):
+        rate_limiter.acquire(host)
+        r = session.request(method, url, **kwargs)
+        if kwargs.get("stream"):
+            # the body is counted as it is read, it has not arrived yet
+            metrics.record_http(r, nbytes=0)
+            _count_streamed_bytes(r)
+        else:
+            metrics.record_http(r)
+        if r.status_code != 429:
+            rate_limiter.succeeded(host)
+            return r
+        rate_limiter.throttled(host, _retry_after_seconds(r))
+        if attempt < MAX_THROTTLE_RETRIES:
+            r.close()  # hands a streamed response's connection back to the pool
+    return r
+
+
+def http_get(url: str, params: dict | None = None, **kwargs) -> requests.Response:
+    """GET a URL through the shared session, see ``http_request``.
+
+    :param url: URL to fetch
+    :param params: query parameters
+    :return: the response
+    """
+    return http_request("GET", url, params=params, **kwargs)
+
+
+# records already fetched in this process, keyed by fetcher name and arguments
+_record_cache = {}
+
+# set by load_snapshot: every record must come from the snapshot, nothing is fetched
+_offline = False
+
+# keys of the records load_snapshot put in the cache, which belong to that build only
+_snapshot_keys = set()
+
+
+def cached_record(func):
+    """Memoise a fetcher so each upstream record is only requested once per build.
+
+    Records obtained some other way (e.g. from a bulk harvest) can be put in the
+    cache with ``fetcher.prime(record, *args)``, where args are the arguments the
+    fetcher would have been called with.
+    """
+    signature = inspect.signature(func)
+
+    def cache_key(args, kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        return (func.__name__, *bound.arguments.values())
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = cache_key(args, kwargs)
+        if key in _record_cache:
+            metrics.record_cache(hit=True)
+            return _record_cache[key]
+        metrics.record_cache(hit=False)
+        if _offline:
+            raise ValueError(
+                f"{func.__name__}{key[1:]} is not in the snapshot, "
+                "and the build is offline. Add it with --save-snapshot on a machine with network access."
+            )
+        with metrics.span(func.__name__, category="fetch"):
+            record = func(*args, **kwargs)
+        _record_cache[key] = record
+        checkpoint.save_record(key, record)
+        return record
+
+    def prime(record, *args, **kwargs):
+        key = cache_key(args, kwargs)
+        if key not in _record_cache:
+            _record_cache[key] = record
+            checkpoint.save_record(key, record)
+
+    wrapper.prime = prime
+    return wrapper
+
+
+@contextmanager
+def resumable_build(output_dir: str, fresh: bool = False):
+    """Checkpoint every record fetched inside the block, resuming from an earlier interrupted build.
+
+    Records left in ``<output_dir>-checkpoint.jsonl`` by a failed run are loaded into
+    the fetcher cache first, so only what that run never fetched is requested again.
+    The state file is removed once the block completes without an error.
+
+    :param output_dir: crate output directory
+    :param fresh: discard the state file of an earlier run and fetch everything again
+    """
+    for key, record in checkpoint.open(checkpoint_path(output_dir), fresh):
+        _record_cache[key] = record
+    try:
+        yield checkpoint
+    except BaseException:
+        checkpoint.close(completed=False)
+        raise
+    checkpoint.close(completed=True)
+
+
+def load_snapshot(path: str) -> int:
+    """Take all upstream records from a snapshot bundle and stop using the network.
+
+    Any record which is not in the bundle then raises an error instead of being fetched.
+
+    :param path: bundle written by ``save_snapshot``
+    :return: number of records loaded
+    """
+    global _offline
+    records = read_snapshot(path)
+    _record_cache.update(records)
+    _snapshot_keys.update(key for key, _ in records)
+    _offline = True
+    print(f"Loaded {len(records)} records from {path}, building offline")
+    return len(records)
+
+
+def reset_build_state(clear_records: bool = False) -> None:
+    """Prepare for another build in the same process, e.g. the next job of the build daemon.
+
+    The build goes back online (an earlier build may have loaded a snapshot) and
+    its metrics start from zero. Records loaded from a snapshot are dropped, as
+    they may be older than upstream. Fetched records stay cached unless cleared.
+
+    :param clear_records: also forget every record fetched so far
+    """
+    global _offline
+    _offline = False
+    if clear_records:
+        _record_cache.clear()
+    else:
+        for key in _snapshot_keys:
+            _record_cache.pop(key, None)
+    _snapshot_keys.clear()
+    metrics.reset()
+
+
+def save_snapshot(path: str) -> int:
+    """Add every record fetched so far to a snapshot bundle, for offline builds with ``load_snapshot``.
+
+    :param path: gzipped JSONL bundle, created if it does not exist
+    :return: number of records in the bundle
+    """
+    count = write_snapshot(path, _record_cache.items())
+    print(f"Snapshot {path} now holds {count} records")
+    return count
+
+
+@cached_record
 def fetch_single_ena_record_by_accession(
     accession: str, result_type: str, accession_field: str = "accession"
-) -> dict:
+) -> Record | dict:
     """Fetch a single record from the ENA API.
 
     :param accession: accession of the record
@@ -55,7 +255,7 @@ def fetch_single_ena_record_by_accession(
     :param accession_field: the field which represents the accession in the chosen result_type (ENA data set). Default is "accession".
     :raises ValueError: multiple results found
     :raises ValueError: no results found
-    :return: Dictionary (a JSON object) with the record's metadata
+    :return: the record's metadata, typed for the result types the builders read (see ``records.ena_record``)
     """
     ena_api = "https://www.ebi.ac.uk/ena/portal/api"
     params = {
@@ -65,12 +265,12 @@ def fetch_single_ena_record_by_accession(
         "format": "json",
         "limit": 10,  # there should only be one, but this limit prevents malformed requests from hanging
     }
-    r = requests.get(f"{ena_api}/search", params=params)
+    r = http_get(f"{ena_api}/search", params=params)
     r.raise_for_status()
     results_list = r.json()
 
     if len(results_list) == 1:
-        return results_list[0]
+        return ena_record(result_type, results_list[0])
     elif len(results_list) > 1:
         raise ValueError(
             f'Unexpectedly retrieved multiple ENA records for accession {accession}: {[i["sample_accession"] for i in results_list]}'
@@ -79,7 +279,29 @@ def fetch_single_ena_record_by_accession(
         raise ValueError(f"No ENA record found for accession {accession}.")
 
 
-def fetch_single_bold_record_by_id(id: str, query_field: str | None = None) -> dict:
+@cached_record
+def fetch_ena_assembly_record(accession: str) -> Record:
+    """Fetch an ENA assembly record by its assembly accession or, failing that, its assembly set accession.
+
+    :param accession: e.g. GCA_964187845.1
+    :raises ValueError: no (or more than one) record found
+    :return: the record's metadata
+    """
+    # try main accession first, then set accession, as they are similar but different...
+    try:
+        return fetch_single_ena_record_by_accession(
+            accession, "assembly", "assembly_accession"
+        )
+    except ValueError:
+        return fetch_single_ena_record_by_accession(
+            accession, "assembly", "assembly_set_accession"
+        )
+
+
+@cached_record
+def fetch_single_bold_record_by_id(
+    id: str, query_field: str | None = None
+) -> BoldDocument:
     """Fetch a single record from the BOLD API.
 
     :param id: id of the record
@@ -88,7 +310,7 @@ def fetch_single_bold_record_by_id(id: str, query_field: str | None = None) -> d
         See the BOLD API docs: https://portal.boldsystems.org/api/docs#/query/query_records_api_query_get
     :raises ValueError: multiple results found
     :raises ValueError: no results found
-    :return: Dictionary (a JSON object) with the record's metadata
+    :return: the record's metadata
     """
     BOLD_API = "https://portal.boldsystems.org/api"
 
@@ -96,12 +318,12 @@ def fetch_single_bold_record_by_id(id: str, query_field: str | None = None) -> d
     if query_field:
         query_str = f"{query_field}:{id}"
     else:
-        r = requests.get(f"{BOLD_API}/query/parse", params={"query": {id}})
+        r = http_get(f"{BOLD_API}/query/parse", params={"query": {id}})
         r.raise_for_status()
         query_str = r.json()["terms"]
 
     # preprocessing - resolves wildcards to specific terms
-    r = requests.get(f"{BOLD_API}/query/preprocessor", params={"query": {query_str}})
+    r = http_get(f"{BOLD_API}/query/preprocessor", params={"query": {query_str}})
     r.raise_for_status()
     try:
         query_str = r.json()["successful_terms"][0]["matched"]
@@ -116,17 +338,17 @@ def fetch_single_bold_record_by_id(id: str, query_field: str | None = None) -> d
         print(f"Selecting first query from list: {query_str}")
 
     # query records - returns an ID which can be used to fetch data
-    r = requests.get(f"{BOLD_API}/query", params={"query": query_str})
+    r = http_get(f"{BOLD_API}/query", params={"query": query_str})
     r.raise_for_status()
     bold_query_id = r.json()["query_id"]
 
     # fetch the record
-    r = requests.get(f"{BOLD_API}/documents/{bold_query_id}")
+    r = http_get(f"{BOLD_API}/documents/{bold_query_id}")
     r.raise_for_status()
     results_list = r.json()["data"]
 
     if len(results_list) == 1:
-        return results_list[0]
+        return BoldDocument(results_list[0])
     elif len(results_list) > 1:
         raise ValueError(
             f'Unexpectedly retrieved multiple BOLD records for id {id}: {[i["processid"] for i in results_list]}'
@@ -139,13 +361,14 @@ def get_accession_permalink(prefix, accession) -> str:
     return f"https://identifiers.org/{prefix}:{accession}"
 
 
+@cached_record
 def get_copo_rocrate_uri_from_accession(accession: str) -> str:
     copo_api = "https://copo-project.org/api"
     params = {
         "standard": "tol",
         "return_type": "json",
     }
-    r = requests.get(f"{copo_api}/sample/biosampleAccession/{accession}", params=params)
+    r = http_get(f"{copo_api}/sample/biosampleAccession/{accession}", params=params)
     r.raise_for_status()
     results_list = r.json()["data"]
 
@@ -161,7 +384,7 @@ def get_copo_rocrate_uri_from_accession(accession: str) -> str:
 
 
 def load_remote_crate(uri: str) -> dict:
-    r = requests.get(uri)
+    r = http_get(uri)
     r.raise_for_status()
     dir = f"/tmp/{uuid.uuid4()}"
     with open(f"{dir}/ro-crate-metadata.json", "w") as f:
@@ -0,0 +1,153 @@
+# Barcode validation TSV helpers for BGE RO-Crate creation
+from concurrent.futures import ProcessPoolExecutor
+import io
+import os
+from typing import NamedTuple
+
+import pandas as pd
+
+# roles of the taxon names in the TSV, in the order they are listed
+TAXON_ROLES = ["species", "identification", "observed"]
+
+# free-text columns, read as strings even where a block has only missing values
+TEXT_COLUMNS = ["sequence_id", "species", "identification", "obs_taxon"]
+
+# below this many bytes, reading the TSV in one process beats starting a pool
+PARALLEL_TSV_MIN_BYTES = 64 * 1024 * 1024
+TSV_BLOCK_BYTES = 16 * 1024 * 1024
+
+
+class ValidationSummary(NamedTuple):
+    """What the crate needs from a validation TSV, in the order rows appear in the file."""
+
+    species: list[str]  # distinct expected species
+    process_ids: list[str]  # distinct BOLD process ids
+    sequence_ids: dict[str, list[str]]  # distinct sequence ids of each process id
+    names: pd.DataFrame  # distinct (bold_process_id, role, name), see ``taxon_names``
+    # sequence_id and the requested per-row columns, one row per TSV row
+    rows: pd.DataFrame
+
+
+def bold_process_id(sequence_id: str) -> str:
+    """BOLD process id a validated sequence belongs to, e.g. "BHNHM001-24" for "BHNHM001-24_r_1_s_50"."""
+    return sequence_id.split("_")[0]
+
+
+def taxon_names(df: pd.DataFrame) -> pd.DataFrame:
+    """All taxon names in the validation TSV, one row per distinct (bold_process_id, role, name).
+
+    Roles are "species" (the expected species), "identification" (the taxon the
+    validator identified) and "observed" (each of the comma-separated obs_taxon).
+    Names are listed by role, then in the order they appear in the file.
+    """
+    observed = df["obs_taxon"].str.split(",")
+    names = pd.concat(
+        [
+            pd.DataFrame(
+                {"bold_process_id": df["bold_process_id"], "role": role, "name": values}
+            )
+            for role, values in zip(
+                TAXON_ROLES, [df["species"], df["identification"], observed]
+            )
+        ]
+    ).explode("name")
+    names = names.dropna(subset=["name"])
+    names["name"] = names["name"].str.strip()
+    return names[names["name"] != ""].drop_duplicates()
+
+
+def _read_block(tsv_path: str, start: int, end: int) -> pd.DataFrame:
+    with open(tsv_path, "rb") as f:
+        header = f.readline()
+        f.seek(start)
+        block = f.read(end - start)
+    return pd.read_table(
+        io.BytesIO(header + block), dtype=dict.fromkeys(TEXT_COLUMNS, str)
+    )
+
+
+def _summarise_block(
+    tsv_path: str, start: int, end: int, columns: list[str]
+) -> ValidationSummary:
+    df = _read_block(tsv_path, start, end)
+    df["bold_process_id"] = df["sequence_id"].map(bold_process_id)
+    sequence_ids = df.groupby("bold_process_id", sort=False)["sequence_id"].unique()
+    return ValidationSummary(
+        species=list(df["species"].unique()),
+        process_ids=list(df["bold_process_id"].unique()),
+        sequence_ids={p: list(ids) for p, ids in sequence_ids.items()},
+        names=taxon_names(df),
+        rows=df[["sequence_id", *columns]],
+    )
+
+
+def _blocks(tsv_path: str, block_bytes: int) -> list[tuple[int, int]]:
+    """Byte ranges of whole lines after the header, each about ``block_bytes`` long."""
+    size = os.path.getsize(tsv_path)
+    blocks = []
+    with open(tsv_path, "rb") as f:
+        f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + block_bytes, size))
+            f.readline()  # finish the line the block ends in
+            end = min(f.tell(), size)
+            blocks.append((start, end))
+            start = end
+    # a file with only a header still makes one (empty) block
+    return blocks or [(start, start)]
+
+
+def _merge(parts: list[ValidationSummary]) -> ValidationSummary:
+    sequence_ids = {}
+    for part in parts:
+        for process_id, ids in part.sequence_ids.items():
+            sequence_ids.setdefault(process_id, []).extend(ids)
+    names = pd.concat([part.names for part in parts], ignore_index=True)
+    # blocks list names by role each, so put the roles back together, keeping file order within them
+    names = names.sort_values(
+        "role", key=lambda role: role.map(TAXON_ROLES.index), kind="stable"
+    ).drop_duplicates()
+    return ValidationSummary(
+        # pd.unique, unlike a dict, treats the missing values of different blocks as one
+        species=list(pd.unique(pd.Series([s for part in parts for s in part.species]))),
+        process_ids=list(
+            pd.unique(pd.Series([p for part in parts for p in part.process_ids]))
+        ),
+        sequence_ids={p: list(dict.fromkeys(ids)) for p, ids in sequence_ids.items()},
+        names=names.reset_index(drop=True),
+        rows=pd.concat([part.rows for part in parts], ignore_index=True),
+    )
+
+
+def summarise_validation_tsv(
+    tsv_path: str, columns: list[str] = (), workers: int | None = None
+) -> ValidationSummary:
+    """Read a barcode validation TSV into what the crate needs, using all cores for large files.
+
+    Large files are split into blocks of whole rows, which are read and summarised
+    in separate processes. The partial summaries are merged in file order, so the
+    result is the same whatever the number of blocks or workers.
+
+    :param tsv_path: TSV written by the barcode validator
+    :param columns: per-row columns to keep besides sequence_id, e.g. base counts to check
+    :param workers: number of processes, defaults to the number of CPUs
+    :return: the summary
+    """
+    size = os.path.getsize(tsv_path)
+    if size < PARALLEL_TSV_MIN_BYTES or workers == 1:
+        return _merge(
+            [
+                _summarise_block(tsv_path, start, end, list(columns))
+                for start, end in _blocks(tsv_path, size)
+            ]
+        )
+    blocks = _blocks(tsv_path, TSV_BLOCK_BYTES)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parts = executor.map(
+            _summarise_block,
+            [tsv_path] * len(blocks),
+            *zip(*blocks),
+            [list(columns)] * len(blocks),
+        )
+        return _merge(list(parts))